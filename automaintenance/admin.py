@@ -16,26 +16,379 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 ##
 
+from django.conf import settings
 from django.contrib import admin
+from django.contrib.admin.util import unquote
+from django.contrib.admin.views.main import ChangeList
+from django.core.exceptions import PermissionDenied
+from django.core.paginator import Paginator, InvalidPage
+from django.core.urlresolvers import reverse
+from django.contrib.admin.options import IncorrectLookupParameters
+from django.db import connections
+from django.http import Http404, HttpResponseRedirect
+from django.template.response import TemplateResponse
+from django.utils.encoding import force_text
+from django.utils.text import capfirst
 
-from automaintenance.models import Car, Trip
+from automaintenance.models import Car, Trip, GasolinePurchase, OilChange
+from automaintenance.models import Maintenance, Payment, RECORD_MODELS
+from automaintenance.deletion import delete_car, delete_trip
+from automaintenance.bulk import delete_records, move_records_to_trip
 
 
-class TripAdmin(admin.ModelAdmin):
+# Tables with fewer rows than this are counted exactly on the change lists,
+# larger ones use the estimate of the database when the list isn't filtered.
+EXACT_COUNT_LIMIT = getattr(settings,
+                            'AUTOMAINTENANCE_ADMIN_EXACT_COUNT_LIMIT', 10000)
+
+
+def estimated_count(queryset):
     """
-        Admin that will provide capability to modify the trip objects in the
-        default django admin.
+        Returns the number of rows of the table of the queryset from the
+        statistics of the database, or None if the queryset is filtered or
+        the database doesn't keep an estimate.
+    """
+    if queryset.query.where or queryset.query.having:
+        return None
+
+    connection = connections[queryset.db]
+    table = queryset.model._meta.db_table
+    if connection.vendor == 'postgresql':
+        sql = 'SELECT reltuples FROM pg_class WHERE relname = %s'
+    elif connection.vendor == 'mysql':
+        sql = 'SELECT table_rows FROM information_schema.tables ' \
+              'WHERE table_schema = DATABASE() AND table_name = %s'
+    else:
+        return None
+
+    cursor = connection.cursor()
+    cursor.execute(sql, [table])
+    row = cursor.fetchone()
+    if row is None or row[0] is None or row[0] < EXACT_COUNT_LIMIT:
+        return None
+    return int(row[0])
+
+
+class EstimatedCountPaginator(Paginator):
+    """
+        Paginator that doesn't count every row of large unfiltered tables.
+    """
+
+    def _get_count(self):
+        if self._count is None:
+            self._count = estimated_count(self.object_list)
+        if self._count is None:
+            self._count = self.object_list.count()
+        return self._count
+    count = property(_get_count)
+
+
+class EstimatedCountChangeList(ChangeList):
+    """
+        Change list that estimates the number of rows of the whole table
+        shown next to the number of filtered rows.
+    """
+
+    def get_results(self, request):
+        paginator = self.model_admin.get_paginator(request, self.query_set,
+                                                   self.list_per_page)
+        result_count = paginator.count
+
+        if not self.query_set.query.where:
+            full_result_count = result_count
+        else:
+            full_result_count = EstimatedCountPaginator(self.root_query_set,
+                                                        1).count
+
+        can_show_all = result_count <= self.list_max_show_all
+        multi_page = result_count > self.list_per_page
+
+        if (self.show_all and can_show_all) or not multi_page:
+            result_list = self.query_set._clone()
+        else:
+            try:
+                result_list = paginator.page(self.page_num + 1).object_list
+            except InvalidPage:
+                raise IncorrectLookupParameters
+
+        self.result_count = result_count
+        self.full_result_count = full_result_count
+        self.result_list = result_list
+        self.can_show_all = can_show_all
+        self.multi_page = multi_page
+        self.paginator = paginator
+
+
+class EstimatedCountAdmin(admin.ModelAdmin):
+    """
+        Admin of a table that can grow too large to count on every page of
+        its change list.  Deleting the selected rows is replaced by set based
+        actions.
+    """
+    paginator = EstimatedCountPaginator
+    list_select_related = True
+
+    def get_changelist(self, request, **kwargs):
+        return EstimatedCountChangeList
+
+    def get_actions(self, request):
+        """
+            The default action loads every row and the rows that refer to
+            it before deleting them.
+        """
+        actions = super(EstimatedCountAdmin, self).get_actions(request)
+        actions.pop('delete_selected', None)
+        return actions
+
+
+class CarFilter(admin.SimpleListFilter):
+    """
+        Filter on the car whose id is in the query string, such as ?car=12.
+        Only that car is shown in the sidebar, listing every car would load
+        the whole table on each page.
+    """
+    title = 'car'
+    parameter_name = 'car'
+
+    def lookups(self, request, model_admin):
+        car_id = request.GET.get(self.parameter_name)
+        if not car_id or not car_id.isdigit():
+            return ()
+        names = Car.all_objects.filter(pk=car_id).values_list('name',
+                                                              flat=True)
+        return [(car_id, names[0] if names else car_id)]
+
+    def queryset(self, request, queryset):
+        if self.value():
+            return queryset.filter(car=self.value())
+
+
+class DeletedFilter(admin.SimpleListFilter):
+    """
+        Filter on whether the car or the trip was deleted but not purged yet.
+    """
+    title = 'deleted'
+    parameter_name = 'deleted'
+
+    def lookups(self, request, model_admin):
+        return (('yes', 'Deleted'), ('no', 'Not deleted'))
+
+    def queryset(self, request, queryset):
+        if self.value() in ('yes', 'no'):
+            return queryset.filter(deleted__isnull=self.value() == 'no')
+
+
+class SoftDeleteAdmin(EstimatedCountAdmin):
+    """
+        Admin of the cars and trips.  The hidden ones are listed too, and
+        deleting one asks for confirmation with the number of records it
+        affects instead of loading every one of them.
     """
-    pass
+    def queryset(self, request):
+        """
+            The default manager leaves out the hidden rows, and the change
+            list couldn't use the estimated count with its filter.
+        """
+        queryset = self.model.all_objects.get_query_set()
+        ordering = self.get_ordering(request)
+        if ordering:
+            queryset = queryset.order_by(*ordering)
+        return queryset
+
+    def affected_records(self, obj):
+        """
+            Returns the querysets of the records affected by the deletion of
+            the object.
+        """
+        raise NotImplementedError
+
+    def deletion_summary(self, obj):
+        """
+            Returns the confirmation list of the deletion, the object
+            followed by the number of records it affects by record type.
+        """
+        counts = []
+        for queryset in self.affected_records(obj):
+            count = queryset.count()
+            if count:
+                name = queryset.model._meta.verbose_name_plural
+                counts.append('%d %s' % (count, force_text(name)))
+        return ['%s: %s' % (capfirst(force_text(obj._meta.verbose_name)),
+                            force_text(obj)), counts]
+
+    def delete_view(self, request, object_id, extra_context=None):
+        """
+            The delete view of the admin without get_deleted_objects, which
+            loads every record that refers to the object.
+        """
+        opts = self.model._meta
+        obj = self.get_object(request, unquote(object_id))
 
+        if not self.has_delete_permission(request, obj):
+            raise PermissionDenied
+        if obj is None:
+            raise Http404('%s object with primary key %r does not exist.' %
+                          (force_text(opts.verbose_name), object_id))
 
-class CarAdmin(admin.ModelAdmin):
+        if request.POST:
+            obj_display = force_text(obj)
+            self.log_deletion(request, obj, obj_display)
+            self.delete_model(request, obj)
+            self.message_user(request, 'The %s "%s" was deleted.' %
+                              (force_text(opts.verbose_name), obj_display))
+            return HttpResponseRedirect(reverse(
+                'admin:%s_%s_changelist' % (opts.app_label, opts.module_name),
+                current_app=self.admin_site.name))
+
+        context = {
+            'title': 'Are you sure?',
+            'object_name': force_text(opts.verbose_name),
+            'object': obj,
+            'deleted_objects': self.deletion_summary(obj),
+            'perms_lacking': (),
+            'protected': (),
+            'opts': opts,
+            'app_label': opts.app_label,
+        }
+        context.update(extra_context or {})
+
+        return TemplateResponse(request, self.delete_confirmation_template or [
+            'admin/%s/%s/delete_confirmation.html' % (
+                opts.app_label, opts.object_name.lower()),
+            'admin/%s/delete_confirmation.html' % opts.app_label,
+            'admin/delete_confirmation.html'
+        ], context, current_app=self.admin_site.name)
+
+
+class CarAdmin(SoftDeleteAdmin):
     """
         Admin that will provide capability to modify the car objects in the
         default django admin.
     """
-    pass
+    list_display = ('name', 'slug', 'owner', 'car_type', 'deleted')
+    list_filter = (DeletedFilter,)
+    raw_id_fields = ('owner',)
+    search_fields = ('name', 'slug')
+    actions = ['delete_cars']
+
+    def affected_records(self, obj):
+        """
+            The records of the car are deleted with it.
+        """
+        return [model.objects.filter(car=obj.pk) for model in RECORD_MODELS]
+
+    def delete_model(self, request, obj):
+        """
+            Delete the records of the car without loading them.
+        """
+        delete_car(obj)
+
+    def delete_cars(self, request, queryset):
+        """
+            Delete the selected cars and their records.
+        """
+        count = 0
+        for car in queryset:
+            delete_car(car)
+            count += 1
+        self.message_user(request, 'Deleted %d cars.' % count)
+    delete_cars.short_description = 'Delete selected cars'
+
+
+class TripAdmin(SoftDeleteAdmin):
+    """
+        Admin that will provide capability to modify the trip objects in the
+        default django admin.
+    """
+    list_display = ('name', 'car', 'start', 'end', 'deleted')
+    list_filter = (CarFilter, DeletedFilter)
+    raw_id_fields = ('car',)
+    search_fields = ('name', 'slug', '=car__slug')
+    ordering = ('-id',)
+    actions = ['delete_trips']
+
+    def affected_records(self, obj):
+        """
+            The records of the trip are kept, only taken out of it.
+        """
+        return [model.objects.filter(trip=obj.pk) for model in RECORD_MODELS]
+
+    def delete_model(self, request, obj):
+        """
+            Take the records out of the trip without loading them.
+        """
+        delete_trip(obj)
+
+    def delete_trips(self, request, queryset):
+        """
+            Delete the selected trips, keeping their records.
+        """
+        count = 0
+        for trip in queryset:
+            delete_trip(trip)
+            count += 1
+        self.message_user(request, 'Deleted %d trips.' % count)
+    delete_trips.short_description = 'Delete selected trips'
+
+
+class RecordAdmin(EstimatedCountAdmin):
+    """
+        Admin of the records.  The lists are searched by the slug of the car
+        and ordered by primary key, the records aren't indexed by date alone.
+        The car is filtered on by id from the query string, the records are
+        indexed by car and date.
+    """
+    list_display = ('date', 'car', 'location', 'mileage', 'total_cost')
+    list_filter = (CarFilter, 'date')
+    raw_id_fields = ('car', 'trip')
+    search_fields = ('=car__slug',)
+    ordering = ('-id',)
+    actions = ['delete_records', 'remove_from_trip']
+
+    def delete_records(self, request, queryset):
+        """
+            Delete the selected records with one statement.
+        """
+        count = delete_records([queryset])
+        self.message_user(request, 'Deleted %d records.' % count)
+    delete_records.short_description = 'Delete selected records'
+
+    def remove_from_trip(self, request, queryset):
+        """
+            Take the selected records out of their trips with one statement.
+        """
+        count = move_records_to_trip([queryset], None)
+        self.message_user(request, 'Removed %d records from their trips.' %
+                          count)
+    remove_from_trip.short_description = 'Remove selected records from trips'
+
+
+class GasolinePurchaseAdmin(RecordAdmin):
+    """
+        Admin of the gasoline purchases.
+    """
+    list_display = RecordAdmin.list_display + ('fuel_amount',
+                                               'price_per_unit')
+
+
+class MaintenanceAdmin(RecordAdmin):
+    """
+        Admin of the maintenance records.
+    """
+    list_display = RecordAdmin.list_display + ('type',)
+
+
+class PaymentAdmin(RecordAdmin):
+    """
+        Admin of the payments.
+    """
+    list_display = ('date', 'car', 'type', 'total_cost')
+
 
 # Add the Admin objects to the admin infrastructure.
 admin.site.register(Trip, TripAdmin)
 admin.site.register(Car, CarAdmin)
+admin.site.register(GasolinePurchase, GasolinePurchaseAdmin)
+admin.site.register(OilChange, RecordAdmin)
+admin.site.register(Maintenance, MaintenanceAdmin)
+admin.site.register(Payment, PaymentAdmin)
@@ -0,0 +1,238 @@
+##
+# Automaintenance.  Django app to track automaintenance records.
+# Copyright (C) 2012 Robert Robinson
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+##
+from django.conf import settings
+from django.db import transaction
+from django.utils.timezone import is_aware, now, utc
+
+from automaintenance.models import RecordArchive, RECORD_MODELS
+from automaintenance.caching import bump_record_versions
+from automaintenance.sequences import chunks
+from automaintenance.signals import notify_records_changed
+
+from collections import defaultdict
+from datetime import datetime, timedelta
+
+import base64
+import json
+import zlib
+
+
+# Number of days after which the records are archived.  Only whole years
+# are archived, so records are archived once the year they are from ended
+# at least this many days ago.
+ARCHIVE_AFTER_DAYS = getattr(settings, 'AUTOMAINTENANCE_ARCHIVE_AFTER_DAYS',
+                             730)
+
+
+def archive_type(model):
+    """
+        Returns the name of the records of the model in the archives.
+    """
+    return model.__name__.lower()
+
+
+# Models of the archived records keyed by their name in the archives.
+ARCHIVE_MODELS = dict((archive_type(model), model) for model in RECORD_MODELS)
+
+
+def archive_fields(model):
+    """
+        Returns the fields of the model that are stored in the archives.
+    """
+    return model._meta.local_fields
+
+
+def encode(value):
+    """
+        Returns the value in a form that can be stored as json.
+    """
+    if isinstance(value, datetime):
+        if is_aware(value):
+            value = value.astimezone(utc)
+        return value.isoformat()
+    if value is not None and not isinstance(value, (int, long, bool,
+                                                    basestring)):
+        return unicode(value)
+    return value
+
+
+def pack(archived):
+    """
+        Returns the archive data of the records, archived holds lists of the
+        values of the archive fields keyed by the type of the records.
+    """
+    data = {}
+    for model in RECORD_MODELS:
+        rows = archived.get(archive_type(model))
+        if rows:
+            data[archive_type(model)] = {
+                'fields': [field.name for field in archive_fields(model)],
+                'rows': [[encode(value) for value in row] for row in rows]}
+    return base64.b64encode(zlib.compress(json.dumps(data)))
+
+
+def unpack(data):
+    """
+        Returns the records stored in the archive data as dictionaries of
+        their field values keyed by the type of the records.  Relations are
+        stored by id under the name of the field like values_list, and the
+        primary key is also stored as pk.
+    """
+    data = json.loads(zlib.decompress(base64.b64decode(data)))
+
+    records = defaultdict(list)
+    for model in RECORD_MODELS:
+        stored = data.get(archive_type(model))
+        if not stored:
+            continue
+
+        fields = dict((field.name, field) for field in archive_fields(model))
+        names = stored['fields']
+        for row in stored['rows']:
+            record = dict((name, fields[name].to_python(value))
+                          for name, value in zip(names, row)
+                          if name in fields)
+            record['pk'] = record[model._meta.pk.name]
+            records[archive_type(model)].append(record)
+
+    return records
+
+
+def year_start(year):
+    """
+        Returns the start of the year, archives are split by the UTC year.
+    """
+    return datetime(year, 1, 1, tzinfo=utc)
+
+
+def archived_records(car_ids, start_date=None, end_date=None, trip=None):
+    """
+        Returns the archived records of the cars in the date range and trip
+        provided, keyed by their model, the records of every car if car_ids
+        is None.  Only the archives of the years that the date range reaches
+        into are read.
+    """
+    archives = RecordArchive.objects.all()
+    if car_ids is not None:
+        archives = archives.filter(car__in=list(car_ids))
+    if start_date is not None:
+        archives = archives.filter(year__gte=start_date.astimezone(utc).year)
+    if end_date is not None:
+        archives = archives.filter(year__lte=end_date.astimezone(utc).year)
+
+    def selected(record):
+        return (start_date is None or record['date'] >= start_date) and \
+            (end_date is None or record['date'] <= end_date) and \
+            (trip is None or record['trip'] == trip.pk)
+
+    records = dict((model, []) for model in RECORD_MODELS)
+    for data in archives.values_list('data', flat=True):
+        archived = unpack(data)
+        for model in RECORD_MODELS:
+            records[model].extend(record for record in
+                                  archived[archive_type(model)]
+                                  if selected(record))
+
+    return records
+
+
+def latest_archived(car, model):
+    """
+        Returns the latest archived record of the model for the car as an
+        instance of the model, or None.  Archived records can't be saved.
+    """
+    archives = RecordArchive.objects.filter(car=car).order_by('-year')
+    for data in archives.values_list('data', flat=True):
+        archived = unpack(data)[archive_type(model)]
+        if archived:
+            record = max(archived,
+                         key=lambda record: (record['date'],
+                                             record['sequence']))
+            return model(**dict((field.attname, record[field.name])
+                                for field in archive_fields(model)))
+    return None
+
+
+def archive_car(car_id, boundary):
+    """
+        Move the records of the car from before the boundary into the
+        archives of their years.  Returns the number of records archived.
+    """
+    archived = defaultdict(lambda: defaultdict(list))
+    moved = {}
+
+    with transaction.commit_on_success():
+        for model in RECORD_MODELS:
+            names = [field.name for field in archive_fields(model)]
+            date_index = names.index('date')
+            pk_index = names.index(model._meta.pk.name)
+
+            rows = list(model.objects.filter(
+                car=car_id, date__lt=boundary).values_list(*names))
+            for row in rows:
+                year = row[date_index].astimezone(utc).year
+                archived[year][archive_type(model)].append(row)
+            if rows:
+                moved[model] = [row[pk_index] for row in rows]
+
+        if not moved:
+            return 0
+
+        for year, rows in archived.items():
+            archive, created = RecordArchive.objects.select_for_update(
+                ).get_or_create(car_id=car_id, year=year,
+                                defaults={'data': ''})
+            if not created:
+                for type_name, records in unpack(archive.data).items():
+                    names = [field.name for field in
+                             archive_fields(ARCHIVE_MODELS[type_name])]
+                    rows[type_name].extend([record[name] for name in names]
+                                           for record in records)
+
+            archive.data = pack(rows)
+            archive.records = sum(len(type_rows)
+                                  for type_rows in rows.values())
+            archive.save()
+
+        for model, pks in moved.items():
+            for chunk in chunks(pks):
+                # The records are still part of the history of the car, so
+                # none of the handlers of a deleted record should run.
+                query = model.objects.filter(pk__in=chunk)
+                query._raw_delete(query.db)
+            bump_record_versions(model, pks)
+
+        notify_records_changed([car_id])
+
+    return sum(len(pks) for pks in moved.values())
+
+
+def archive_records(after_days=ARCHIVE_AFTER_DAYS, car_ids=None):
+    """
+        Archive the records of the years that ended at least after_days ago,
+        one car per transaction.  Returns the number of records archived.
+    """
+    boundary = year_start((now() - timedelta(days=after_days)).year)
+
+    if car_ids is None:
+        car_ids = set()
+        for model in RECORD_MODELS:
+            car_ids.update(model.objects.filter(date__lt=boundary).order_by(
+                ).values_list('car', flat=True).distinct())
+
+    return sum(archive_car(car_id, boundary) for car_id in sorted(car_ids))
@@ -0,0 +1,116 @@
+##
+# Automaintenance.  Django app to track automaintenance records.
+# Copyright (C) 2012 Robert Robinson
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+##
+from django.db import transaction
+
+from automaintenance.sequences import taken_sequences, next_sequences
+from automaintenance.signals import notify_records_changed
+from automaintenance.changes import log_changes
+from automaintenance.models import CHANGE_UPDATE, CHANGE_DELETE
+
+
+def affected_cars(querysets):
+    """
+        Returns the ids of the cars that own the records of the querysets.
+    """
+    car_ids = set()
+    for queryset in querysets:
+        car_ids.update(queryset.values_list('car', flat=True).distinct())
+    return car_ids
+
+
+def delete_records(querysets):
+    """
+        Delete the records of the querysets with one DELETE statement per
+        record type.  Returns the number of records deleted.
+    """
+    count = 0
+
+    with transaction.commit_on_success():
+        car_ids = affected_cars(querysets)
+
+        for queryset in querysets:
+            rows = list(queryset.values_list('pk', 'car'))
+            count += len(rows)
+            # Nothing references the records, so there is no need for the
+            # collector to load every row before deleting it.
+            queryset._raw_delete(queryset.db)
+            log_changes(queryset.model, CHANGE_DELETE, rows)
+
+        notify_records_changed(car_ids)
+
+    return count
+
+
+def move_records_to_trip(querysets, trip):
+    """
+        Move the records of the querysets to the trip, or out of their trip
+        when trip is None.  Returns the number of records moved.
+    """
+    count = 0
+
+    with transaction.commit_on_success():
+        car_ids = affected_cars(querysets)
+
+        for queryset in querysets:
+            rows = list(queryset.values_list('pk', 'car'))
+            count += queryset.update(trip=trip)
+            log_changes(queryset.model, CHANGE_UPDATE, rows)
+
+        notify_records_changed(car_ids)
+
+    return count
+
+
+def move_records_to_car(querysets, car):
+    """
+        Move the records of the querysets to another car.  The trips of the
+        records belong to the old car so the records are taken out of them.
+        Records that collide with the dates of the car are given the next
+        sequence number of their date.  Returns the number of records moved.
+    """
+    count = 0
+
+    with transaction.commit_on_success():
+        car_ids = affected_cars(querysets)
+        car_ids.add(car.pk)
+
+        for queryset in querysets:
+            moving = list(queryset.exclude(car=car).order_by(
+                'date', 'sequence', 'pk').values_list('pk', 'date',
+                                                      'sequence'))
+            taken = taken_sequences(queryset.model,
+                                    [(car.pk, row[1]) for row in moving])
+            renumbered = next_sequences(taken, [((car.pk, row[1]), row[2])
+                                                for row in moving])
+
+            rows = list(queryset.values_list('pk', 'car'))
+            count += len(rows)
+            for index, sequence in renumbered.items():
+                queryset.model.objects.filter(pk=moving[index][0]).update(
+                    car=car, trip=None, sequence=sequence)
+            queryset.update(car=car, trip=None)
+
+            # Clients following the old cars see the records go away.
+            log_changes(queryset.model, CHANGE_DELETE,
+                        [row for row in rows if row[1] != car.pk])
+            log_changes(queryset.model, CHANGE_UPDATE,
+                        [(pk, car.pk) for pk, car_id in rows])
+
+        notify_records_changed(car_ids)
+
+    return count
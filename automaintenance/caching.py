@@ -0,0 +1,81 @@
+##
+# Automaintenance.  Django app to track automaintenance records.
+# Copyright (C) 2012 Robert Robinson
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+##
+from django.conf import settings
+from django.core.cache import cache
+
+from automaintenance.metrics import cache_lookups
+
+import uuid
+
+
+# Number of seconds that rendered rows of the maintenance lists are cached.
+ROW_CACHE_TIMEOUT = getattr(settings, 'AUTOMAINTENANCE_ROW_CACHE_TIMEOUT',
+                            60 * 60 * 24)
+
+
+def record_type(record):
+    """
+        Returns the name of the type of the record used in the cache keys.
+        Listing rows are named after the model they were read from.
+    """
+    model = getattr(record, 'model', None) or record.__class__
+    return model.__name__.lower()
+
+
+def record_version_key(type_name, pk):
+    """
+        Returns the cache key that stores the version of a record.
+    """
+    return 'automaintenance:record_version:%s:%s' % (type_name, pk)
+
+
+def new_version():
+    """
+        Returns a version that hasn't been used before.
+    """
+    return uuid.uuid4().hex
+
+
+def record_versions(records):
+    """
+        Returns the versions of the records keyed by (type name, pk).  Records
+        without a cached version get a new one, so rows cached under a version
+        that was evicted are never used again.
+    """
+    keys = dict((record_version_key(record_type(record), record.pk),
+                 (record_type(record), record.pk)) for record in records)
+    cached = cache.get_many(keys.keys())
+
+    missing = dict((key, new_version()) for key in keys if key not in cached)
+    if missing:
+        cache.set_many(missing, ROW_CACHE_TIMEOUT)
+        cached.update(missing)
+    cache_lookups('record_versions', hits=len(keys) - len(missing),
+                  misses=len(missing))
+
+    return dict((keys[key], version) for key, version in cached.items())
+
+
+def bump_record_versions(model, pks):
+    """
+        Give the records of the model a new version, which makes the cached
+        rows of the records stale.
+    """
+    type_name = model.__name__.lower()
+    cache.set_many(dict((record_version_key(type_name, pk), new_version())
+                        for pk in pks), ROW_CACHE_TIMEOUT)
@@ -0,0 +1,199 @@
+##
+# Automaintenance.  Django app to track automaintenance records.
+# Copyright (C) 2012 Robert Robinson
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+##
+from django.conf import settings
+from django.db import router, transaction
+from django.db.models import Count, Max, Min
+from django.utils.timezone import now
+
+from automaintenance.models import Car, Trip, Change, ChangeHorizon
+from automaintenance.models import RECORD_MODELS, CHANGE_DELETE
+from automaintenance.sequences import chunks
+
+from collections import defaultdict
+from datetime import timedelta
+
+
+# Number of days that the changes of deleted objects are kept.  Clients that
+# didn't sync within that many days have to download the history again.
+CHANGE_RETENTION_DAYS = getattr(settings,
+                                'AUTOMAINTENANCE_CHANGE_RETENTION_DAYS', 30)
+
+# Number of seconds before a change is served.  Sequences are handed out when
+# a change is logged but become visible when its transaction commits, so a
+# change logged by a slow transaction can appear behind a cursor that already
+# went past it.  Holding back the recent changes leaves that long for the
+# transactions to commit, it has to cover the longest transaction that logs
+# changes and the clock difference between the servers.
+CHANGE_VISIBILITY_SECONDS = getattr(
+    settings, 'AUTOMAINTENANCE_CHANGE_VISIBILITY_SECONDS', 10)
+
+
+def change_type(model):
+    """
+        Returns the name of the type of the objects of the model in the feed.
+    """
+    return model.__name__.lower()
+
+
+# Models whose changes are in the feed, keyed by their type name.
+CHANGE_MODELS = dict((change_type(model), model)
+                     for model in (Car, Trip) + RECORD_MODELS)
+
+
+def log_changes(model, action, rows, owners=None):
+    """
+        Append the change of the objects to the feed.  Rows are (object id,
+        car id) tuples.  The owners of the cars are looked up unless they are
+        provided keyed by car id, the changes of cars that are gone are not
+        logged since the change of the car covers them.
+    """
+    rows = list(rows)
+    if not rows:
+        return
+
+    if owners is None:
+        owners = {}
+        car_ids = list(set(car_id for object_id, car_id in rows))
+        for chunk in chunks(car_ids):
+            owners.update(Car.objects.filter(pk__in=chunk).values_list(
+                'pk', 'owner'))
+
+    object_type = change_type(model)
+    Change.objects.bulk_create([
+        Change(owner_id=owners[car_id], car_id=car_id,
+               object_type=object_type, object_id=object_id, action=action)
+        for object_id, car_id in rows if car_id in owners])
+
+
+def change_horizon(owner):
+    """
+        Returns the sequence up to which the changes of the owner were
+        compacted away.
+    """
+    for sequence in ChangeHorizon.objects.filter(owner=owner).values_list(
+            'sequence', flat=True):
+        return sequence
+    return 0
+
+
+def latest_change(owner):
+    """
+        Returns the sequence of the last visible change of the owner, None if
+        the owner has no changes.  Recent changes are not visible yet, the
+        sequence stops before the first of them.
+    """
+    visible = now() - timedelta(seconds=CHANGE_VISIBILITY_SECONDS)
+    recent = Change.objects.filter(owner=owner, date__gt=visible).aggregate(
+        first=Min('pk'))['first']
+    if recent is not None:
+        return recent - 1
+    return Change.objects.filter(owner=owner).aggregate(
+        latest=Max('pk'))['latest']
+
+
+def changes_since(owner, cursor, limit, car_id=None):
+    """
+        Returns the changes of the owner after the cursor, at most limit of
+        them, and whether there are more changes.  Each change comes with the
+        current values of its object, None for deleted objects.  The changes
+        stop before the first change logged less than the visibility seconds
+        ago, so that no sequence below the returned ones can still commit.
+    """
+    query = Change.objects.filter(owner=owner, pk__gt=cursor)
+    if car_id is not None:
+        query = query.filter(car_id=car_id)
+    changes = list(query.order_by('pk')[:limit + 1])
+    has_more = len(changes) > limit
+    changes = changes[:limit]
+
+    visible = now() - timedelta(seconds=CHANGE_VISIBILITY_SECONDS)
+    for index, change in enumerate(changes):
+        if change.date > visible:
+            changes = changes[:index]
+            has_more = False
+            break
+
+    object_ids = defaultdict(set)
+    for change in changes:
+        if change.action != CHANGE_DELETE:
+            object_ids[change.object_type].add(change.object_id)
+
+    values = {}
+    for object_type, ids in object_ids.items():
+        for chunk in chunks(list(ids)):
+            for row in CHANGE_MODELS[object_type].objects.filter(
+                    pk__in=chunk).values():
+                values[(object_type, row['id'])] = row
+
+    return [(change, values.get((change.object_type, change.object_id)))
+            for change in changes], has_more
+
+
+def compact_changes(retention_days=CHANGE_RETENTION_DAYS):
+    """
+        Keep the feed bounded.  Only the last change of an object is kept per
+        car, which is all a client needs to catch up from any cursor, and the
+        changes of objects deleted more than the retention days ago are
+        dropped.  Returns the number of changes removed.
+    """
+    removed = 0
+    using = router.db_for_write(Change)
+
+    with transaction.commit_on_success(using=using):
+        superseded = Change.objects.order_by().values(
+            'owner', 'car_id', 'object_type', 'object_id').annotate(
+            last=Max('pk'), entries=Count('pk')).filter(entries__gt=1)
+        last = {}
+        object_ids = defaultdict(set)
+        for group in superseded:
+            key = (group['owner'], group['car_id'], group['object_type'],
+                   group['object_id'])
+            last[key] = group['last']
+            object_ids[group['object_type']].add(group['object_id'])
+
+        removable = []
+        for object_type, ids in object_ids.items():
+            for chunk in chunks(list(ids)):
+                for row in Change.objects.filter(
+                        object_type=object_type,
+                        object_id__in=chunk).values_list(
+                        'pk', 'owner', 'car_id', 'object_type', 'object_id'):
+                    if row[0] < last.get(row[1:], 0):
+                        removable.append(row[0])
+
+        for chunk in chunks(removable):
+            Change.objects.filter(pk__in=chunk)._raw_delete(using)
+        removed += len(removable)
+
+        expired = Change.objects.filter(
+            action=CHANGE_DELETE,
+            date__lt=now() - timedelta(days=retention_days))
+        horizons = dict(expired.order_by().values('owner').annotate(
+            last=Max('pk')).values_list('owner', 'last'))
+
+        for owner_id, sequence in horizons.items():
+            horizon, created = ChangeHorizon.objects.get_or_create(
+                owner_id=owner_id)
+            if sequence > horizon.sequence:
+                horizon.sequence = sequence
+                horizon.save()
+
+        removed += expired.count()
+        expired._raw_delete(using)
+
+    return removed
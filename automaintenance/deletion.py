@@ -0,0 +1,204 @@
+##
+# Automaintenance.  Django app to track automaintenance records.
+# Copyright (C) 2012 Robert Robinson
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+##
+from django.conf import settings
+from django.db import router, transaction
+from django.utils.timezone import now
+
+from automaintenance.models import Car, Trip, RECORD_MODELS
+from automaintenance.models import CHANGE_UPDATE, CHANGE_DELETE
+from automaintenance.changes import log_changes
+from automaintenance.signals import notify_records_changed
+from automaintenance.versions import bump_car_versions, retire_car_versions
+from automaintenance.locations import refresh_locations
+from automaintenance.sequences import LOOKUP_CHUNK_SIZE
+
+
+# Whether deleting a car or a trip only hides it, leaving the removal of its
+# records to the purge_deleted command.
+SOFT_DELETE = getattr(settings, 'AUTOMAINTENANCE_SOFT_DELETE', False)
+
+# Number of records removed or taken out of a trip per transaction when the
+# deleted cars and trips are purged.
+PURGE_BATCH_SIZE = getattr(settings, 'AUTOMAINTENANCE_PURGE_BATCH_SIZE',
+                           LOOKUP_CHUNK_SIZE)
+
+
+def clear_trip(trip_id, car_id, batch_size=None):
+    """
+        Take the records out of the trip with one UPDATE statement per record
+        type, at most batch size records when one is provided.  Returns the
+        number of records taken out.
+    """
+    count = 0
+    for model in RECORD_MODELS:
+        limit = None if batch_size is None else batch_size - count
+        if limit == 0:
+            break
+
+        query = model.objects.filter(trip=trip_id)
+        pks = list(query.order_by('pk').values_list('pk', flat=True)[:limit])
+        if not pks:
+            continue
+        if batch_size is not None:
+            query = model.objects.filter(pk__in=pks)
+
+        query.update(trip=None)
+        log_changes(model, CHANGE_UPDATE, [(pk, car_id) for pk in pks])
+        count += len(pks)
+
+    return count
+
+
+def clear_car(car_id, batch_size=None):
+    """
+        Remove the records of the car with one DELETE statement per record
+        type, at most batch size records when one is provided.  Returns the
+        number of records removed in the batch.  The changes of the records
+        are not logged, the deletion of the car covers them.
+    """
+    count = 0
+    for model in RECORD_MODELS:
+        query = model.objects.filter(car=car_id)
+        if batch_size is not None:
+            limit = batch_size - count
+            if limit == 0:
+                break
+            pks = list(query.order_by('pk').values_list('pk',
+                                                        flat=True)[:limit])
+            if not pks:
+                continue
+            count += len(pks)
+            query = model.objects.filter(pk__in=pks)
+
+        query._raw_delete(router.db_for_write(model))
+
+    return count
+
+
+def remove_car(car_id):
+    """
+        Remove the rows that refer to the car and the car itself, once its
+        records are gone.
+    """
+    # Recounting the locations of the car without its records drops its
+    # counts from the totals of the dictionary.
+    refresh_locations([car_id])
+    retire_car_versions([car_id])
+
+    for related in Car._meta.get_all_related_objects(include_hidden=True):
+        query = related.model._base_manager.filter(**{
+            related.field.name: car_id})
+        query._raw_delete(router.db_for_write(related.model))
+
+    Car.all_objects.filter(pk=car_id)._raw_delete(router.db_for_write(Car))
+
+
+def remove_trip(trip_id):
+    """
+        Remove the trip, once no record is part of it anymore.
+    """
+    Trip.all_objects.filter(pk=trip_id)._raw_delete(router.db_for_write(Trip))
+
+
+def delete_car(car):
+    """
+        Delete the car along with everything that refers to it in one
+        transaction, without loading its records.
+    """
+    if SOFT_DELETE:
+        return hide_car(car)
+
+    with transaction.commit_on_success():
+        log_changes(Car, CHANGE_DELETE, [(car.pk, car.pk)],
+                    owners={car.pk: car.owner_id})
+        clear_car(car.pk)
+        remove_car(car.pk)
+
+
+def delete_trip(trip):
+    """
+        Take the records out of the trip and delete it in one transaction,
+        without loading the records.
+    """
+    if SOFT_DELETE:
+        return hide_trip(trip)
+
+    with transaction.commit_on_success():
+        clear_trip(trip.pk, trip.car_id)
+        log_changes(Trip, CHANGE_DELETE, [(trip.pk, trip.car_id)])
+        remove_trip(trip.pk)
+        notify_records_changed([trip.car_id])
+
+
+def hide_car(car):
+    """
+        Hide the car right away, its records are removed later on by
+        purge_deleted.
+    """
+    with transaction.commit_on_success():
+        log_changes(Car, CHANGE_DELETE, [(car.pk, car.pk)],
+                    owners={car.pk: car.owner_id})
+        Car.all_objects.filter(pk=car.pk).update(deleted=now())
+        refresh_locations([car.pk])
+        bump_car_versions([car.pk])
+
+
+def hide_trip(trip):
+    """
+        Hide the trip and take its records out of it right away, the record
+        forms only accept visible trips.  The trip itself is removed later on
+        by purge_deleted.
+    """
+    with transaction.commit_on_success():
+        clear_trip(trip.pk, trip.car_id)
+        log_changes(Trip, CHANGE_DELETE, [(trip.pk, trip.car_id)])
+        Trip.all_objects.filter(pk=trip.pk).update(deleted=now())
+        notify_records_changed([trip.car_id])
+
+
+def purge_deleted(batch_size=PURGE_BATCH_SIZE):
+    """
+        Remove the cars and trips that were hidden, a batch of records per
+        transaction so that the tables are never locked for long.  Returns
+        the number of cars and trips purged.
+    """
+    purged = 0
+
+    trips = Trip.all_objects.filter(deleted__isnull=False,
+                                    car__deleted__isnull=True)
+    for trip_id, car_id in list(trips.values_list('pk', 'car')):
+        while True:
+            with transaction.commit_on_success():
+                if not clear_trip(trip_id, car_id, batch_size):
+                    break
+        with transaction.commit_on_success():
+            remove_trip(trip_id)
+            notify_records_changed([car_id])
+        purged += 1
+
+    cars = Car.all_objects.filter(deleted__isnull=False)
+    for car_id in list(cars.values_list('pk', flat=True)):
+        while True:
+            with transaction.commit_on_success():
+                if not clear_car(car_id, batch_size):
+                    break
+        with transaction.commit_on_success():
+            remove_car(car_id)
+        purged += 1
+
+    return purged
@@ -0,0 +1,134 @@
+##
+# Automaintenance.  Django app to track automaintenance records.
+# Copyright (C) 2012 Robert Robinson
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+##
+from django.conf import settings
+from django.db import connections, transaction
+
+from automaintenance.routers import replica_enabled, replica_reads
+from automaintenance.metrics import start_db_timing, db_time, add_db_time
+
+from multiprocessing.pool import ThreadPool
+
+import threading
+
+
+# Whether independent queries, such as the queries of the record types, run
+# at the same time on a pool of threads with their own connections.  Meant
+# for databases on another host, where every query waits for a round trip.
+QUERY_FANOUT = getattr(settings, 'AUTOMAINTENANCE_QUERY_FANOUT', False)
+
+# Number of threads, and so of extra database connections, of the pool of
+# every process.
+QUERY_FANOUT_WORKERS = getattr(settings,
+                               'AUTOMAINTENANCE_QUERY_FANOUT_WORKERS', 4)
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    """
+        Returns the query pool of this process, creating it on first use.
+    """
+    global _pool
+
+    with _pool_lock:
+        if _pool is None:
+            _pool = ThreadPool(QUERY_FANOUT_WORKERS)
+    return _pool
+
+
+def fanout_enabled():
+    """
+        Returns whether the queries of the current thread can run on the
+        pool.  Other connections can't see the uncommitted writes of this
+        thread, nor an in memory SQLite database.
+    """
+    if not QUERY_FANOUT:
+        return False
+
+    for alias in connections:
+        if transaction.is_dirty(using=alias):
+            return False
+        if connections[alias].vendor == 'sqlite' and \
+                connections[alias].settings_dict['NAME'] in ('', ':memory:'):
+            return False
+    return True
+
+
+def finish_task(failed):
+    """
+        End the read transactions the task left open on the connections of
+        the worker thread, which stay open for the next tasks.  The
+        connections of a failed task are closed in case they are broken.
+    """
+    for alias in connections:
+        if failed:
+            connections[alias].close()
+        else:
+            transaction.rollback_unless_managed(using=alias)
+
+
+def run_task(function, args, use_replica):
+    """
+        Run the function on a worker thread, reading from the same database
+        as the thread that submitted it.  Returns the result and the time
+        the queries of the task took, which the submitting thread adds to
+        its own database time.
+    """
+    failed = True
+    start_db_timing()
+    try:
+        if use_replica:
+            with replica_reads():
+                result = function(*args)
+        else:
+            result = function(*args)
+        failed = False
+        return result, db_time()
+    finally:
+        finish_task(failed)
+
+
+def fan_out(tasks):
+    """
+        Run the (function, args) tasks and return their results in order.
+        With the fan out on, the tasks run at the same time on the pool so
+        the time taken is close to the one of the slowest task.  Tasks that
+        fail on the pool are run again on the current thread.  The database
+        time of the tasks is added to the one of the current thread, so it
+        is the time of every query of the request even when they overlap.
+    """
+    tasks = list(tasks)
+    if len(tasks) < 2 or not fanout_enabled():
+        return [function(*args) for function, args in tasks]
+
+    use_replica = replica_enabled()
+    pool = get_pool()
+    pending = [pool.apply_async(run_task, (function, args, use_replica))
+               for function, args in tasks]
+
+    results = []
+    for (function, args), result in zip(tasks, pending):
+        try:
+            value, seconds = result.get()
+        except Exception:
+            results.append(function(*args))
+        else:
+            add_db_time(seconds)
+            results.append(value)
+    return results
@@ -0,0 +1,298 @@
+##
+# Automaintenance.  Django app to track automaintenance records.
+# Copyright (C) 2012 Robert Robinson
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+##
+from django.conf import settings
+
+from automaintenance.models import Car, CarVersion
+from automaintenance.snapshots import CarSnapshot, COLUMNS, build_snapshot
+from automaintenance.metrics import cache_lookups
+
+from array import array
+
+import errno
+import fcntl
+import hashlib
+import json
+import mmap
+import os
+import struct
+import tempfile
+import threading
+
+
+# Directory of the fleet snapshot files.  When it is set the snapshots of the
+# cars are read from a memory mapped file per owner, which every worker
+# process on the host shares through the page cache, instead of the cache.
+FLEET_SNAPSHOT_DIR = getattr(settings, 'AUTOMAINTENANCE_FLEET_SNAPSHOT_DIR',
+                             None)
+
+# Layout of the files.  The header holds the magic, the version of the
+# layout, the data version of the fleet, the number of cars, rows and
+# columns and the length of the category names.  It is followed by the
+# typecode and item size of every column, the (car id, first row, end row)
+# of every car, the category names as json and then the columns, each
+# aligned to 8 bytes.
+FLEET_MAGIC = 'AMFS'
+FLEET_FORMAT = 1
+HEADER = struct.Struct('<4sH40sIQHI')
+COLUMN_ENTRY = struct.Struct('<cB')
+CAR_ENTRY = struct.Struct('<qQQ')
+
+_mapped = {}
+_lock = threading.Lock()
+
+
+def fleet_version(owner_id):
+    """
+        Returns the data version of the cars of the owner, which changes
+        whenever one of the cars or its records change.
+    """
+    versions = dict(CarVersion.objects.filter(
+        car__owner=owner_id).values_list('car', 'version'))
+    cars = Car.objects.filter(owner=owner_id).order_by('pk').values_list(
+        'pk', flat=True)
+    return hashlib.sha1(repr([(car_id, versions.get(car_id, 0))
+                              for car_id in cars])).hexdigest()
+
+
+def aligned(offset):
+    """
+        Returns the offset rounded up to a multiple of 8.
+    """
+    return (offset + 7) & ~7
+
+
+def snapshot_path(owner_id):
+    """
+        Returns the path of the snapshot file of the owner.
+    """
+    return os.path.join(FLEET_SNAPSHOT_DIR, 'fleet-%s.snapshot' % owner_id)
+
+
+def lock_path(owner_id):
+    """
+        Returns the path of the file locked while the snapshot file of the
+        owner is rebuilt.
+    """
+    return os.path.join(FLEET_SNAPSHOT_DIR, 'fleet-%s.lock' % owner_id)
+
+
+def lock_fleet(owner_id, blocking=True):
+    """
+        Lock the rebuild of the snapshot file of the owner across the worker
+        processes.  Returns the open lock file, which releases the lock when
+        closed, or None when another process holds the lock and blocking is
+        false.
+    """
+    lock_file = open(lock_path(owner_id), 'a')
+    try:
+        fcntl.flock(lock_file.fileno(),
+                    fcntl.LOCK_EX if blocking else
+                    fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except IOError as error:
+        lock_file.close()
+        if error.errno in (errno.EAGAIN, errno.EACCES):
+            return None
+        raise
+    return lock_file
+
+
+def build_fleet(owner_id, version):
+    """
+        Returns the contents of the snapshot file of the cars of the owner.
+        The snapshots of the cars are stored one after the other and share
+        one list of category names.
+    """
+    car_ids = Car.objects.filter(owner=owner_id).order_by('pk').values_list(
+        'pk', flat=True)
+
+    categories = {}
+    columns = dict((name, array(typecode)) for name, typecode in COLUMNS)
+    cars = []
+    for car_id in car_ids:
+        snapshot = build_snapshot(car_id)
+        first = len(columns['date'])
+        for name, typecode in COLUMNS:
+            if name == 'category':
+                columns[name].extend(
+                    categories.setdefault(snapshot.categories[category],
+                                          len(categories))
+                    for category in snapshot.category)
+            else:
+                columns[name].extend(getattr(snapshot, name))
+        cars.append((car_id, first, len(columns['date'])))
+
+    names = json.dumps(sorted(categories, key=categories.get))
+
+    parts = [HEADER.pack(FLEET_MAGIC, FLEET_FORMAT, version, len(cars),
+                         len(columns['date']), len(COLUMNS), len(names))]
+    parts.extend(COLUMN_ENTRY.pack(typecode, array(typecode).itemsize)
+                 for name, typecode in COLUMNS)
+    parts.extend(CAR_ENTRY.pack(*car) for car in cars)
+    parts.append(names)
+
+    contents = ''.join(parts)
+    for name, typecode in COLUMNS:
+        contents += '\0' * (aligned(len(contents)) - len(contents))
+        contents += columns[name].tostring()
+    return contents
+
+
+def write_fleet(owner_id, version):
+    """
+        Write the snapshot file of the owner next to the current one and
+        rename it over the current one, so readers only ever map a complete
+        file.
+    """
+    contents = build_fleet(owner_id, version)
+
+    handle, path = tempfile.mkstemp(dir=FLEET_SNAPSHOT_DIR,
+                                    prefix='.fleet-%s-' % owner_id)
+    try:
+        with os.fdopen(handle, 'wb') as temporary:
+            temporary.write(contents)
+            temporary.flush()
+            os.fsync(temporary.fileno())
+        os.rename(path, snapshot_path(owner_id))
+    except Exception:
+        if os.path.exists(path):
+            os.remove(path)
+        raise
+
+
+class FleetSnapshot(object):
+    """
+        Read only memory map of the snapshot file of an owner.  The columns
+        of a car are only copied out of the map when the car is asked for.
+    """
+
+    def __init__(self, path):
+        with open(path, 'rb') as snapshot_file:
+            self.map = mmap.mmap(snapshot_file.fileno(), 0,
+                                 access=mmap.ACCESS_READ)
+
+        magic, layout, self.version, car_count, self.rows, column_count, \
+            names_length = HEADER.unpack_from(self.map, 0)
+        if magic != FLEET_MAGIC or layout != FLEET_FORMAT or \
+                column_count != len(COLUMNS):
+            raise ValueError('Unknown fleet snapshot layout')
+
+        offset = HEADER.size
+        for name, typecode in COLUMNS:
+            stored, itemsize = COLUMN_ENTRY.unpack_from(self.map, offset)
+            if stored != typecode or itemsize != array(typecode).itemsize:
+                raise ValueError('Fleet snapshot written by another platform')
+            offset += COLUMN_ENTRY.size
+
+        self.cars = {}
+        for index in range(car_count):
+            car_id, first, end = CAR_ENTRY.unpack_from(self.map, offset)
+            self.cars[car_id] = (first, end)
+            offset += CAR_ENTRY.size
+
+        self.categories = json.loads(self.map[offset:offset + names_length])
+        offset += names_length
+
+        self.offsets = {}
+        for name, typecode in COLUMNS:
+            offset = aligned(offset)
+            self.offsets[name] = offset
+            offset += array(typecode).itemsize * self.rows
+
+    def car(self, car_id):
+        """
+            Returns the snapshot of the car.
+        """
+        first, end = self.cars.get(car_id, (0, 0))
+        columns = {}
+        for name, typecode in COLUMNS:
+            itemsize = array(typecode).itemsize
+            start = self.offsets[name] + first * itemsize
+            columns[name] = array(typecode,
+                                  self.map[start:start + (end - first) *
+                                           itemsize])
+        return CarSnapshot(self.categories, **columns)
+
+    def close(self):
+        """
+            Unmap the file.
+        """
+        self.map.close()
+
+
+def open_fleet(path):
+    """
+        Returns the mapped snapshot file, None when there is no readable file.
+    """
+    try:
+        return FleetSnapshot(path)
+    except (IOError, ValueError, struct.error, mmap.error):
+        return None
+
+
+def fleet_snapshot(owner_id):
+    """
+        Returns the mapped snapshot of the current data version of the cars
+        of the owner.  The file is only rebuilt when the version it was
+        written for is out of date, and the mapping is kept open by the
+        process until the version changes.  One process rebuilds the file at
+        a time, the others get None meanwhile instead of an out of date
+        snapshot, and read the snapshots of the cars from the cache.
+    """
+    version = fleet_version(owner_id)
+
+    with _lock:
+        previous = _mapped.get(owner_id)
+    if previous is not None and previous.version == version:
+        cache_lookups('fleet', hits=1)
+        return previous
+
+    path = snapshot_path(owner_id)
+    snapshot = open_fleet(path)
+    if snapshot is None or snapshot.version != version:
+        if snapshot is not None:
+            snapshot.close()
+        lock_file = lock_fleet(owner_id, blocking=False)
+        if lock_file is None:
+            cache_lookups('fleet', misses=1)
+            return None
+
+        try:
+            # The file may have been rebuilt before the lock was taken.
+            snapshot = open_fleet(path)
+            if snapshot is None or snapshot.version != version:
+                if snapshot is not None:
+                    snapshot.close()
+                cache_lookups('fleet', misses=1)
+                write_fleet(owner_id, version)
+                snapshot = FleetSnapshot(path)
+            else:
+                cache_lookups('fleet', hits=1)
+        finally:
+            lock_file.close()
+    else:
+        cache_lookups('fleet', hits=1)
+
+    if previous is not None:
+        cache_lookups('fleet', evictions=1)
+
+    # Requests may still be reading the previous mapping, it is closed once
+    # nothing refers to it anymore.
+    with _lock:
+        _mapped[owner_id] = snapshot
+
+    return snapshot
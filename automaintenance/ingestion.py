@@ -0,0 +1,259 @@
+##
+# Automaintenance.  Django app to track automaintenance records.
+# Copyright (C) 2012 Robert Robinson
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+##
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.utils.dateparse import parse_datetime
+from django.utils.encoding import force_text
+from django.utils.timezone import is_aware, localtime
+
+from automaintenance.models import Car, Trip, IngestionKey, CHANGE_CREATE
+from automaintenance.sequences import chunks, matching_rows, assign_sequences
+from automaintenance.signals import notify_records_changed
+from automaintenance.changes import log_changes
+from automaintenance.views.forms import GasolinePurchaseForm, OilChangeForm
+from automaintenance.views.forms import MaintenanceForm, PaymentForm
+
+from collections import defaultdict
+
+
+# Largest number of records accepted in one batch.
+MAX_BATCH_SIZE = getattr(settings, 'AUTOMAINTENANCE_INGESTION_MAX_BATCH', 5000)
+
+INGESTION_CREATED = 'created'
+INGESTION_DUPLICATE = 'duplicate'
+INGESTION_ERROR = 'error'
+
+
+class IngestionConflict(Exception):
+    """
+        Raised when another writer used the same keys, or the same dates of
+        a car, at the same time.
+    """
+    pass
+
+
+class BatchFormMixin(object):
+    """
+        Record forms used for batches leave uniqueness to the sequence
+        numbers that are assigned once for the whole batch.
+    """
+
+    def validate_unique(self):
+        """
+            Sequence numbers are assigned by create_records.
+        """
+        pass
+
+
+class GasolinePurchaseBatchForm(BatchFormMixin, GasolinePurchaseForm):
+    pass
+
+
+class OilChangeBatchForm(BatchFormMixin, OilChangeForm):
+    pass
+
+
+class MaintenanceBatchForm(BatchFormMixin, MaintenanceForm):
+    pass
+
+
+class PaymentBatchForm(BatchFormMixin, PaymentForm):
+    pass
+
+
+# Forms used to validate the records of a batch keyed by the record type.
+BATCH_FORMS = {
+    'gasolinepurchase': GasolinePurchaseBatchForm,
+    'oilchange': OilChangeBatchForm,
+    'maintenance': MaintenanceBatchForm,
+    'payment': PaymentBatchForm,
+}
+
+# Fields of the batch records that are not passed to the forms.
+BATCH_FIELDS = ('key', 'record_type', 'car', 'trip', 'date')
+
+
+def form_data(form_class, item):
+    """
+        Convert a record of the batch into the data of the record form.  The
+        date is an ISO 8601 string that is split for the date widgets, fields
+        that are left out get the defaults of the model.
+    """
+    data = dict((name, value) for name, value in item.items()
+                if name not in BATCH_FIELDS)
+
+    for field in form_class._meta.model._meta.fields:
+        if field.name in form_class.base_fields and \
+                field.name not in BATCH_FIELDS and \
+                field.name not in data and field.has_default():
+            data[field.name] = field.get_default()
+
+    record_date = parse_datetime(item.get('date') or '')
+    if record_date is not None:
+        if is_aware(record_date):
+            record_date = localtime(record_date)
+        data['date_0'] = record_date.date().isoformat()
+        data['date_1'] = record_date.strftime('%H:%M:%S')
+
+    return data
+
+
+def validate_record(item, cars, trips):
+    """
+        Returns the unsaved record of the batch item or a dictionary of
+        errors.
+    """
+    if item.get('record_type') not in BATCH_FORMS:
+        return None, {'record_type': ['Unknown record type']}
+
+    car = cars.get(item.get('car'))
+    if car is None:
+        return None, {'car': ['Unknown car']}
+
+    trip = None
+    if item.get('trip'):
+        trip = trips.get((car.pk, item['trip']))
+        if trip is None:
+            return None, {'trip': ['Unknown trip']}
+
+    form_class = BATCH_FORMS[item['record_type']]
+    form = form_class(form_data(form_class, item))
+    # Trips are resolved for the whole batch, so the form doesn't need to
+    # look them up one at a time.
+    del form.fields['trip']
+
+    if not form.is_valid():
+        return None, dict((name, [force_text(error) for error in errors])
+                          for name, errors in form.errors.items())
+
+    record = form.save(commit=False)
+    record.car = car
+    record.trip = trip
+    return record, None
+
+
+def ingest_records(owner, items):
+    """
+        Validate and insert the records of a batch for the cars of the owner.
+        Returns one result per item.  Items whose key was already used are
+        reported as duplicates of the record that was created for the key.
+    """
+    results = [None] * len(items)
+    items = [item if isinstance(item, dict) else {} for item in items]
+
+    keys = set(item.get('key') for item in items if item.get('key'))
+    existing = {}
+    for chunk in chunks(keys):
+        for ingestion_key in IngestionKey.objects.filter(owner=owner,
+                                                         key__in=chunk):
+            existing[ingestion_key.key] = ingestion_key
+
+    cars = {}
+    for chunk in chunks(set(item.get('car') for item in items)):
+        for car in Car.objects.filter(owner=owner, slug__in=chunk):
+            cars[car.slug] = car
+
+    trips = {}
+    for chunk in chunks(set(item.get('trip') for item in items
+                            if item.get('trip'))):
+        for trip in Trip.objects.filter(car__owner=owner, slug__in=chunk):
+            trips[(trip.car_id, trip.slug)] = trip
+
+    pending = defaultdict(list)
+    batch_keys = set()
+
+    for index, item in enumerate(items):
+        key = item.get('key')
+
+        if not key:
+            results[index] = {'status': INGESTION_ERROR,
+                              'errors': {'key': ['A key is required']}}
+        elif key in existing:
+            results[index] = {'key': key, 'status': INGESTION_DUPLICATE,
+                              'type': existing[key].record_type,
+                              'id': existing[key].record_id}
+        elif key in batch_keys:
+            results[index] = {'key': key, 'status': INGESTION_ERROR,
+                              'errors': {'key': ['Key used twice in batch']}}
+        else:
+            batch_keys.add(key)
+            record, errors = validate_record(item, cars, trips)
+            if errors:
+                results[index] = {'key': key, 'status': INGESTION_ERROR,
+                                  'errors': errors}
+            else:
+                pending[item['record_type']].append((index, key, record))
+
+    try:
+        with transaction.commit_on_success():
+            create_records(owner, pending, results)
+    except IntegrityError:
+        raise IngestionConflict()
+
+    return results
+
+
+def create_records(owner, pending, results):
+    """
+        Insert the validated records with one bulk insert per record type and
+        store their keys.
+    """
+    ingestion_keys = []
+    car_ids = set()
+
+    for type_name, records in pending.items():
+        if not records:
+            continue
+
+        model = records[0][2].__class__
+        new_records = [record for index, key, record in records]
+        assign_sequences(model, new_records)
+        model.objects.bulk_create(new_records)
+
+        # Bulk inserts don't return the primary keys, find them by the car,
+        # date and sequence of the records.
+        created = {}
+        for car_id, record_date, sequence, pk in matching_rows(
+                model, [(record.car_id, record.date)
+                        for record in new_records], 'sequence', 'pk'):
+            created[(car_id, record_date, sequence)] = pk
+
+        rows = []
+        for index, key, record in records:
+            record_id = created.get((record.car_id, record.date,
+                                     record.sequence))
+            # The dates of the batch are whole seconds, which every backend
+            # stores as they are.  A record that can't be found again was
+            # changed by another writer, storing its key without the record
+            # would report it as missing to every retry.
+            if record_id is None:
+                raise IngestionConflict()
+            car_ids.add(record.car_id)
+            rows.append((record_id, record.car_id))
+            ingestion_keys.append(IngestionKey(owner=owner, key=key,
+                                               record_type=type_name,
+                                               record_id=record_id))
+            results[index] = {'key': key, 'status': INGESTION_CREATED,
+                              'type': type_name, 'id': record_id}
+
+        log_changes(model, CHANGE_CREATE, rows,
+                    owners=dict((car_id, owner.pk) for record_id, car_id
+                                in rows))
+
+    IngestionKey.objects.bulk_create(ingestion_keys)
+    notify_records_changed(car_ids)
@@ -0,0 +1,202 @@
+##
+# Automaintenance.  Django app to track automaintenance records.
+# Copyright (C) 2012 Robert Robinson
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+##
+from django.conf import settings
+from django.db import connection, connections, router, IntegrityError
+from django.db import transaction
+from django.utils.importlib import import_module
+from django.utils.timezone import now
+
+from automaintenance.models import ReportJob, REPORT_JOB_PENDING
+from automaintenance.models import REPORT_JOB_RUNNING, REPORT_JOB_DONE
+from automaintenance.models import REPORT_JOB_FAILED
+from automaintenance.routers import replica_reads
+from automaintenance.versions import car_data_version
+
+from datetime import timedelta
+from multiprocessing.pool import Pool, ThreadPool
+
+import hashlib
+import json
+import threading
+import traceback
+
+
+# Pool used to run the report jobs, either 'thread', 'process' or the dotted
+# path to a callable that takes the number of workers and returns an object
+# with an apply_async(func, args) method.
+REPORT_JOB_POOL = getattr(settings, 'AUTOMAINTENANCE_REPORT_JOB_POOL',
+                          'thread')
+
+REPORT_JOB_WORKERS = getattr(settings, 'AUTOMAINTENANCE_REPORT_JOB_WORKERS', 2)
+
+# Number of seconds after which a job that is still pending or running is
+# taken to be lost, with the process that ran it for example, and is queued
+# again by the next request for it.
+REPORT_JOB_TIMEOUT = getattr(settings, 'AUTOMAINTENANCE_REPORT_JOB_TIMEOUT',
+                             10 * 60)
+
+POOLS = {
+    'thread': ThreadPool,
+    'process': Pool,
+}
+
+_pool = None
+_deferred = threading.local()
+
+
+def get_pool():
+    """
+        Returns the worker pool of this process, creating it on first use.
+        The connections are closed before a process pool forks, so that the
+        workers don't share the sockets of this process.
+    """
+    global _pool
+
+    if _pool is None:
+        if REPORT_JOB_POOL in POOLS:
+            pool_class = POOLS[REPORT_JOB_POOL]
+        else:
+            module_name, class_name = REPORT_JOB_POOL.rsplit('.', 1)
+            pool_class = getattr(import_module(module_name), class_name)
+        if pool_class is Pool:
+            for alias in connections:
+                connections[alias].close()
+        _pool = pool_class(REPORT_JOB_WORKERS)
+
+    return _pool
+
+
+def job_key(report, car, start_date, end_date):
+    """
+        Returns the key that identifies identical report requests.  The data
+        version of the car is part of it, so a job never returns a report of
+        records that changed since.
+    """
+    key = '%s:%s:%s:%s:%s' % (report, car.pk, car_data_version(car.pk),
+                              start_date.isoformat(), end_date.isoformat())
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+
+def queue_job(job_id):
+    """
+        Queue the job on the pool.  The workers can't see a job created in a
+        transaction that is still open, such as the one of the transaction
+        middleware, so it is queued once the request is finished.
+    """
+    if transaction.is_managed(using=router.db_for_write(ReportJob)):
+        if not hasattr(_deferred, 'jobs'):
+            _deferred.jobs = []
+        _deferred.jobs.append(job_id)
+    else:
+        get_pool().apply_async(run_report_job, (job_id,))
+
+
+def queue_deferred_jobs():
+    """
+        Queue the jobs that waited for the transaction of the request.
+    """
+    job_ids = getattr(_deferred, 'jobs', [])
+    _deferred.jobs = []
+    for job_id in job_ids:
+        get_pool().apply_async(run_report_job, (job_id,))
+
+
+def submit_report_job(report, car, start_date, end_date):
+    """
+        Returns the job computing the report, queueing a new job only if
+        there isn't already one for the same report, car and date range.
+    """
+    key = job_key(report, car, start_date, end_date)
+    using = router.db_for_write(ReportJob)
+
+    sid = transaction.savepoint(using=using)
+    try:
+        job = ReportJob.objects.create(key=key, car=car, report=report,
+                                       start_date=start_date,
+                                       end_date=end_date)
+    except IntegrityError:
+        transaction.savepoint_rollback(sid, using=using)
+        transaction.rollback_unless_managed(using=using)
+
+        # The job may be too new to have reached the replica.
+        job = ReportJob.objects.using(using).get(key=key)
+
+        # Failed jobs, and jobs that were lost before they finished, are
+        # queued again by the first request that claims them.
+        lost = now() - timedelta(seconds=REPORT_JOB_TIMEOUT)
+        if job.status == REPORT_JOB_FAILED:
+            claim = ReportJob.objects.filter(pk=job.pk,
+                                             status=REPORT_JOB_FAILED)
+        elif not job.is_finished() and job.created < lost:
+            claim = ReportJob.objects.filter(pk=job.pk, status=job.status,
+                                             created=job.created)
+        else:
+            return job
+        if not claim.update(status=REPORT_JOB_PENDING, error='',
+                            finished=None, created=now()):
+            return job
+        job.status = REPORT_JOB_PENDING
+    else:
+        transaction.savepoint_commit(sid, using=using)
+
+    queue_job(job.pk)
+
+    return job
+
+
+def run_report_job(job_id):
+    """
+        Compute the report of the job and store the result.  Runs in the
+        worker pool.
+    """
+    from automaintenance.views.report import REPORTS
+
+    try:
+        try:
+            job = ReportJob.objects.select_related('car').get(pk=job_id)
+        except ReportJob.DoesNotExist:
+            # The job was expired, or the transaction that created it was
+            # rolled back.
+            return
+        ReportJob.objects.filter(pk=job_id).update(status=REPORT_JOB_RUNNING)
+
+        try:
+            report = REPORTS[job.report]()
+            report.car = job.car
+            report.start_date = job.start_date
+            report.end_date = job.end_date
+
+            with replica_reads():
+                result = json.dumps(report.get_report_data())
+        except Exception:
+            ReportJob.objects.filter(pk=job_id).update(
+                status=REPORT_JOB_FAILED, error=traceback.format_exc(),
+                finished=now())
+        else:
+            ReportJob.objects.filter(pk=job_id).update(
+                status=REPORT_JOB_DONE, result=result, finished=now())
+    finally:
+        connection.close()
+
+
+def expire_report_jobs(car_ids):
+    """
+        Remove the jobs of the cars provided.  Their keys hold the previous
+        data version of the cars, so no request asks for them anymore.
+    """
+    ReportJob.objects.filter(car__in=list(car_ids)).delete()
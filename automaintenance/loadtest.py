@@ -0,0 +1,386 @@
+##
+# Automaintenance.  Django app to track automaintenance records.
+# Copyright (C) 2012 Robert Robinson
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+##
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.urlresolvers import reverse
+from django.db import connections, transaction
+from django.test.client import Client
+from django.utils.timezone import now
+
+from automaintenance.models import Car, Trip, GasolinePurchase, OilChange
+from automaintenance.models import Maintenance, Payment
+from automaintenance.signals import notify_records_changed
+from automaintenance.deletion import delete_car
+
+from bisect import bisect
+from collections import defaultdict
+from datetime import timedelta
+from multiprocessing import Pool
+
+import cookielib
+import math
+import random
+import threading
+import time
+import urllib
+import urllib2
+import uuid
+
+
+# User that owns the cars seeded for the load test.
+LOAD_TEST_USERNAME = 'automaintenance-load-test'
+
+# Reports that are requested, each is its own route so their latencies are
+# reported apart.
+REPORTS = ('auto_maintenance_distance_per_unit',
+           'auto_maintenance_cost_per_distance',
+           'auto_maintenance_price_per_gallon',
+           'auto_maintenance_category_expense',
+           'auto_maintenance_distance_per_time',
+           'auto_maintenance_location_report',
+           'auto_maintenance_report_totals')
+
+LOCATIONS = ('Shell', 'Exxon', 'Costco', 'Dealer', 'Corner Garage')
+
+
+def seed_load_test(cars, records, trips):
+    """
+        Create the user, cars, trips and records that the load test works
+        on, replacing the ones of a previous run.  Returns the dataset the
+        routes pick their urls from.
+    """
+    remove_load_test()
+
+    password = uuid.uuid4().hex
+    user = User.objects.create_user(LOAD_TEST_USERNAME, '', password)
+    started = now()
+    dataset = {'username': LOAD_TEST_USERNAME, 'password': password,
+               'cars': []}
+
+    for index in range(cars):
+        car = Car.objects.create(owner=user, slug='load-test-%d' % index,
+                                 name='Load Test %d' % index)
+        trip_list = [Trip.objects.create(
+            car=car, slug='load-test-trip-%d' % number,
+            name='Load Test Trip %d' % number,
+            start=started - timedelta(days=(number + 1) * 30),
+            end=started - timedelta(days=number * 30 + 20))
+            for number in range(trips)]
+
+        with transaction.commit_on_success():
+            batches = defaultdict(list)
+            for number in range(records):
+                date = started - timedelta(hours=number * 12 + 1)
+                values = {'car': car, 'date': date,
+                          'location': LOCATIONS[number % len(LOCATIONS)],
+                          'total_cost': '%d.00' % (20 + number % 50)}
+                if trip_list and number % 5 == 0:
+                    values['trip'] = trip_list[number % len(trip_list)]
+                kind = number % 10
+                if kind < 6:
+                    batches[GasolinePurchase].append(GasolinePurchase(
+                        mileage=100000 - number * 50, tank_mileage='300.000',
+                        fuel_amount='10.000', price_per_unit='3.000',
+                        **values))
+                elif kind < 8:
+                    batches[Payment].append(Payment(type='parking',
+                                                    **values))
+                elif kind < 9:
+                    batches[OilChange].append(OilChange(
+                        mileage=100000 - number * 50, **values))
+                else:
+                    batches[Maintenance].append(Maintenance(
+                        mileage=100000 - number * 50, type='Tires', **values))
+
+            for model, batch in batches.items():
+                model.objects.bulk_create(batch, batch_size=500)
+            notify_records_changed([car.pk])
+
+        dataset['cars'].append({
+            'slug': car.slug,
+            'trips': [trip.slug for trip in trip_list],
+            'records': list(GasolinePurchase.objects.filter(
+                car=car).values_list('pk', flat=True)[:200]),
+        })
+
+    return dataset
+
+
+def remove_load_test():
+    """
+        Remove the user of the load test along with its cars.
+    """
+    for user in User.objects.filter(username=LOAD_TEST_USERNAME):
+        for car in Car.all_objects.filter(owner=user):
+            delete_car(car)
+        user.delete()
+
+
+class Route(object):
+    """
+        Kind of request of the workload, picked with a probability
+        proportional to its weight.  Path returns the method, the path and
+        the data of a request for a car of the dataset.
+    """
+
+    def __init__(self, name, weight, path):
+        self.name = name
+        self.weight = weight
+        self.path = path
+
+
+def record_form(car, rng):
+    """
+        Returns the data of a new gasoline purchase at a random time, so
+        that concurrent creates don't collide.
+    """
+    date = now() - timedelta(seconds=rng.randint(0, 10 ** 8))
+    return {'date_0': date.strftime('%Y-%m-%d'),
+            'date_1': date.strftime('%H:%M:%S'),
+            'location': rng.choice(LOCATIONS), 'mileage': '1000',
+            'total_cost': '30.00', 'tank_mileage': '300.000',
+            'price_per_unit': '3.000', 'fuel_amount': '10.000'}
+
+
+def report_route(name, weight):
+    """
+        Returns the route of the report with the url name.
+    """
+    return Route(name, weight,
+                 lambda car, rng: ('GET', reverse(name, args=[car['slug']]),
+                                   None))
+
+
+ROUTES = (
+    Route('auto_maintenance_car_list', 10,
+          lambda car, rng: ('GET', reverse('auto_maintenance_car_list'),
+                            None)),
+    Route('auto_maintenance_car_detail', 25,
+          lambda car, rng: ('GET', reverse('auto_maintenance_car_detail',
+                                           args=[car['slug']]), None)),
+    Route('auto_maintenance_trip_view', 15,
+          lambda car, rng: ('GET', reverse('auto_maintenance_trip_view',
+                                           args=[car['slug'],
+                                                 rng.choice(car['trips'])]),
+                            None)),
+    Route('auto_gasolinepurchase_view_record', 15,
+          lambda car, rng: ('GET', reverse(
+              'auto_gasolinepurchase_view_record',
+              args=[car['slug'], rng.choice(car['records'])]), None)),
+) + tuple(report_route(name, 25.0 / len(REPORTS)) for name in REPORTS) + (
+    Route('auto_maintenance_create_gas_maintenance', 10,
+          lambda car, rng: ('POST', reverse(
+              'auto_maintenance_create_gas_maintenance',
+              args=[car['slug']]), record_form(car, rng))),
+)
+
+
+class TestClientSession(object):
+    """
+        Sends the requests through the test client, in this process.
+    """
+
+    def __init__(self, dataset):
+        self.client = Client()
+        if not self.client.login(username=dataset['username'],
+                                 password=dataset['password']):
+            raise ValueError('The load test user could not log in')
+
+    def request(self, method, path, data):
+        if method == 'POST':
+            response = self.client.post(path, data)
+        else:
+            response = self.client.get(path)
+        return response.status_code
+
+
+class HttpSession(object):
+    """
+        Sends the requests to a running server, logged in through the login
+        page of the site.
+    """
+
+    def __init__(self, dataset, url):
+        self.url = url.rstrip('/')
+        self.cookies = cookielib.CookieJar()
+        self.opener = urllib2.build_opener(
+            urllib2.HTTPCookieProcessor(self.cookies))
+
+        status = self.request('POST', settings.LOGIN_URL, {
+            'username': dataset['username'],
+            'password': dataset['password'],
+            'next': reverse('auto_maintenance_car_list')})
+        if status >= 400:
+            raise ValueError('The load test user could not log in')
+
+    def csrf_token(self, path):
+        """
+            Returns the csrf token of the session, fetching the page first
+            to get one.
+        """
+        for cookie in self.cookies:
+            if cookie.name == settings.CSRF_COOKIE_NAME:
+                return cookie.value
+        self.request('GET', path, None)
+        for cookie in self.cookies:
+            if cookie.name == settings.CSRF_COOKIE_NAME:
+                return cookie.value
+        return ''
+
+    def request(self, method, path, data):
+        url = self.url + path
+        body = None
+        if method == 'POST':
+            data = dict(data, csrfmiddlewaretoken=self.csrf_token(path))
+            body = urllib.urlencode(data)
+        request = urllib2.Request(url, body, {'Referer': url})
+        try:
+            response = self.opener.open(request)
+            response.read()
+            return response.getcode()
+        except urllib2.HTTPError as error:
+            error.read()
+            return error.code
+
+
+def run_worker(session, dataset, requests, duration, seed, results):
+    """
+        Send the requests of one simulated user, adding the latency of every
+        request to the results keyed by route.
+    """
+    rng = random.Random(seed)
+    totals = []
+    for route in ROUTES:
+        totals.append((totals[-1] if totals else 0) + route.weight)
+
+    deadline = time.time() + duration if duration else None
+    sent = 0
+    while (deadline is None and sent < requests) or \
+            (deadline is not None and time.time() < deadline):
+        route = ROUTES[bisect(totals, rng.random() * totals[-1])]
+        method, path, data = route.path(rng.choice(dataset['cars']), rng)
+
+        started = time.time()
+        try:
+            status = session.request(method, path, data)
+        except Exception:
+            status = 500
+        results[route.name].append((time.time() - started, status))
+        sent += 1
+
+
+def run_process(dataset, url, threads, requests, duration, seed):
+    """
+        Run the simulated users of one process on threads.  Returns the
+        latency and status of every request keyed by route.
+    """
+    results = defaultdict(list)
+
+    def worker(index):
+        try:
+            if url:
+                session = HttpSession(dataset, url)
+            else:
+                session = TestClientSession(dataset)
+            run_worker(session, dataset, requests, duration, seed + index,
+                       results)
+        finally:
+            for connection in connections.all():
+                connection.close()
+
+    workers = [threading.Thread(target=worker, args=(index,))
+               for index in range(threads)]
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+
+    return dict(results)
+
+
+def _run_process(args):
+    """
+        Pool entry point of run_process.
+    """
+    return run_process(*args)
+
+
+def run_load_test(dataset, url=None, processes=1, threads=10, requests=100,
+                  duration=None, seed=0):
+    """
+        Drive the workload against the url, or the test client without one,
+        from threads in one or more processes.  Every thread sends requests
+        requests, or sends requests for duration seconds.  Returns the
+        results keyed by route and the time it took.
+    """
+    started = time.time()
+    jobs = [(dataset, url, threads, requests, duration,
+             seed + index * threads) for index in range(processes)]
+
+    if processes > 1:
+        # The processes can't share the connections of this one.
+        for connection in connections.all():
+            connection.close()
+        pool = Pool(processes)
+        try:
+            outputs = pool.map(_run_process, jobs)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        outputs = [run_process(*jobs[0])]
+
+    results = defaultdict(list)
+    for output in outputs:
+        for name, samples in output.items():
+            results[name].extend(samples)
+
+    return dict(results), time.time() - started
+
+
+def latency_percentile(latencies, fraction):
+    """
+        Returns the nearest rank percentile of the sorted latencies.
+    """
+    rank = int(math.ceil(fraction * len(latencies)))
+    return latencies[max(rank, 1) - 1]
+
+
+def summarize(results, elapsed):
+    """
+        Returns a row per route and a total row with the number of requests,
+        errors, requests per second and the 50th, 95th and 99th percentile
+        latencies in milliseconds.
+    """
+    def summary(name, samples):
+        latencies = sorted(latency for latency, status in samples)
+        return {'route': name, 'requests': len(samples),
+                'errors': len([status for latency, status in samples
+                               if status >= 400]),
+                'throughput': len(samples) / elapsed if elapsed else 0.0,
+                'p50': latency_percentile(latencies, 0.5) * 1000,
+                'p95': latency_percentile(latencies, 0.95) * 1000,
+                'p99': latency_percentile(latencies, 0.99) * 1000}
+
+    rows = [summary(name, samples)
+            for name, samples in sorted(results.items()) if samples]
+    everything = [sample for samples in results.values()
+                  for sample in samples]
+    if everything:
+        rows.append(summary('total', everything))
+    return rows
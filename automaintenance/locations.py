@@ -0,0 +1,344 @@
+##
+# Automaintenance.  Django app to track automaintenance records.
+# Copyright (C) 2012 Robert Robinson
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+##
+from django.db import connections, router, transaction, IntegrityError
+from django.db.models import Count, F, Max, Q, Sum
+
+from automaintenance.models import Car, Location, CarLocation, RECORD_MODELS
+from automaintenance.models import GasolinePurchase
+from automaintenance.sequences import chunks
+from automaintenance.archive import archived_records
+
+from collections import defaultdict
+from decimal import Decimal
+
+
+# Name used in the reports for records without a location.
+UNKNOWN_LOCATION = 'Unknown'
+
+
+def normalize_location(name):
+    """
+        Returns the name used to match the variants of a location.
+    """
+    return u' '.join(name.split()).lower()
+
+
+def location_usage(car_ids):
+    """
+        Count the records of the cars by car and normalized location with one
+        grouped query per record type, archived records included.  Returns
+        the uses, the last time the location was used and the uses of every
+        spelling of the name.
+    """
+    usage = {}
+    archived = archived_records(car_ids)
+
+    for model in RECORD_MODELS:
+        rows = list(model.objects.filter(car__in=car_ids).exclude(
+            location='').order_by().values('car', 'location').annotate(
+            uses=Count('pk'), last_used=Max('date')))
+        rows.extend({'car': record['car'], 'location': record['location'],
+                     'uses': 1, 'last_used': record['date']}
+                    for record in archived[model] if record['location'])
+
+        for row in rows:
+            key = (row['car'], normalize_location(row['location']))
+            if not key[1]:
+                continue
+
+            entry = usage.setdefault(key, {'uses': 0, 'last_used': None,
+                                           'names': defaultdict(int)})
+            entry['uses'] += row['uses']
+            entry['names'][row['location'].strip()] += row['uses']
+            if entry['last_used'] is None or \
+                    row['last_used'] > entry['last_used']:
+                entry['last_used'] = row['last_used']
+
+    return usage
+
+
+def dictionary_entries(owner_names):
+    """
+        Returns the dictionary entries keyed by (owner_id, normalized name)
+        for the names provided, creating the ones that don't exist yet.
+        Owner names maps (owner_id, normalized name) to the name to use for
+        a new entry.
+    """
+    entries = {}
+    by_owner = defaultdict(list)
+    for owner_id, normalized in owner_names:
+        by_owner[owner_id].append(normalized)
+
+    def load():
+        for owner_id, names in by_owner.items():
+            for chunk in chunks(names):
+                for location in Location.objects.filter(owner=owner_id,
+                                                        normalized__in=chunk):
+                    entries[(owner_id, location.normalized)] = location
+
+    using = router.db_for_write(Location)
+    for attempt in range(3):
+        load()
+        missing = [Location(owner_id=owner_id, normalized=normalized,
+                            name=owner_names[(owner_id, normalized)])
+                   for owner_id, normalized in owner_names
+                   if (owner_id, normalized) not in entries]
+        if not missing:
+            break
+
+        sid = transaction.savepoint(using=using)
+        try:
+            Location.objects.bulk_create(missing)
+        except IntegrityError:
+            # Another save added some of the names at the same time, use
+            # the entries it created.
+            transaction.savepoint_rollback(sid, using=using)
+            if attempt == 2:
+                raise
+        else:
+            transaction.savepoint_commit(sid, using=using)
+            # Bulk inserts don't return the primary keys.
+            load()
+            break
+
+    return entries
+
+
+def refresh_locations(car_ids):
+    """
+        Recount the locations of the records of the cars provided, adding the
+        new locations to the dictionaries of their owners.  Only the records
+        of the cars are counted, the totals of the dictionary entries are
+        summed from the counts of every car.
+    """
+    car_ids = list(car_ids)
+    owners = dict(Car.objects.filter(pk__in=car_ids).values_list('pk',
+                                                                 'owner'))
+    usage = location_usage(owners.keys())
+
+    owner_names = {}
+    for (car_id, normalized), entry in usage.items():
+        name = max(entry['names'].items(), key=lambda item: item[1])[0]
+        owner_names.setdefault((owners[car_id], normalized), name[:100])
+    entries = dictionary_entries(owner_names)
+
+    touched = set(CarLocation.objects.filter(car__in=car_ids).values_list(
+        'location', flat=True))
+    CarLocation.objects.filter(car__in=car_ids).delete()
+
+    car_locations = []
+    for (car_id, normalized), entry in usage.items():
+        location = entries[(owners[car_id], normalized)]
+        touched.add(location.pk)
+        car_locations.append(CarLocation(car_id=car_id, location=location,
+                                         uses=entry['uses'],
+                                         last_used=entry['last_used']))
+    CarLocation.objects.bulk_create(car_locations)
+
+    update_location_totals(touched)
+
+
+def forget_locations(car_ids):
+    """
+        Drop the counts of the cars from the totals of the dictionary
+        entries, for cars deleted along with their records.
+    """
+    car_locations = CarLocation.objects.filter(car__in=list(car_ids))
+    touched = set(car_locations.values_list('location', flat=True))
+    car_locations.delete()
+    update_location_totals(touched)
+
+
+def update_location_totals(location_ids):
+    """
+        Sum the counts of the cars into the dictionary entries provided with
+        one UPDATE per chunk, and remove the entries that no car uses.
+    """
+    using = router.db_for_write(Location)
+    qn = connections[using].ops.quote_name
+    location_table = qn(Location._meta.db_table)
+    car_table = qn(CarLocation._meta.db_table)
+    correlated = 'FROM %s WHERE %s.%s = %s.%s' % (
+        car_table, car_table, qn('location_id'), location_table, qn('id'))
+
+    cursor = connections[using].cursor()
+    for chunk in chunks(list(location_ids)):
+        cursor.execute(
+            'UPDATE %s SET %s = (SELECT COALESCE(SUM(%s), 0) %s), '
+            '%s = (SELECT MAX(%s) %s) WHERE %s IN (%s)' % (
+                location_table, qn('uses'), qn('uses'), correlated,
+                qn('last_used'), qn('last_used'), correlated, qn('id'),
+                ', '.join(['%s'] * len(chunk))), chunk)
+        Location.objects.filter(pk__in=chunk, uses=0).delete()
+    transaction.commit_unless_managed(using=using)
+
+
+def change_use(owner_id, car_id, name, amount, record_date=None):
+    """
+        Add amount to the uses of the location by the car, a negative amount
+        takes uses away and removes the rows left without uses.  The last
+        used date moves forward to the date of the record provided.
+    """
+    normalized = normalize_location(name)
+    if not normalized:
+        return
+
+    if amount > 0:
+        location = dictionary_entries({
+            (owner_id, normalized): u' '.join(name.split())[:100]})[
+            (owner_id, normalized)]
+    else:
+        found = list(Location.objects.filter(owner=owner_id,
+                                             normalized=normalized)[:1])
+        if not found:
+            return
+        location = found[0]
+
+    car_locations = CarLocation.objects.filter(car=car_id, location=location)
+    locations = Location.objects.filter(pk=location.pk)
+
+    if amount < 0:
+        car_locations.filter(uses__gte=-amount).update(
+            uses=F('uses') + amount)
+        car_locations.filter(uses=0).delete()
+        locations.filter(uses__gte=-amount).update(uses=F('uses') + amount)
+        locations.filter(uses=0).delete()
+        return
+
+    if amount > 0:
+        if not car_locations.update(uses=F('uses') + amount):
+            using = router.db_for_write(CarLocation)
+            sid = transaction.savepoint(using=using)
+            try:
+                CarLocation.objects.create(car_id=car_id, location=location,
+                                           uses=amount, last_used=record_date)
+            except IntegrityError:
+                # Another save of the car counted the location first.
+                transaction.savepoint_rollback(sid, using=using)
+                car_locations.update(uses=F('uses') + amount)
+            else:
+                transaction.savepoint_commit(sid, using=using)
+        locations.update(uses=F('uses') + amount)
+
+    later = Q(last_used__lt=record_date) | Q(last_used__isnull=True)
+    car_locations.filter(later).update(last_used=record_date)
+    locations.filter(later).update(last_used=record_date)
+
+
+def count_location(record, deleted=False):
+    """
+        Apply the change of a single record to the location counts of its
+        car instead of recounting every record of the car.  The use of its
+        previous location is taken away and the use of its location added.
+        Taking a use away leaves the last used date as it was until the next
+        recount of the car.
+    """
+    previous = getattr(record, '_previous', None)
+    if deleted:
+        removed, added = record.location, ''
+    else:
+        removed, added = previous['location'] if previous else '', \
+            record.location
+
+    try:
+        owner_id = record.car.owner_id
+    except Car.DoesNotExist:
+        # The record goes with its car, whose counts are already dropped.
+        return
+
+    if normalize_location(removed) == normalize_location(added):
+        # The record stays at its location, only its date may be later.
+        if previous is not None and record.date > previous['date']:
+            change_use(owner_id, record.car_id, added, 0, record.date)
+        return
+
+    change_use(owner_id, record.car_id, removed, -1)
+    change_use(owner_id, record.car_id, added, 1, record.date)
+
+
+def complete_location(owner, prefix, limit=10):
+    """
+        Returns the most used locations of the owner that start with the
+        prefix.  The prefix is looked up as a range of the normalized names
+        so that the lookup uses the owner and name index.
+    """
+    prefix = normalize_location(prefix)
+    locations = Location.objects.filter(owner=owner)
+    if prefix:
+        locations = locations.filter(normalized__gte=prefix,
+                                     normalized__lt=prefix + u'\uffff')
+    return locations.order_by('-uses', 'normalized')[:limit]
+
+
+def location_totals(car, start_date=None, end_date=None):
+    """
+        Total the spend and the fuel bought of the records of the car by
+        location.  The records are grouped by their location text in the
+        database and the groups are merged on the dictionary entry of the
+        location, so the spellings of a location are reported together.
+    """
+    groups = {}
+
+    def group(location):
+        normalized = normalize_location(location)
+        if normalized not in groups:
+            groups[normalized] = {'location': location.strip() or
+                                  UNKNOWN_LOCATION,
+                                  'location_id': None, 'records': 0,
+                                  'spend': Decimal(0),
+                                  'fuel_amount': Decimal(0),
+                                  'fuel_spend': Decimal(0)}
+        return groups[normalized]
+
+    archived = archived_records([car.pk], start_date, end_date)
+
+    for model in RECORD_MODELS:
+        aggregates = {'records': Count('pk'), 'spend': Sum('total_cost')}
+        if model is GasolinePurchase:
+            aggregates['fuel_amount'] = Sum('fuel_amount')
+
+        rows = list(car.maintenance_query(model, start_date, end_date
+                                          ).order_by().values(
+            'location').annotate(**aggregates))
+        rows.extend({'location': record['location'], 'records': 1,
+                     'spend': record['total_cost'],
+                     'fuel_amount': record.get('fuel_amount')}
+                    for record in archived[model])
+
+        for row in rows:
+            totals = group(row['location'])
+            totals['records'] += row['records']
+            totals['spend'] += row['spend'] or 0
+            if model is GasolinePurchase:
+                totals['fuel_amount'] += row['fuel_amount'] or 0
+                totals['fuel_spend'] += row['spend'] or 0
+
+    names = [normalized for normalized in groups if normalized]
+    for chunk in chunks(names):
+        for location in Location.objects.filter(owner=car.owner_id,
+                                                normalized__in=chunk):
+            groups[location.normalized]['location'] = location.name
+            groups[location.normalized]['location_id'] = location.pk
+
+    results = sorted(groups.values(), key=lambda totals: -totals['spend'])
+    for totals in results:
+        totals['price_per_unit'] = None
+        if totals['fuel_amount']:
+            totals['price_per_unit'] = \
+                totals['fuel_spend'] / totals['fuel_amount']
+    return results
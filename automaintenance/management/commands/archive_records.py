@@ -0,0 +1,42 @@
+##
+# Automaintenance.  Django app to track automaintenance records.
+# Copyright (C) 2012 Robert Robinson
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+##
+from django.core.management.base import BaseCommand
+
+from automaintenance.archive import archive_records, ARCHIVE_AFTER_DAYS
+
+from optparse import make_option
+
+
+class Command(BaseCommand):
+    """
+        Move the records of the years that ended long ago into the archives,
+        meant to be run periodically.
+    """
+    help = 'Archive the records of the years that ended long ago.'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--after-days', action='store', dest='after_days',
+                    type='int', default=ARCHIVE_AFTER_DAYS,
+                    help='Number of days after the end of a year that its '
+                         'records are archived.'),
+    )
+
+    def handle(self, *args, **options):
+        archived = archive_records(options['after_days'])
+
+        self.stdout.write('Archived %d records' % archived)
@@ -0,0 +1,42 @@
+##
+# Automaintenance.  Django app to track automaintenance records.
+# Copyright (C) 2012 Robert Robinson
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+##
+from django.core.management.base import BaseCommand
+
+from automaintenance.changes import compact_changes, CHANGE_RETENTION_DAYS
+
+from optparse import make_option
+
+
+class Command(BaseCommand):
+    """
+        Keep the change feed bounded, meant to be run periodically.
+    """
+    help = 'Remove the superseded and expired changes of the change feed.'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--retention-days', action='store',
+                    dest='retention_days', type='int',
+                    default=CHANGE_RETENTION_DAYS,
+                    help='Number of days the changes of deleted objects '
+                         'are kept.'),
+    )
+
+    def handle(self, *args, **options):
+        removed = compact_changes(options['retention_days'])
+
+        self.stdout.write('Removed %d changes' % removed)
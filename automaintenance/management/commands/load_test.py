@@ -0,0 +1,88 @@
+##
+# Automaintenance.  Django app to track automaintenance records.
+# Copyright (C) 2012 Robert Robinson
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+##
+from django.core.management.base import BaseCommand
+from django.test.utils import setup_test_environment
+
+from automaintenance.loadtest import seed_load_test, remove_load_test
+from automaintenance.loadtest import run_load_test, summarize
+
+from optparse import make_option
+
+
+class Command(BaseCommand):
+    """
+        Seed a dataset and drive a mix of the pages of the app from many
+        simulated users, reporting the latency of every route.  Meant for
+        development and staging databases, the dataset is written to the
+        configured database.
+    """
+    help = 'Run a load test and report the latency percentiles per route.'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--url', action='store', dest='url', default=None,
+                    help='Address of a running server, the requests go '
+                         'through the test client without one.'),
+        make_option('--processes', action='store', dest='processes',
+                    type='int', default=1,
+                    help='Number of processes sending requests.'),
+        make_option('--threads', action='store', dest='threads', type='int',
+                    default=10,
+                    help='Number of simulated users per process.'),
+        make_option('--requests', action='store', dest='requests',
+                    type='int', default=100,
+                    help='Number of requests sent by every user.'),
+        make_option('--duration', action='store', dest='duration',
+                    type='float', default=None,
+                    help='Number of seconds to send requests for, instead '
+                         'of a number of requests.'),
+        make_option('--cars', action='store', dest='cars', type='int',
+                    default=3, help='Number of cars seeded.'),
+        make_option('--records', action='store', dest='records', type='int',
+                    default=2000, help='Number of records seeded per car.'),
+        make_option('--trips', action='store', dest='trips', type='int',
+                    default=10, help='Number of trips seeded per car.'),
+        make_option('--seed', action='store', dest='seed', type='int',
+                    default=0, help='Seed of the random workload.'),
+        make_option('--keep', action='store_true', dest='keep',
+                    default=False,
+                    help='Keep the seeded dataset after the test.'),
+    )
+
+    def handle(self, *args, **options):
+        if not options['url']:
+            # Lets the test client through ALLOWED_HOSTS.
+            setup_test_environment()
+
+        dataset = seed_load_test(options['cars'], options['records'],
+                                 max(options['trips'], 1))
+        try:
+            results, elapsed = run_load_test(
+                dataset, url=options['url'], processes=options['processes'],
+                threads=options['threads'], requests=options['requests'],
+                duration=options['duration'], seed=options['seed'])
+        finally:
+            if not options['keep']:
+                remove_load_test()
+
+        self.stdout.write('%-45s %8s %7s %8s %8s %8s %8s' % (
+            'route', 'requests', 'errors', 'req/s', 'p50 ms', 'p95 ms',
+            'p99 ms'))
+        for row in summarize(results, elapsed):
+            self.stdout.write('%-45s %8d %7d %8.1f %8.1f %8.1f %8.1f' % (
+                row['route'], row['requests'], row['errors'],
+                row['throughput'], row['p50'], row['p95'], row['p99']))
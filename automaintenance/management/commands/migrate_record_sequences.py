@@ -0,0 +1,239 @@
+##
+# Automaintenance.  Django app to track automaintenance records.
+# Copyright (C) 2012 Robert Robinson
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+##
+from django.core.management.base import BaseCommand, CommandError
+from django.core.management.color import no_style
+from django.db import connections, transaction, DEFAULT_DB_ALIAS
+from django.db.backends.util import truncate_name
+from django.db.models import get_app, get_models
+
+from automaintenance.models import Car, Trip, RECORD_MODELS
+from automaintenance.search import install_search_index
+
+from optparse import make_option
+
+
+# Nullable columns added to existing tables, by model and field name.
+ADDED_COLUMNS = (
+    (Car, 'deleted'),
+    (Trip, 'deleted'),
+)
+
+
+def table_columns(connection, model):
+    """
+        Returns the names of the columns of the table of the model.
+    """
+    cursor = connection.cursor()
+    description = connection.introspection.get_table_description(
+        cursor, model._meta.db_table)
+    return [column[0] for column in description]
+
+
+def has_sequence(connection, model):
+    """
+        Returns whether the table of the model already has the sequence
+        column.
+    """
+    return 'sequence' in table_columns(connection, model)
+
+
+def add_column(connection, model, name):
+    """
+        Returns the statements adding the nullable column of the field to
+        the table of the model along with its index.
+    """
+    qn = connection.ops.quote_name
+    field = model._meta.get_field(name)
+    statements = ['ALTER TABLE %s ADD COLUMN %s %s NULL' % (
+        qn(model._meta.db_table), qn(field.column),
+        field.db_type(connection=connection))]
+    statements.extend(connection.creation.sql_indexes_for_field(
+        model, field, no_style()))
+    return statements
+
+
+def migrate_postgresql(connection, model):
+    """
+        Add the sequence column and swap the unique date constraint for the
+        car, date and sequence one in place.
+    """
+    qn = connection.ops.quote_name
+    table = model._meta.db_table
+    return [
+        'ALTER TABLE %s ADD COLUMN %s integer NOT NULL DEFAULT 0 '
+        'CHECK (%s >= 0)' % (qn(table), qn('sequence'), qn('sequence')),
+        'ALTER TABLE %s ALTER COLUMN %s DROP DEFAULT' % (qn(table),
+                                                         qn('sequence')),
+        'ALTER TABLE %s DROP CONSTRAINT %s' % (qn(table),
+                                               qn('%s_date_key' % table)),
+        'ALTER TABLE %s ADD CONSTRAINT %s UNIQUE (%s, %s, %s)' % (
+            qn(table), qn('%s_car_id_date_sequence_key' % table),
+            qn('car_id'), qn('date'), qn('sequence')),
+    ]
+
+
+def migrate_mysql(connection, model):
+    """
+        Add the sequence column and swap the unique date index for the car,
+        date and sequence one in place.
+    """
+    qn = connection.ops.quote_name
+    return [
+        'ALTER TABLE %s ADD COLUMN %s integer UNSIGNED NOT NULL DEFAULT 0, '
+        'DROP INDEX %s, ADD UNIQUE (%s, %s, %s)' % (
+            qn(model._meta.db_table), qn('sequence'), qn('date'),
+            qn('car_id'), qn('date'), qn('sequence')),
+    ]
+
+
+def migrate_sqlite(connection, model):
+    """
+        SQLite can't drop the unique date constraint, so the table is
+        rebuilt from the current model and the records are copied over.
+    """
+    qn = connection.ops.quote_name
+    style = no_style()
+    table = model._meta.db_table
+    old_table = '%s__old' % table
+
+    statements = ['ALTER TABLE %s RENAME TO %s' % (qn(table), qn(old_table))]
+
+    # Index names are global, drop the ones of the old table before the new
+    # table creates them again.
+    cursor = connection.cursor()
+    cursor.execute("SELECT name FROM sqlite_master WHERE type = 'index' AND "
+                   "tbl_name = %s AND sql IS NOT NULL", [table])
+    statements.extend('DROP INDEX %s' % qn(row[0])
+                      for row in cursor.fetchall())
+
+    create, references = connection.creation.sql_create_model(
+        model, style, set(get_models()))
+    statements.extend(create)
+    statements.extend(connection.creation.sql_indexes_for_model(model, style))
+
+    columns = [qn(field.column) for field in model._meta.local_fields
+               if field.name != 'sequence']
+    statements.append('INSERT INTO %s (%s, %s) SELECT %s, 0 FROM %s' % (
+        qn(table), ', '.join(columns), qn('sequence'), ', '.join(columns),
+        qn(old_table)))
+    statements.append('DROP TABLE %s' % qn(old_table))
+
+    return statements
+
+
+# Queries returning whether an index exists, by table and index name.
+INDEX_QUERIES = {
+    'postgresql': 'SELECT 1 FROM pg_indexes WHERE tablename = %s AND '
+                  'indexname = %s',
+    'mysql': 'SELECT 1 FROM information_schema.statistics WHERE '
+             'table_schema = DATABASE() AND table_name = %s AND '
+             'index_name = %s',
+    'sqlite': "SELECT 1 FROM sqlite_master WHERE type = 'index' AND "
+              "tbl_name = %s AND name = %s",
+}
+
+
+def missing_indexes(connection, model):
+    """
+        Returns the fields and the statements of the multi column indexes of
+        the model that the table doesn't have yet.  Tables created before
+        the indexes were declared don't get them from syncdb.
+    """
+    table = model._meta.db_table
+    cursor = connection.cursor()
+    statements = []
+    for names in model._meta.index_together:
+        # Named the way the database creation of Django names them.
+        fields = [model._meta.get_field(name) for name in names]
+        index_name = truncate_name('%s_%s' % (
+            table, connection.creation._digest([field.name
+                                                for field in fields])),
+            connection.ops.max_name_length())
+        cursor.execute(INDEX_QUERIES[connection.vendor], [table, index_name])
+        if cursor.fetchone() is None:
+            statements.extend((names, statement) for statement in
+                              connection.creation.sql_indexes_for_fields(
+                                  model, fields, no_style()))
+    return statements
+
+
+MIGRATIONS = {
+    'postgresql': migrate_postgresql,
+    'mysql': migrate_mysql,
+    'sqlite': migrate_sqlite,
+}
+
+
+class Command(BaseCommand):
+    """
+        Move the record tables from dates that are unique across every car
+        to dates that are unique per car and told apart by a sequence number.
+        Existing records keep sequence 0, their dates were already unique.
+        The columns and the multi column indexes that existing tables are
+        missing, like the deleted column of the cars and the car and start
+        index of the trips, are created as well.
+    """
+    help = 'Make record dates unique per car instead of per table and ' \
+           'create missing columns and indexes.'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--database', action='store', dest='database',
+                    default=DEFAULT_DB_ALIAS,
+                    help='Database to migrate, defaults to "default".'),
+    )
+
+    def handle(self, *args, **options):
+        connection = connections[options['database']]
+
+        migrate = MIGRATIONS.get(connection.vendor)
+        if migrate is None:
+            raise CommandError('No migration for the %s database.' %
+                               connection.vendor)
+
+        with transaction.commit_on_success(using=connection.alias):
+            cursor = connection.cursor()
+            for model in RECORD_MODELS:
+                if has_sequence(connection, model):
+                    self.stdout.write('%s is already migrated' %
+                                      model._meta.db_table)
+                    continue
+
+                for statement in migrate(connection, model):
+                    cursor.execute(statement)
+
+                self.stdout.write('Migrated %s' % model._meta.db_table)
+
+            for model, name in ADDED_COLUMNS:
+                if name in table_columns(connection, model):
+                    continue
+                for statement in add_column(connection, model, name):
+                    cursor.execute(statement)
+                self.stdout.write('Added %s to %s' % (name,
+                                                      model._meta.db_table))
+
+            tables = connection.introspection.table_names()
+            for model in get_models(get_app('automaintenance')):
+                if model._meta.db_table not in tables:
+                    continue
+                for names, statement in missing_indexes(connection, model):
+                    cursor.execute(statement)
+                    self.stdout.write('Indexed %s on %s' % (
+                        model._meta.db_table, ', '.join(names)))
+
+            # Rebuilding a table drops the triggers of the search index.
+            install_search_index(connection.alias)
@@ -0,0 +1,41 @@
+##
+# Automaintenance.  Django app to track automaintenance records.
+# Copyright (C) 2012 Robert Robinson
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+##
+from django.core.management.base import BaseCommand
+
+from automaintenance.deletion import purge_deleted, PURGE_BATCH_SIZE
+
+from optparse import make_option
+
+
+class Command(BaseCommand):
+    """
+        Remove the cars and trips that were deleted while soft deletion is
+        on, meant to be run periodically.
+    """
+    help = 'Remove the records of the deleted cars and trips in batches.'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-size', action='store', dest='batch_size',
+                    type='int', default=PURGE_BATCH_SIZE,
+                    help='Number of records handled per transaction.'),
+    )
+
+    def handle(self, *args, **options):
+        purged = purge_deleted(options['batch_size'])
+
+        self.stdout.write('Purged %d cars and trips' % purged)
@@ -0,0 +1,43 @@
+##
+# Automaintenance.  Django app to track automaintenance records.
+# Copyright (C) 2012 Robert Robinson
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+##
+from django.core.management.base import BaseCommand
+from django.db import transaction, DEFAULT_DB_ALIAS
+
+from automaintenance.search import install_search_index
+
+from optparse import make_option
+
+
+class Command(BaseCommand):
+    """
+        Create the search index of the records and fill it from the records
+        and trips that are already stored.
+    """
+    help = 'Create and fill the search index of the records and trips.'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--database', action='store', dest='database',
+                    default=DEFAULT_DB_ALIAS,
+                    help='Database to index, defaults to "default".'),
+    )
+
+    def handle(self, *args, **options):
+        with transaction.commit_on_success(using=options['database']):
+            install_search_index(options['database'], rebuild=True)
+
+        self.stdout.write('Rebuilt the search index')
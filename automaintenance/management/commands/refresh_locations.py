@@ -0,0 +1,49 @@
+##
+# Automaintenance.  Django app to track automaintenance records.
+# Copyright (C) 2012 Robert Robinson
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+##
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from automaintenance.models import Car
+from automaintenance.locations import refresh_locations
+
+from optparse import make_option
+
+
+class Command(BaseCommand):
+    """
+        Build the location dictionaries from the records that are already
+        stored, a batch of cars at a time.
+    """
+    help = 'Build the location dictionaries from the records.'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-size', action='store', dest='batch_size',
+                    type='int', default=100,
+                    help='Number of cars counted per transaction.'),
+    )
+
+    def handle(self, *args, **options):
+        car_ids = list(Car.objects.order_by('pk').values_list('pk',
+                                                              flat=True))
+        batch_size = options['batch_size']
+
+        for start in range(0, len(car_ids), batch_size):
+            with transaction.commit_on_success():
+                refresh_locations(car_ids[start:start + batch_size])
+
+        self.stdout.write('Counted the locations of %d cars' % len(car_ids))
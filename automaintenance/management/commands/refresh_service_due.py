@@ -0,0 +1,34 @@
+##
+# Automaintenance.  Django app to track automaintenance records.
+# Copyright (C) 2012 Robert Robinson
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+##
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from automaintenance.scheduler import refresh_service_due
+
+
+class Command(BaseCommand):
+    """
+        Rebuild the service due table for every car in one pass.
+    """
+    help = 'Rebuild the service due table for every car.'
+
+    def handle(self, *args, **options):
+        with transaction.commit_on_success():
+            service_due_list = refresh_service_due()
+
+        self.stdout.write('Scheduled %d services' % len(service_due_list))
@@ -0,0 +1,510 @@
+##
+# Automaintenance.  Django app to track automaintenance records.
+# Copyright (C) 2012 Robert Robinson
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+##
+from django.conf import settings
+from django.db import connections
+
+from bisect import bisect_left
+
+import atexit
+import errno
+import fcntl
+import json
+import os
+import re
+import tempfile
+import threading
+import time
+
+
+# Directory shared by the worker processes, every process writes its
+# metrics to a file in it and the metrics endpoint adds the files up.
+# Without one the endpoint only reports the process that serves it.
+METRICS_DIR = getattr(settings, 'AUTOMAINTENANCE_METRICS_DIR', None)
+
+# Least number of seconds between two writes of the file of a process, the
+# metrics that changed are also written that often by a thread of the process
+# so that idle processes don't keep them to themselves.
+METRICS_FLUSH_SECONDS = getattr(settings,
+                                'AUTOMAINTENANCE_METRICS_FLUSH_SECONDS', 5)
+
+# Upper bounds of the buckets of the latency histograms, in seconds.
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+                   10.0)
+
+# Files of the metrics directory.  A process writes metrics-<pid>-<start>.json,
+# the start telling apart processes that got the same pid.  The metrics of
+# processes that exited are added to the totals file and their files removed.
+PROCESS_FILE = re.compile(r'^metrics-(\d+)-(\d+)\.json$')
+TOTALS_FILE = 'totals.json'
+LOCK_FILE = 'metrics.lock'
+
+
+def process_alive(pid):
+    """
+        Returns whether a process with the pid is running on this host.
+    """
+    try:
+        os.kill(pid, 0)
+    except OSError as error:
+        return error.errno == errno.EPERM
+    return True
+
+
+def read_json(path):
+    """
+        Returns the contents of the json file, None if it can't be read.
+    """
+    try:
+        with open(path) as data:
+            return json.load(data)
+    except (IOError, ValueError):
+        return None
+
+
+def write_json(path, contents):
+    """
+        Write the json file next to the current one and rename it over it,
+        so that readers only ever see a complete file.
+    """
+    handle, temporary = tempfile.mkstemp(dir=os.path.dirname(path),
+                                         prefix='.metrics-')
+    with os.fdopen(handle, 'w') as output:
+        json.dump(contents, output)
+    os.rename(temporary, path)
+
+
+class Metric(object):
+    """
+        Base of the metrics of the registry, holding a value per set of
+        label values.
+    """
+    kind = None
+
+    def __init__(self, registry, name, help_text, labels=()):
+        self.name = name
+        self.help_text = help_text
+        self.labels = tuple(labels)
+        self.values = {}
+        self.lock = registry.lock
+        self.registry = registry
+        registry.register(self)
+
+    def key(self, labels):
+        return tuple(labels.get(name, '') for name in self.labels)
+
+    def label_text(self, key, extra=()):
+        pairs = list(zip(self.labels, key)) + list(extra)
+        if not pairs:
+            return ''
+        return '{%s}' % ','.join('%s="%s"' % (name, unicode(value).replace(
+            '\\', '\\\\').replace('"', '\\"')) for name, value in pairs)
+
+
+class Counter(Metric):
+    """
+        Number that only goes up, such as a number of requests.
+    """
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        self.registry.check_fork()
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+            self.registry.changed = True
+
+    def merge(self, key, value):
+        self.values[key] = self.values.get(key, 0) + value
+
+    def exposition(self):
+        values = self.values
+        if not values and not self.labels:
+            values = {(): 0}
+        return ['%s%s %s' % (self.name, self.label_text(key), value)
+                for key, value in sorted(values.items())]
+
+
+class Histogram(Metric):
+    """
+        Distribution of observed values, counted in buckets by upper bound
+        along with their sum and count.
+    """
+    kind = 'histogram'
+
+    def __init__(self, registry, name, help_text, labels=(),
+                 buckets=LATENCY_BUCKETS):
+        super(Histogram, self).__init__(registry, name, help_text, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        bucket = bisect_left(self.buckets, value)
+        self.registry.check_fork()
+        with self.lock:
+            entry = self.values.get(key)
+            if entry is None:
+                entry = self.values[key] = [[0] * (len(self.buckets) + 1),
+                                            0.0]
+            entry[0][bucket] += 1
+            entry[1] += value
+            self.registry.changed = True
+
+    def merge(self, key, value):
+        entry = self.values.get(key)
+        if entry is None:
+            self.values[key] = [list(value[0]), value[1]]
+        else:
+            entry[0] = [first + second for first, second in zip(entry[0],
+                                                                value[0])]
+            entry[1] += value[1]
+
+    def exposition(self):
+        lines = []
+        for key, (counts, total) in sorted(self.values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                lines.append('%s_bucket%s %d' % (
+                    self.name, self.label_text(key, [('le', bound)]),
+                    cumulative))
+            lines.append('%s_sum%s %s' % (self.name, self.label_text(key),
+                                          repr(total)))
+            lines.append('%s_count%s %d' % (self.name, self.label_text(key),
+                                            cumulative))
+        return lines
+
+
+class Registry(object):
+    """
+        Metrics of this process.  They are written to a file per process in
+        the metrics directory so that the endpoint can add up the metrics
+        of every process.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.metrics = []
+        self.pid = os.getpid()
+        self.started = int(time.time() * 1000)
+        self.flushed = 0
+        self.changed = False
+        self.timer_pid = None
+
+    def register(self, metric):
+        self.metrics.append(metric)
+
+    def check_fork(self):
+        """
+            A process forked from this one starts with the metrics of its
+            parent, which the file of the parent already counts.
+        """
+        if os.getpid() != self.pid:
+            with self.lock:
+                if os.getpid() != self.pid:
+                    for metric in self.metrics:
+                        metric.values = {}
+                    self.pid = os.getpid()
+                    self.started = int(time.time() * 1000)
+                    self.flushed = 0
+                    self.changed = False
+
+    def snapshot(self):
+        """
+            Returns the values of the metrics in a form that can be stored
+            as json.
+        """
+        self.check_fork()
+        with self.lock:
+            self.changed = False
+            return dict((metric.name, [[list(key), value] for key, value in
+                                       metric.values.items()])
+                        for metric in self.metrics)
+
+    def path(self):
+        """
+            Returns the path of the metrics file of this process.
+        """
+        return os.path.join(METRICS_DIR, 'metrics-%d-%d.json' % (
+            self.pid, self.started))
+
+    def flush(self, force=False):
+        """
+            Write the metrics of this process to its file, at most once per
+            METRICS_FLUSH_SECONDS unless forced.
+        """
+        if not METRICS_DIR:
+            return
+        self.check_fork()
+        self.start_timer()
+        if not force and time.time() - self.flushed < METRICS_FLUSH_SECONDS:
+            return
+        self.flushed = time.time()
+
+        if not os.path.isdir(METRICS_DIR):
+            os.makedirs(METRICS_DIR)
+        write_json(self.path(), self.snapshot())
+
+    def flush_changed(self):
+        """
+            Write the metrics of this process if they changed since they were
+            last written.  Runs on the timer and when the process exits.
+        """
+        if self.changed and os.getpid() == self.pid:
+            self.flush(force=True)
+
+    def start_timer(self):
+        """
+            Start the thread that writes the changed metrics of this process
+            every METRICS_FLUSH_SECONDS, once per process since threads
+            don't survive a fork.
+        """
+        if self.timer_pid == os.getpid():
+            return
+        with self.lock:
+            if self.timer_pid == os.getpid():
+                return
+            self.timer_pid = os.getpid()
+
+        def run():
+            while True:
+                time.sleep(METRICS_FLUSH_SECONDS)
+                self.flush_changed()
+
+        timer = threading.Thread(target=run, name='automaintenance-metrics')
+        timer.daemon = True
+        timer.start()
+
+    def empty(self):
+        """
+            Returns a registry with the same metrics as this one and no
+            values.
+        """
+        empty = Registry()
+        for metric in self.metrics:
+            if metric.kind == 'histogram':
+                Histogram(empty, metric.name, metric.help_text,
+                          metric.labels, metric.buckets)
+            else:
+                Counter(empty, metric.name, metric.help_text, metric.labels)
+        return empty
+
+    def merge(self, snapshot):
+        """
+            Add the values of a snapshot to the metrics of this registry.
+        """
+        metrics = dict((metric.name, metric) for metric in self.metrics)
+        for name, values in snapshot.items():
+            if name in metrics:
+                for key, value in values:
+                    metrics[name].merge(tuple(key), value)
+
+    def exited_files(self):
+        """
+            Returns the names of the files of the processes that exited,
+            which are the processes that are gone and the ones whose pid was
+            taken by a process that started later.
+        """
+        processes = []
+        for name in os.listdir(METRICS_DIR):
+            match = PROCESS_FILE.match(name)
+            if match:
+                processes.append((name, int(match.group(1)),
+                                  int(match.group(2))))
+
+        latest = {}
+        for name, pid, started in processes:
+            latest[pid] = max(latest.get(pid, 0), started)
+
+        return [name for name, pid, started in processes
+                if (pid, started) != (self.pid, self.started) and
+                (started < latest[pid] or not process_alive(pid))]
+
+    def fold_exited(self):
+        """
+            Add the metrics of the processes that exited to the totals file
+            and remove their files, so that the counters never go down while
+            the directory doesn't grow with every process.  The files folded
+            are listed in the totals so that they are never counted twice.
+        """
+        with open(os.path.join(METRICS_DIR, LOCK_FILE), 'a') as lock_file:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+
+            exited = set(self.exited_files())
+            if not exited:
+                return
+
+            path = os.path.join(METRICS_DIR, TOTALS_FILE)
+            totals = read_json(path) or {'metrics': {}, 'folded': []}
+            folded = set(totals['folded']) & exited
+            if exited - folded:
+                total = self.empty()
+                total.merge(totals['metrics'])
+                for name in exited - folded:
+                    snapshot = read_json(os.path.join(METRICS_DIR, name))
+                    if snapshot is not None:
+                        total.merge(snapshot)
+                folded = exited
+                write_json(path, {'metrics': total.snapshot(),
+                                  'folded': sorted(folded)})
+
+            for name in folded:
+                try:
+                    os.remove(os.path.join(METRICS_DIR, name))
+                except OSError:
+                    pass
+
+    def collect(self):
+        """
+            Returns a registry holding the sum of the metrics of every
+            process that wrote to the metrics directory, including the totals
+            of the processes that exited.
+        """
+        self.flush(force=True)
+        total = self.empty()
+
+        if not METRICS_DIR:
+            total.merge(self.snapshot())
+            return total
+
+        self.fold_exited()
+        totals = read_json(os.path.join(METRICS_DIR, TOTALS_FILE)) or {
+            'metrics': {}, 'folded': []}
+        total.merge(totals['metrics'])
+        folded = set(totals['folded'])
+        for name in os.listdir(METRICS_DIR):
+            if PROCESS_FILE.match(name) and name not in folded:
+                snapshot = read_json(os.path.join(METRICS_DIR, name))
+                if snapshot is not None:
+                    total.merge(snapshot)
+        return total
+
+    def exposition(self):
+        """
+            Returns the metrics in the text exposition format.
+        """
+        lines = []
+        for metric in self.metrics:
+            lines.append('# HELP %s %s' % (metric.name, metric.help_text))
+            lines.append('# TYPE %s %s' % (metric.name, metric.kind))
+            lines.extend(metric.exposition())
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+atexit.register(registry.flush_changed)
+
+REQUEST_SECONDS = Histogram(
+    registry, 'automaintenance_request_seconds',
+    'Time taken to answer the requests by url name.', ('view',))
+
+REQUEST_DB_SECONDS = Histogram(
+    registry, 'automaintenance_request_db_seconds',
+    'Time spent in the database per request by url name.', ('view',))
+
+MAINTENANCE_LIST_ROWS = Counter(
+    registry, 'automaintenance_maintenance_list_rows_total',
+    'Records read by the maintenance lists of the cars.')
+
+RECORD_ROWS = Counter(
+    registry, 'automaintenance_record_rows_total',
+    'Rows listed by the record listings of the cars and trips.')
+
+SESSION_WRITES = Counter(
+    registry, 'automaintenance_session_writes_total',
+    'Requests that saved their session.')
+
+CACHE_LOOKUPS = Counter(
+    registry, 'automaintenance_cache_lookups_total',
+    'Lookups of the caches of the app by cache and result.  Evictions are '
+    'entries that were found out of date and replaced.',
+    ('cache', 'result'))
+
+
+def cache_lookups(cache_name, hits=0, misses=0, evictions=0):
+    """
+        Count the lookups of one of the caches of the app.
+    """
+    for result, count in (('hit', hits), ('miss', misses),
+                          ('eviction', evictions)):
+        if count:
+            CACHE_LOOKUPS.inc(count, cache=cache_name, result=result)
+
+
+_state = threading.local()
+
+
+class TimedCursor(object):
+    """
+        Cursor that adds the time its statements take to the database time
+        of the current request.
+    """
+
+    def __init__(self, cursor):
+        self.cursor = cursor
+
+    def execute(self, *args):
+        started = time.time()
+        try:
+            return self.cursor.execute(*args)
+        finally:
+            add_db_time(time.time() - started)
+
+    def executemany(self, *args):
+        started = time.time()
+        try:
+            return self.cursor.executemany(*args)
+        finally:
+            add_db_time(time.time() - started)
+
+    def __getattr__(self, attr):
+        return getattr(self.cursor, attr)
+
+    def __iter__(self):
+        return iter(self.cursor)
+
+
+def add_db_time(seconds):
+    _state.db_time = getattr(_state, 'db_time', 0.0) + seconds
+
+
+def start_db_timing():
+    """
+        Time the statements of the connections of the current thread from
+        now on.  Connections are per thread, so the cursors are wrapped the
+        first time a thread sees a connection.
+    """
+    _state.db_time = 0.0
+    for alias in connections:
+        connection = connections[alias]
+        if not getattr(connection, 'automaintenance_timed', False):
+            connection.cursor = timed_cursor(connection.cursor)
+            connection.automaintenance_timed = True
+
+
+def timed_cursor(cursor):
+    def cursor_factory():
+        return TimedCursor(cursor())
+    return cursor_factory
+
+
+def db_time():
+    """
+        Returns the database time of the current thread since timing
+        started.
+    """
+    return getattr(_state, 'db_time', 0.0)
@@ -0,0 +1,111 @@
+##
+# Automaintenance.  Django app to track automaintenance records.
+# Copyright (C) 2012 Robert Robinson
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+##
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+
+from automaintenance.routers import clear_writes, has_written
+from automaintenance.routers import LAST_WRITE_SESSION_KEY
+from automaintenance.profiling import PROFILE_DIR, profile_requested
+from automaintenance.profiling import profile_view
+from automaintenance.metrics import REQUEST_SECONDS, REQUEST_DB_SECONDS
+from automaintenance.metrics import SESSION_WRITES, registry
+from automaintenance.metrics import start_db_timing, db_time
+
+import time
+
+
+class ReplicaMiddleware(object):
+    """
+        Stores the time of the requests that wrote to the database in the
+        session, so that the read only views stop reading from the replica
+        until it has caught up.  Needs to come after the session middleware.
+    """
+
+    def process_request(self, request):
+        """
+            Start tracking the writes of the request.
+        """
+        clear_writes()
+
+    def process_response(self, request, response):
+        """
+            Remember the time of the write in the session.
+        """
+        if has_written() and hasattr(request, 'session'):
+            request.session[LAST_WRITE_SESSION_KEY] = time.time()
+        return response
+
+
+class ProfilerMiddleware(object):
+    """
+        Profiles the requests of staff users that ask for it with the
+        profile query parameter or the X-Automaintenance-Profile header.
+        Needs to come after the authentication middleware, and takes itself
+        out of the middleware when AUTOMAINTENANCE_PROFILE_DIR isn't set.
+    """
+
+    def __init__(self):
+        if not PROFILE_DIR:
+            raise MiddlewareNotUsed
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        """
+            Run the view in the profiler when the request asks for it.
+        """
+        if profile_requested(request):
+            return profile_view(request, view_func, view_args, view_kwargs)
+        return None
+
+
+class MetricsMiddleware(object):
+    """
+        Measures the time taken by the requests and by their queries per url
+        name, and counts the requests that save their session.  Needs to
+        come right after the session middleware so that it sees every
+        change the other middleware make to the session.
+    """
+
+    def process_request(self, request):
+        """
+            Start the clocks of the request.
+        """
+        request.metrics_started = time.time()
+        start_db_timing()
+
+    def process_response(self, request, response):
+        """
+            Record the measures of the request, a request that failed in an
+            earlier middleware was never started.
+        """
+        started = getattr(request, 'metrics_started', None)
+        if started is None:
+            return response
+
+        match = getattr(request, 'resolver_match', None)
+        view = match.url_name if match is not None and match.url_name \
+            else 'unmatched'
+        REQUEST_SECONDS.observe(time.time() - started, view=view)
+        REQUEST_DB_SECONDS.observe(db_time(), view=view)
+
+        session = getattr(request, 'session', None)
+        if session is not None and response.status_code != 500 and \
+                (session.modified or settings.SESSION_SAVE_EVERY_REQUEST):
+            SESSION_WRITES.inc()
+
+        registry.flush()
+        return response
@@ -24,6 +24,9 @@ from django.conf import settings
 from django.core.urlresolvers import reverse
 from django.utils.safestring import mark_safe
 
+from automaintenance.fanout import fan_out
+from automaintenance.metrics import MAINTENANCE_LIST_ROWS
+
 import pytz
 
 from datetime import datetime
@@ -72,31 +75,28 @@ DEFAULT_PAYMENT_TYPE = 'other'
 def earliest_first(first, second):
     """
             Basic comparison function for all records that will sort based on
-            the date values.
+            the date and sequence values.
         """
-    return_value = 0
-
-    if first.date < second.date:
-        return_value = -1
-    elif first.date > second.date:
-        return_value = 1
-
-    return return_value
+    return cmp((first.date, first.sequence), (second.date, second.sequence))
 
 
 def latest_first(first, second):
     """
             Basic comparison function for all records that will sort based on
-            the date values.
+            the date and sequence values.
         """
-    return_value = 0
+    return cmp((second.date, second.sequence), (first.date, first.sequence))
 
-    if first.date < second.date:
-        return_value = 1
-    elif first.date > second.date:
-        return_value = -1
 
-    return return_value
+class VisibleManager(models.Manager):
+    """
+        Manager that leaves out the objects that were deleted but are not
+        purged yet.
+    """
+
+    def get_query_set(self):
+        return super(VisibleManager, self).get_query_set().filter(
+            deleted__isnull=True)
 
 
 class Car(models.Model):
@@ -117,6 +117,11 @@ class Car(models.Model):
                                        default=27.0)
     currency = models.CharField(max_length=20, choices=CURRENCY_UNITS,
                                 default=DEFAULT_CURRENCY)
+    deleted = models.DateTimeField(null=True, blank=True, db_index=True,
+                                   editable=False)
+
+    objects = VisibleManager()
+    all_objects = models.Manager()
 
     class Meta:
         ordering = ['name']
@@ -167,21 +172,15 @@ class Car(models.Model):
             Returns a list of maintenance records for the car model provided.
         """ 
         # Populate the maintenance list for this car
-        gasoline = self.maintenance_query(GasolinePurchase,
-                                          start_date=start_date,
-                                          end_date=end_date, trip=trip)
-        
-        oilchange = self.maintenance_query(OilChange, start_date, end_date,
-                                           trip)
-                
-        maintenance = self.maintenance_query(Maintenance, start_date, end_date,
-                                             trip)
+        queries = [(list, (self.maintenance_query(model, start_date, end_date,
+                                                  trip),))
+                   for model in RECORD_MODELS]
 
-        payment = self.maintenance_query(Payment, start_date, end_date, trip)
-        
-        maintenance_list = list(gasoline) + list(oilchange) + \
-            list(maintenance) + list(payment)
+        maintenance_list = []
+        for records in fan_out(queries):
+            maintenance_list.extend(records)
         maintenance_list = sorted(maintenance_list, cmp=latest_first)
+        MAINTENANCE_LIST_ROWS.inc(len(maintenance_list))
 
         return maintenance_list
     
@@ -213,12 +212,19 @@ class Trip(models.Model):
     description = models.TextField(blank=True)
     start = models.DateTimeField()
     end = models.DateTimeField(null=True)
+    deleted = models.DateTimeField(null=True, blank=True, db_index=True,
+                                   editable=False)
+
+    objects = VisibleManager()
+    all_objects = models.Manager()
 
     class Meta:
         """
-            Meta class that overrides the models basic attributes.
+            Meta class that overrides the models basic attributes.  Trips
+            are looked up by car and start date by the record forms.
         """
         ordering = ['name']
+        index_together = (('car', 'start'),)
 
     def __unicode__(self):
         """
@@ -240,7 +246,8 @@ class MaintenanceBase(models.Model):
         Maintenance root object that contains date, car, location, mileage, and
         cost fields for any of the maintenance record values.
     """
-    date = models.DateTimeField(unique=True, default=datetime.now)
+    date = models.DateTimeField(default=datetime.now)
+    sequence = models.PositiveIntegerField(default=0)
     date_timezone = models.CharField(max_length=50, choices=timezone_choices, 
                                      default=settings.TIME_ZONE)
     car = models.ForeignKey(Car)
@@ -254,10 +261,12 @@ class MaintenanceBase(models.Model):
     class Meta:
         """
             Mark the model as being an abstract model for the rest of the
-            maintenance type objects.
+            maintenance type objects.  Dates are unique per car, records
+            of a car at the same date are told apart by their sequence.
         """
         abstract = True
-        ordering = ['date']
+        ordering = ['date', 'sequence']
+        unique_together = (('car', 'date', 'sequence'),)
         get_latest_by = 'date'
 
     def __unicode__(self):
@@ -271,11 +280,7 @@ class MaintenanceBase(models.Model):
             Basic comparison operator for all records that will sort based on
             the date values.
         """
-        if self.date < other.date:
-            return -1
-        elif self.date > other.date:
-            return 1
-        return 0
+        return cmp((self.date, self.sequence), (other.date, other.sequence))
     
     def human_readable_type(self):
         """ 
@@ -432,7 +437,8 @@ class Payment(models.Model):
         fines, tickets. Basically anything that doesn't have a mileage
         associated with it.
     """
-    date = models.DateTimeField(unique=True, default=datetime.now)
+    date = models.DateTimeField(default=datetime.now)
+    sequence = models.PositiveIntegerField(default=0)
     date_timezone = models.CharField(max_length=50, choices=timezone_choices,
                                      default=settings.TIME_ZONE)
     car = models.ForeignKey(Car)
@@ -444,6 +450,13 @@ class Payment(models.Model):
     type = models.CharField(max_length=11, choices=PAYMENT_TYPES,
                             default=DEFAULT_PAYMENT_TYPE)
 
+    class Meta:
+        """
+            Dates are unique per car like the maintenance records.
+        """
+        ordering = ['date', 'sequence']
+        unique_together = (('car', 'date', 'sequence'),)
+
     def get_absolute_url(self):
         """
             Absolute URL for the detailed record.
@@ -472,4 +485,277 @@ class Payment(models.Model):
         """
             Returns a human readable type information for this object type.
         """
-        return self.get_type_display()
\ No newline at end of file
+        return self.get_type_display()
+
+
+# Models that make up the maintenance history of a car.
+RECORD_MODELS = (GasolinePurchase, OilChange, Maintenance, Payment)
+
+
+# Name of the service that is used to track oil changes in the service due
+# table.
+OIL_CHANGE_SERVICE = 'Oil Change'
+
+
+class ServiceDue(models.Model):
+    """
+        When the next oil change or recurring maintenance is due for a car.
+        These rows are maintained by the scheduler so that the services that
+        are due across every car can be found with a single indexed query.
+    """
+    car = models.ForeignKey(Car, related_name='+')
+    service = models.CharField(max_length=100)
+    last_date = models.DateTimeField()
+    last_mileage = models.PositiveIntegerField(default=0)
+    interval_mileage = models.PositiveIntegerField(null=True, blank=True)
+    interval_days = models.PositiveIntegerField(null=True, blank=True)
+    due_mileage = models.PositiveIntegerField(null=True, blank=True)
+    due_date = models.DateTimeField(null=True, blank=True)
+    projected_mileage_date = models.DateTimeField(null=True, blank=True)
+    next_due = models.DateTimeField(db_index=True)
+
+    class Meta:
+        """
+            Services are unique per car and are ordered by when they are due.
+        """
+        ordering = ['next_due']
+        unique_together = (('car', 'service'),)
+
+    def __unicode__(self):
+        """
+            Return the service and when it is due.
+        """
+        return "%s: %s" % (self.service, date(self.next_due, "Y-m-d"))
+
+
+class CarVersion(models.Model):
+    """
+        Version counter of the data shown for a car.  The version is bumped
+        whenever the car, its trips or its records change, so pages can tell
+        whether anything changed without looking at the records.
+    """
+    car = models.OneToOneField(Car, primary_key=True, related_name='+')
+    version = models.PositiveIntegerField(default=0)
+    modified = models.DateTimeField()
+
+    def __unicode__(self):
+        """
+            Return the car and its version.
+        """
+        return "%s: %s" % (self.car_id, self.version)
+
+
+class RemovedCarVersion(models.Model):
+    """
+        Last data version of a car that was removed.  The primary key of a
+        removed car can be given to a new car, which continues from this
+        version so that it never reads the data cached for the removed car.
+        The car is not a foreign key so that the row outlives the car.
+    """
+    car_id = models.PositiveIntegerField(primary_key=True)
+    version = models.PositiveIntegerField(default=0)
+
+    def __unicode__(self):
+        """
+            Return the car and its last version.
+        """
+        return "%s: %s" % (self.car_id, self.version)
+
+REPORT_JOB_PENDING = 'pending'
+REPORT_JOB_RUNNING = 'running'
+REPORT_JOB_DONE = 'done'
+REPORT_JOB_FAILED = 'failed'
+
+REPORT_JOB_STATUSES = ((REPORT_JOB_PENDING, 'Pending'),
+                       (REPORT_JOB_RUNNING, 'Running'),
+                       (REPORT_JOB_DONE, 'Done'),
+                       (REPORT_JOB_FAILED, 'Failed'),)
+
+
+class ReportJob(models.Model):
+    """
+        A report that is computed in the background.  The key identifies the
+        report, car and date range so that identical requests share one job.
+    """
+    key = models.CharField(max_length=40, unique=True)
+    car = models.ForeignKey(Car, related_name='+')
+    report = models.CharField(max_length=50)
+    start_date = models.DateTimeField()
+    end_date = models.DateTimeField()
+    status = models.CharField(max_length=10, choices=REPORT_JOB_STATUSES,
+                              default=REPORT_JOB_PENDING)
+    result = models.TextField(blank=True)
+    error = models.TextField(blank=True)
+    created = models.DateTimeField(auto_now_add=True)
+    finished = models.DateTimeField(null=True, blank=True)
+
+    def __unicode__(self):
+        """
+            Return the report and the status of the job.
+        """
+        return "%s (%s): %s" % (self.report, self.car_id, self.status)
+
+    def is_finished(self):
+        """
+            Returns whether the job is done running, successful or not.
+        """
+        return self.status in (REPORT_JOB_DONE, REPORT_JOB_FAILED)
+
+
+class IngestionKey(models.Model):
+    """
+        Key supplied by a client for a record sent to the batch ingestion api.
+        Sending a record with a key that was already used returns the record
+        that was created the first time instead of creating it again.
+    """
+    owner = models.ForeignKey(User, related_name='+')
+    key = models.CharField(max_length=100)
+    record_type = models.CharField(max_length=50)
+    record_id = models.PositiveIntegerField(null=True)
+    created = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        """
+            Keys are unique per owner.
+        """
+        unique_together = (('owner', 'key'),)
+
+    def __unicode__(self):
+        """
+            Return the key and the record it created.
+        """
+        return "%s: %s %s" % (self.key, self.record_type, self.record_id)
+
+
+class Location(models.Model):
+    """
+        Entry of the location dictionary of an owner.  Locations are matched
+        on their normalized name, so the variants of a name that only differ
+        in case or spacing share one entry.
+    """
+    owner = models.ForeignKey(User, related_name='+')
+    name = models.CharField(max_length=100)
+    normalized = models.CharField(max_length=100)
+    uses = models.PositiveIntegerField(default=0)
+    last_used = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        """
+            Locations are unique per owner, the most used ones come first.
+        """
+        ordering = ['-uses', 'normalized']
+        unique_together = (('owner', 'normalized'),)
+
+    def __unicode__(self):
+        """
+            Return the name of the location.
+        """
+        return self.name
+
+
+class CarLocation(models.Model):
+    """
+        Number of records of a car at a location.  The uses of the locations
+        are the sum of these rows, so a change to the records of a car only
+        recounts the records of that car.
+    """
+    car = models.ForeignKey(Car, related_name='+')
+    location = models.ForeignKey(Location, related_name='+')
+    uses = models.PositiveIntegerField(default=0)
+    last_used = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        """
+            Every car has one row per location.
+        """
+        unique_together = (('car', 'location'),)
+
+    def __unicode__(self):
+        """
+            Return the car, location and the number of uses.
+        """
+        return "%s: %s (%s)" % (self.car_id, self.location_id, self.uses)
+
+
+class RecordArchive(models.Model):
+    """
+        Records of a car from one year that were moved out of the record
+        tables because they are rarely read.  The records are stored as
+        compressed json in data, the readers of the records merge them back
+        in when the dates they read reach into the year.
+    """
+    car = models.ForeignKey(Car, related_name='+')
+    year = models.PositiveIntegerField()
+    records = models.PositiveIntegerField(default=0)
+    data = models.TextField()
+
+    class Meta:
+        """
+            Every car has one archive per year.
+        """
+        ordering = ['year']
+        unique_together = (('car', 'year'),)
+
+    def __unicode__(self):
+        """
+            Return the car, the year and the number of records.
+        """
+        return "%s: %s (%s)" % (self.car_id, self.year, self.records)
+
+
+CHANGE_CREATE = 'create'
+CHANGE_UPDATE = 'update'
+CHANGE_DELETE = 'delete'
+
+CHANGE_ACTIONS = ((CHANGE_CREATE, 'Created'),
+                  (CHANGE_UPDATE, 'Updated'),
+                  (CHANGE_DELETE, 'Deleted'),)
+
+
+class Change(models.Model):
+    """
+        Entry of the change feed of an owner.  The primary key is the
+        sequence of the change, clients keep the sequence of the last change
+        they have seen and ask for the changes after it.  The car is not a
+        foreign key so that the changes outlive the car.
+    """
+    owner = models.ForeignKey(User, related_name='+')
+    car_id = models.PositiveIntegerField()
+    object_type = models.CharField(max_length=50)
+    object_id = models.PositiveIntegerField()
+    action = models.CharField(max_length=6, choices=CHANGE_ACTIONS)
+    date = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        """
+            Changes are read in sequence per owner, and compacted per object.
+        """
+        ordering = ['pk']
+        index_together = (('owner', 'id'),
+                          ('object_type', 'object_id'),)
+
+    def __unicode__(self):
+        """
+            Return the sequence and what changed.
+        """
+        return "%s: %s %s %s" % (self.pk, self.action, self.object_type,
+                                 self.object_id)
+
+
+class ChangeHorizon(models.Model):
+    """
+        Sequence up to which the changes of an owner were compacted away.
+        Clients with an older cursor have to download the history again.
+    """
+    owner = models.OneToOneField(User, primary_key=True, related_name='+')
+    sequence = models.PositiveIntegerField(default=0)
+
+    def __unicode__(self):
+        """
+            Return the owner and the sequence.
+        """
+        return "%s: %s" % (self.owner_id, self.sequence)
+
+
+# Connect the handlers that keep the data derived from the records up to date.
+import automaintenance.signals  # noqa
@@ -0,0 +1,235 @@
+##
+# Automaintenance.  Django app to track automaintenance records.
+# Copyright (C) 2012 Robert Robinson
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+##
+from django.core.cache import cache
+from django.utils.timezone import utc
+
+from automaintenance.models import Car, GasolinePurchase, Location
+from automaintenance.archive import archived_records
+from automaintenance.locations import normalize_location, UNKNOWN_LOCATION
+from automaintenance.snapshots import car_snapshot, scaled, timestamp
+from automaintenance.snapshots import SNAPSHOT_TIMEOUT, TYPE_GASOLINE
+from automaintenance.versions import car_data_version, car_data_versions
+from automaintenance.sequences import chunks
+from automaintenance.metrics import cache_lookups
+
+from collections import defaultdict
+from datetime import datetime
+from decimal import Decimal
+
+import hashlib
+
+
+# Prices and fuel amounts are in thousandths like the snapshot columns.
+PRICE_SCALE = 1000
+
+
+def percentile(ordered, fraction):
+    """
+        Returns the percentile of the sorted values, interpolating between
+        the two closest values.
+    """
+    position = (len(ordered) - 1) * fraction
+    low = int(position)
+    high = min(low + 1, len(ordered) - 1)
+    return ordered[low] + (ordered[high] - ordered[low]) * (position - low)
+
+
+def price_statistics(prices, volumes):
+    """
+        Returns the number of fills and the minimum, median, 90th percentile,
+        maximum and the mean price weighted by the fuel bought, or None
+        without any fills.
+    """
+    if not prices:
+        return None
+
+    ordered = sorted(prices)
+    volume = sum(volumes)
+    if volume:
+        weighted = float(sum(price * amount for price, amount in
+                             zip(prices, volumes))) / volume
+    else:
+        weighted = float(sum(prices)) / len(prices)
+
+    def price(value):
+        return (Decimal(repr(float(value))) / PRICE_SCALE).quantize(
+            Decimal('0.001'))
+
+    return {'fills': len(prices), 'min': price(ordered[0]),
+            'median': price(percentile(ordered, 0.5)),
+            'p90': price(percentile(ordered, 0.9)),
+            'max': price(ordered[-1]), 'weighted_mean': price(weighted)}
+
+
+def statistics_data(statistics):
+    """
+        Returns the statistics with the prices as floats so they can be
+        serialized as json.
+    """
+    if statistics is None:
+        return None
+    return dict((name, float(value) if isinstance(value, Decimal) else value)
+                for name, value in statistics.items())
+
+
+def month_start(year, month):
+    """
+        Returns the start of the month, periods are UTC months.
+    """
+    return datetime(year, month, 1, tzinfo=utc)
+
+
+def periods_between(start_date, end_date):
+    """
+        Returns the (year, month) of every month that the dates reach into.
+    """
+    start_date = start_date.astimezone(utc)
+    end_date = end_date.astimezone(utc)
+
+    periods = []
+    year, month = start_date.year, start_date.month
+    while (year, month) <= (end_date.year, end_date.month):
+        periods.append((year, month))
+        year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+    return periods
+
+
+def period_fills(snapshots, periods):
+    """
+        Returns the prices and fuel amounts of the fills of the snapshots in
+        the periods, keyed by period, in one pass over their rows.
+    """
+    fills = dict((period, ([], [])) for period in periods)
+    if not periods:
+        return fills
+
+    first = month_start(*periods[0])
+    year, month = periods[-1]
+    end = month_start(*((year + 1, 1) if month == 12 else (year, month + 1)))
+
+    last = timestamp(end)
+    for snapshot in snapshots:
+        gasoline = snapshot.between(first, end).select(types=[TYPE_GASOLINE])
+        for record_date, price, fuel in zip(gasoline.date, gasoline.price,
+                                            gasoline.fuel):
+            if record_date >= last:
+                continue
+            day = datetime.utcfromtimestamp(record_date)
+            prices, volumes = fills[(day.year, day.month)]
+            prices.append(price)
+            volumes.append(fuel)
+
+    return fills
+
+
+def period_statistics(scope, version, snapshots, start_date, end_date):
+    """
+        Returns a (year, month, statistics) for every month between the dates.
+        The statistics of a month cover the whole month and are cached by the
+        version of the data, so only the months that aren't cached are
+        computed.  Snapshots is a callable returning the snapshots to read.
+    """
+    periods = periods_between(start_date, end_date)
+    keys = dict((period, 'automaintenance:price_stats:%s:%s:%04d-%02d' % (
+        scope, version, period[0], period[1])) for period in periods)
+
+    cached = cache.get_many(keys.values())
+    missing = [period for period in periods if keys[period] not in cached]
+    if missing:
+        computed = {}
+        for period, (prices, volumes) in period_fills(snapshots(),
+                                                      missing).items():
+            computed[keys[period]] = price_statistics(prices, volumes)
+        cache.set_many(computed, SNAPSHOT_TIMEOUT)
+        cached.update(computed)
+    cache_lookups('price_stats', hits=len(periods) - len(missing),
+                  misses=len(missing))
+
+    return [(year, month, cached[keys[(year, month)]])
+            for year, month in periods]
+
+
+def car_price_statistics(car, start_date, end_date):
+    """
+        Returns the monthly fuel price statistics of the car.
+    """
+    return period_statistics('car:%s' % car.pk, car_data_version(car.pk),
+                             lambda: [car_snapshot(car)], start_date,
+                             end_date)
+
+
+def fleet_cars(car):
+    """
+        Returns the cars of the owner of the car that buy fuel in the same
+        unit and currency, so their prices can be compared.
+    """
+    return list(Car.objects.filter(owner=car.owner_id,
+                                   fuel_unit=car.fuel_unit,
+                                   currency=car.currency).order_by('pk'))
+
+
+def fleet_price_statistics(car, start_date, end_date):
+    """
+        Returns the monthly fuel price statistics of the cars of the owner
+        of the car that are comparable to it.
+    """
+    cars = fleet_cars(car)
+    versions = car_data_versions([fleet_car.pk for fleet_car in cars])
+    version = hashlib.sha1(repr([(fleet_car.pk, versions[fleet_car.pk])
+                                 for fleet_car in cars])).hexdigest()
+    return period_statistics('fleet:%s' % car.owner_id, version,
+                             lambda: [car_snapshot(fleet_car)
+                                      for fleet_car in cars],
+                             start_date, end_date)
+
+
+def location_price_statistics(car, start_date, end_date):
+    """
+        Returns the fuel price statistics of the car per location between
+        the dates, most fills first.  The fills are read with one query.
+    """
+    fills = defaultdict(lambda: ([], []))
+    names = {}
+
+    rows = list(car.maintenance_query(GasolinePurchase, start_date,
+                                      end_date).order_by().values_list(
+        'location', 'price_per_unit', 'fuel_amount'))
+    rows.extend((record['location'], record['price_per_unit'],
+                 record['fuel_amount']) for record in archived_records(
+        [car.pk], start_date, end_date)[GasolinePurchase])
+
+    for location, price, fuel in rows:
+        normalized = normalize_location(location)
+        names.setdefault(normalized, location.strip() or UNKNOWN_LOCATION)
+        prices, volumes = fills[normalized]
+        prices.append(scaled(price, PRICE_SCALE))
+        volumes.append(scaled(fuel, PRICE_SCALE))
+
+    dictionary = [name for name in names if name]
+    for chunk in chunks(dictionary):
+        for entry in Location.objects.filter(owner=car.owner_id,
+                                             normalized__in=chunk):
+            names[entry.normalized] = entry.name
+
+    statistics = []
+    for normalized, (prices, volumes) in fills.items():
+        location_statistics = price_statistics(prices, volumes)
+        location_statistics['location'] = names[normalized]
+        statistics.append(location_statistics)
+    statistics.sort(key=lambda entry: (-entry['fills'], entry['location']))
+    return statistics
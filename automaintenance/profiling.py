@@ -0,0 +1,187 @@
+##
+# Automaintenance.  Django app to track automaintenance records.
+# Copyright (C) 2012 Robert Robinson
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+##
+from django.conf import settings
+from django.db import connections
+from django.utils.timezone import now
+
+import cProfile
+import json
+import os
+import pstats
+import re
+import StringIO
+import tempfile
+import time
+import uuid
+
+
+# Directory that the profiles are written to, profiling is off without one.
+PROFILE_DIR = getattr(settings, 'AUTOMAINTENANCE_PROFILE_DIR', None)
+
+# Number of profiles kept, the oldest ones are removed first.
+PROFILE_KEEP = getattr(settings, 'AUTOMAINTENANCE_PROFILE_KEEP', 100)
+
+# Query parameter and header that ask for the request to be profiled.
+PROFILE_PARAMETER = 'profile'
+PROFILE_HEADER = 'HTTP_X_AUTOMAINTENANCE_PROFILE'
+
+# Number of functions listed in the text report of a profile.
+PROFILE_FUNCTIONS = 40
+
+PROFILE_ID = re.compile(r'^[0-9]{14}-[0-9a-f]{8}$')
+
+
+def profile_requested(request):
+    """
+        Returns whether the request asks to be profiled and comes from a
+        staff user.  The user is only looked up for requests that ask.
+    """
+    if PROFILE_PARAMETER not in request.GET and \
+            PROFILE_HEADER not in request.META:
+        return False
+    user = getattr(request, 'user', None)
+    return user is not None and user.is_staff
+
+
+def profile_view(request, view_func, args, kwargs):
+    """
+        Run the view under the profiler while recording the queries it
+        makes, and store the profile.  Template responses are rendered in
+        the profiler so that the templates are part of the profile.
+    """
+    aliases = list(connections)
+    debug_cursors = dict((alias, connections[alias].use_debug_cursor)
+                         for alias in aliases)
+    offsets = dict((alias, len(connections[alias].queries))
+                   for alias in aliases)
+    for alias in aliases:
+        connections[alias].use_debug_cursor = True
+
+    def run():
+        response = view_func(request, *args, **kwargs)
+        if hasattr(response, 'render') and callable(response.render):
+            response = response.render()
+        return response
+
+    profiler = cProfile.Profile()
+    started = time.time()
+    try:
+        response = profiler.runcall(run)
+    finally:
+        duration = time.time() - started
+        for alias in aliases:
+            connections[alias].use_debug_cursor = debug_cursors[alias]
+
+    queries = []
+    for alias in aliases:
+        for query in connections[alias].queries[offsets[alias]:]:
+            queries.append({'database': alias, 'sql': query['sql'],
+                            'time': float(query['time'])})
+
+    save_profile(request, response, profiler, duration, queries)
+    return response
+
+
+def profile_path(profile_id, extension):
+    """
+        Returns the path of a file of the profile.
+    """
+    return os.path.join(PROFILE_DIR, '%s.%s' % (profile_id, extension))
+
+
+def save_profile(request, response, profiler, duration, queries):
+    """
+        Write the statistics of the profiler and a summary of the request
+        next to them, then remove the oldest profiles.
+    """
+    if not os.path.isdir(PROFILE_DIR):
+        os.makedirs(PROFILE_DIR)
+
+    profile_id = '%s-%s' % (now().strftime('%Y%m%d%H%M%S'),
+                            uuid.uuid4().hex[:8])
+    profiler.dump_stats(profile_path(profile_id, 'prof'))
+
+    report = StringIO.StringIO()
+    stats = pstats.Stats(profiler, stream=report)
+    stats.sort_stats('cumulative').print_stats(PROFILE_FUNCTIONS)
+
+    summary = {
+        'id': profile_id,
+        'path': request.get_full_path(),
+        'method': request.method,
+        'user': request.user.get_username(),
+        'status': response.status_code,
+        'date': now().isoformat(),
+        'duration': duration,
+        'sql_time': sum(query['time'] for query in queries),
+        'queries': queries,
+        'report': report.getvalue(),
+    }
+
+    handle, path = tempfile.mkstemp(dir=PROFILE_DIR)
+    with os.fdopen(handle, 'w') as output:
+        json.dump(summary, output)
+    os.rename(path, profile_path(profile_id, 'json'))
+
+    for old_id in profile_ids()[PROFILE_KEEP:]:
+        for extension in ('json', 'prof'):
+            try:
+                os.remove(profile_path(old_id, extension))
+            except OSError:
+                pass
+
+
+def profile_ids():
+    """
+        Returns the ids of the stored profiles, latest first.
+    """
+    if not PROFILE_DIR or not os.path.isdir(PROFILE_DIR):
+        return []
+    names = [name[:-5] for name in os.listdir(PROFILE_DIR)
+             if name.endswith('.json')]
+    return sorted([name for name in names if PROFILE_ID.match(name)],
+                  reverse=True)
+
+
+def load_profile(profile_id):
+    """
+        Returns the summary of the profile, or None if there is no such
+        profile.
+    """
+    if not PROFILE_DIR or not PROFILE_ID.match(profile_id):
+        return None
+    try:
+        with open(profile_path(profile_id, 'json')) as summary:
+            return json.load(summary)
+    except (IOError, ValueError):
+        return None
+
+
+def list_profiles():
+    """
+        Returns the summaries of the stored profiles without their queries
+        and reports, latest first.
+    """
+    profiles = []
+    for profile_id in profile_ids():
+        profile = load_profile(profile_id)
+        if profile is not None:
+            profile['query_count'] = len(profile.pop('queries'))
+            profile.pop('report')
+            profiles.append(profile)
+    return profiles
@@ -0,0 +1,221 @@
+##
+# Automaintenance.  Django app to track automaintenance records.
+# Copyright (C) 2012 Robert Robinson
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+##
+from django.conf import settings
+from django.core.cache import cache
+
+from automaintenance.models import GasolinePurchase
+from automaintenance.snapshots import car_snapshot, timestamp, scaled
+from automaintenance.snapshots import SCALES, SNAPSHOT_TIMEOUT
+from automaintenance.versions import car_data_version
+from automaintenance.metrics import cache_lookups
+
+from array import array
+from bisect import bisect_left, bisect_right
+from decimal import Decimal
+
+
+# Columns of the range indexes, they hold the running totals of the snapshot
+# columns with the same name.
+RANGE_COLUMNS = ('cost', 'distance', 'fuel')
+
+# Number of days of the trailing windows that costs are spread over by the
+# cost per distance report.
+COST_WINDOWS = getattr(settings, 'AUTOMAINTENANCE_COST_WINDOWS',
+                       (30, 90, 365))
+
+DAY = 24 * 60 * 60
+
+
+class RangeIndex(object):
+    """
+        Running totals of the cost, distance and fuel of the records of a car
+        ordered by date.  The totals of any date range are the difference of
+        the running totals at its ends, which are found by bisecting the
+        dates.  The running totals start with a 0 so the ranges at the start
+        of the history don't need a special case.  Snapshot version is the
+        version of the snapshot the index was built from, None when the
+        snapshot didn't know its version.
+    """
+    snapshot_version = None
+
+    def __init__(self, version, dates, snapshot_version=None, **columns):
+        self.version = version
+        self.snapshot_version = snapshot_version
+        self.dates = dates
+        for name in RANGE_COLUMNS:
+            setattr(self, name, columns[name])
+
+    @classmethod
+    def from_snapshot(cls, version, snapshot):
+        """
+            Build the index of a snapshot.
+        """
+        columns = {}
+        for name in RANGE_COLUMNS:
+            running = array('l', [0])
+            total = 0
+            for value in getattr(snapshot, name):
+                total += value
+                running.append(total)
+            columns[name] = running
+        return cls(version, array('d', snapshot.date),
+                   snapshot_version=snapshot.version, **columns)
+
+    def append(self, record_date, cost, distance, fuel):
+        """
+            Add a record that is at least as late as every other record, the
+            values are in the units of the snapshot columns.
+        """
+        self.dates.append(record_date)
+        for name, value in zip(RANGE_COLUMNS, (cost, distance, fuel)):
+            column = getattr(self, name)
+            column.append(column[-1] + value)
+
+    def totals(self, start_date=None, end_date=None):
+        """
+            Returns the number of records and the total cost, distance and
+            fuel of the records between the dates.
+        """
+        low = 0
+        high = len(self.dates)
+        if start_date is not None:
+            low = bisect_left(self.dates, timestamp(start_date))
+        if end_date is not None:
+            high = bisect_right(self.dates, timestamp(end_date))
+        high = max(low, high)
+
+        totals = {'count': high - low}
+        for name in RANGE_COLUMNS:
+            column = getattr(self, name)
+            totals[name] = Decimal(column[high] - column[low]) / SCALES[name]
+        return totals
+
+
+def range_index_key(car_id):
+    """
+        Returns the cache key of the range index of the car.
+    """
+    return 'automaintenance:range_index:%s' % car_id
+
+
+def range_index(car):
+    """
+        Returns the range index of the current version of the car.  Indexes
+        that fell behind the car are rebuilt from its snapshot.
+    """
+    version = car_data_version(car.pk)
+    key = range_index_key(car.pk)
+
+    index = cache.get(key)
+    if index is None or index.version != version:
+        if index is None:
+            cache_lookups('range_index', misses=1)
+        else:
+            cache_lookups('range_index', evictions=1)
+        index = RangeIndex.from_snapshot(version, car_snapshot(car))
+        cache.set(key, index, SNAPSHOT_TIMEOUT)
+    else:
+        cache_lookups('range_index', hits=1)
+    return index
+
+
+def append_record(record):
+    """
+        Add a new record to the index of its car without rebuilding it.  This
+        only applies when the record is the only change since the index was
+        built from a snapshot of the same version and it isn't back dated,
+        other changes leave the index behind the version of the car so it is
+        rebuilt when it is read.
+    """
+    version = car_data_version(record.car_id)
+    key = range_index_key(record.car_id)
+
+    index = cache.get(key)
+    if index is None or index.version != version - 1 or \
+            index.snapshot_version != index.version:
+        return
+
+    record_date = timestamp(record.date)
+    if index.dates and record_date < index.dates[-1]:
+        return
+
+    # The values of a record that was just created can still be floats or
+    # strings, their text is what the database stored.
+    distance = fuel = 0
+    if isinstance(record, GasolinePurchase):
+        distance = scaled(unicode(record.tank_mileage), SCALES['distance'])
+        fuel = scaled(unicode(record.fuel_amount), SCALES['fuel'])
+
+    index.append(record_date, scaled(unicode(record.total_cost),
+                                     SCALES['cost']), distance, fuel)
+    index.version = index.snapshot_version = version
+    cache.set(key, index, SNAPSHOT_TIMEOUT)
+
+
+def bucket_size(start, end):
+    """
+        Returns the number of seconds between the points of a chart of the
+        seconds since the epoch provided, so charts have at most about a
+        hundred points.
+    """
+    span = end - start
+    if span <= 62 * DAY:
+        return DAY
+    if span <= 732 * DAY:
+        return 7 * DAY
+    return 30 * DAY
+
+
+def cost_per_distance(index, start_date, end_date, windows=COST_WINDOWS):
+    """
+        Spread every cost of the car, payments and maintenance included, over
+        the distance driven in trailing windows of the days provided.
+        Returns a list of (days, points) with a [milliseconds, cost per
+        distance] point at the end of every bucket between the dates.  The
+        windows reach back before the start date, so yearly costs such as
+        insurance are spread over the year they cover.
+    """
+    start = timestamp(start_date)
+    end = timestamp(end_date)
+    step = bucket_size(start, end)
+
+    ends = []
+    point = start + step
+    while point < end:
+        ends.append(point)
+        point += step
+    ends.append(end)
+
+    dates = index.dates
+    cost = index.cost
+    distance = index.distance
+    cost_scale = float(SCALES['cost'])
+    distance_scale = float(SCALES['distance'])
+
+    results = []
+    for days in windows:
+        points = []
+        for point in ends:
+            low = bisect_right(dates, point - days * DAY)
+            high = bisect_right(dates, point)
+            driven = (distance[high] - distance[low]) / distance_scale
+            if driven > 0:
+                spent = (cost[high] - cost[low]) / cost_scale
+                points.append([int(point) * 1000, spent / driven])
+        results.append((days, points))
+    return results
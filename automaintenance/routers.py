@@ -0,0 +1,120 @@
+##
+# Automaintenance.  Django app to track automaintenance records.
+# Copyright (C) 2012 Robert Robinson
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+##
+from django.conf import settings
+
+from contextlib import contextmanager
+
+import threading
+import time
+
+
+# Alias of the database that read only views read from, reads go to the
+# default database if the alias isn't defined in DATABASES.
+REPLICA_DATABASE = getattr(settings, 'AUTOMAINTENANCE_REPLICA_DATABASE',
+                           'replica')
+
+# Number of seconds after a write that the reads of the same session stay on
+# the default database, so that users see their own changes.
+REPLICA_PIN_SECONDS = getattr(settings, 'AUTOMAINTENANCE_REPLICA_PIN_SECONDS',
+                              10)
+
+# Session key storing the time of the last write of the session.
+LAST_WRITE_SESSION_KEY = 'automaintenance_last_write'
+
+_state = threading.local()
+
+
+def replica_enabled():
+    """
+        Returns whether reads of the current thread go to the replica.
+    """
+    return getattr(_state, 'use_replica', False) and \
+        REPLICA_DATABASE in settings.DATABASES
+
+
+@contextmanager
+def replica_reads():
+    """
+        Send the reads of the automaintenance models made in the block to the
+        replica database.
+    """
+    previous = getattr(_state, 'use_replica', False)
+    _state.use_replica = True
+    try:
+        yield
+    finally:
+        _state.use_replica = previous
+
+
+def pinned_to_default(request):
+    """
+        Returns whether the session of the request wrote recently enough that
+        its reads should not go to the replica.
+    """
+    last_write = request.session.get(LAST_WRITE_SESSION_KEY, 0)
+    return time.time() - last_write < REPLICA_PIN_SECONDS
+
+
+def clear_writes():
+    """
+        Forget the writes made by the current thread.
+    """
+    _state.wrote = False
+
+
+def has_written():
+    """
+        Returns whether the current thread has written any automaintenance
+        models since the last call to clear_writes.
+    """
+    return getattr(_state, 'wrote', False)
+
+
+class ReplicaRouter(object):
+    """
+        Database router that sends the reads of the automaintenance models to
+        the replica database inside of replica_reads blocks.  Writes always go
+        to the default database.
+    """
+
+    def db_for_read(self, model, **hints):
+        """
+            Read from the replica when it has been requested.
+        """
+        if model._meta.app_label == 'automaintenance' and replica_enabled():
+            return REPLICA_DATABASE
+        return None
+
+    def db_for_write(self, model, **hints):
+        """
+            Remember that a write happened so that the following reads can be
+            pinned to the default database.
+        """
+        if model._meta.app_label == 'automaintenance':
+            _state.wrote = True
+        return None
+
+    def allow_relation(self, obj1, obj2, **hints):
+        """
+            Objects read from the replica are the same objects as the ones in
+            the default database.
+        """
+        databases = ('default', REPLICA_DATABASE)
+        if obj1._state.db in databases and obj2._state.db in databases:
+            return True
+        return None
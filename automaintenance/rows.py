@@ -0,0 +1,203 @@
+##
+# Automaintenance.  Django app to track automaintenance records.
+# Copyright (C) 2012 Robert Robinson
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+##
+from django.core.urlresolvers import reverse
+
+from automaintenance.models import GasolinePurchase, OilChange, Maintenance
+from automaintenance.models import Payment, RECORD_MODELS, PAYMENT_TYPES
+from automaintenance.archive import archived_records
+from automaintenance.fanout import fan_out
+from automaintenance.metrics import RECORD_ROWS
+
+
+PAYMENT_TYPE_NAMES = dict(PAYMENT_TYPES)
+
+
+class RecordRow(object):
+    """
+        Lightweight stand in for a record in the listings.  Only the columns
+        that the listings show are read from the database, and the car is
+        shared by every row instead of being looked up per row.
+    """
+    __slots__ = ('car', 'pk', 'date', 'sequence', 'mileage', 'total_cost',
+                 'archived')
+
+    # Model that the rows are read from, the columns of the model that are
+    # read after the primary key, date, sequence and total cost, and the
+    # names of the urls of the records.
+    model = None
+    columns = ('mileage',)
+    view_url = None
+    edit_url = None
+    delete_url = None
+
+    def __init__(self, car, pk, date, sequence, total_cost, *values):
+        self.car = car
+        self.pk = pk
+        self.date = date
+        self.sequence = sequence
+        self.total_cost = total_cost
+        self.archived = False
+        for name, value in zip(self.columns, values):
+            setattr(self, name, value)
+
+    def __cmp__(self, other):
+        """
+            Rows sort by date and sequence like the records.
+        """
+        return cmp((self.date, self.sequence), (other.date, other.sequence))
+
+    def __repr__(self):
+        return '<%s: %s %s>' % (self.__class__.__name__, self.model.__name__,
+                                self.pk)
+
+    def human_readable_type(self):
+        """
+            Returns a human readable type information for this object type.
+        """
+        return "Abstract"
+
+    def url_kwargs(self):
+        """
+            Arguments of the urls of the record.
+        """
+        return {'car_slug': self.car.slug, 'pk': self.pk}
+
+    def get_absolute_url(self):
+        """
+            Absolute URL for the detailed record.
+        """
+        return reverse(self.view_url, kwargs=self.url_kwargs())
+
+    def get_edit_url(self):
+        """
+            Define a url object for editing the record.
+        """
+        return reverse(self.edit_url, kwargs=self.url_kwargs())
+
+    def get_delete_url(self):
+        """
+            Define a url object for deleting the record.
+        """
+        return reverse(self.delete_url, kwargs=self.url_kwargs())
+
+
+class GasolinePurchaseRow(RecordRow):
+    """
+        Listing row of a gasoline purchase.
+    """
+    __slots__ = ('tank_mileage', 'price_per_unit', 'fuel_amount')
+
+    model = GasolinePurchase
+    columns = ('mileage', 'tank_mileage', 'price_per_unit', 'fuel_amount')
+    view_url = 'auto_gasolinepurchase_view_record'
+    edit_url = 'auto_maintenance_edit_gas_maintenance'
+    delete_url = 'auto_maintenance_delete_gas_maintenance'
+
+    def efficency(self):
+        return self.tank_mileage / self.fuel_amount
+
+    def human_readable_type(self):
+        return "Gasoline"
+
+
+class OilChangeRow(RecordRow):
+    """
+        Listing row of an oil change.
+    """
+    __slots__ = ()
+
+    model = OilChange
+    view_url = 'auto_oilchange_view_record'
+    edit_url = 'auto_maintenance_edit_oil_change'
+    delete_url = 'auto_maintenance_delete_oil_change'
+
+    def human_readable_type(self):
+        return "Oil Change"
+
+
+class MaintenanceRow(RecordRow):
+    """
+        Listing row of a maintenance record.
+    """
+    __slots__ = ('type',)
+
+    model = Maintenance
+    columns = ('mileage', 'type')
+    view_url = 'auto_maintenance_view_record'
+    edit_url = 'auto_maintenance_edit_scheduled_maintenance'
+    delete_url = 'auto_maintenance_delete_scheduled_maintenance'
+
+    def human_readable_type(self):
+        return self.type
+
+
+class PaymentRow(RecordRow):
+    """
+        Listing row of a payment, payments don't have a mileage.
+    """
+    __slots__ = ('type',)
+
+    model = Payment
+    columns = ('type',)
+    view_url = 'auto_oilchange_view_payment'
+    edit_url = 'auto_maintenance_edit_payment'
+    delete_url = 'auto_maintenance_delete_payment'
+
+    def human_readable_type(self):
+        return PAYMENT_TYPE_NAMES.get(self.type, self.type)
+
+
+ROW_CLASSES = dict((row_class.model, row_class) for row_class in
+                   (GasolinePurchaseRow, OilChangeRow, MaintenanceRow,
+                    PaymentRow))
+
+
+def record_rows(car, start_date=None, end_date=None, trip=None,
+                models=RECORD_MODELS):
+    """
+        Returns the listing rows of the records of the car, latest first.
+        Takes the same filters as the maintenance list of the car.  Archived
+        records are listed when the dates reach into the archives, their
+        rows are marked as archived since they can't be edited.
+    """
+    queries = []
+    for model in models:
+        row_class = ROW_CLASSES[model]
+        fields = ('pk', 'date', 'sequence', 'total_cost') + row_class.columns
+        query = car.maintenance_query(model, start_date, end_date, trip)
+        queries.append((list, (query.order_by().values_list(*fields),)))
+
+    results = fan_out(queries + [(archived_records, ([car.pk], start_date,
+                                                     end_date, trip))])
+    archived = results.pop()
+
+    rows = []
+    for model, model_rows in zip(models, results):
+        row_class = ROW_CLASSES[model]
+        fields = ('pk', 'date', 'sequence', 'total_cost') + row_class.columns
+        for values in model_rows:
+            rows.append(row_class(car, *values))
+
+        for record in archived[model]:
+            row = row_class(car, *[record[name] for name in fields])
+            row.archived = True
+            rows.append(row)
+
+    rows.sort(reverse=True)
+    RECORD_ROWS.inc(len(rows))
+    return rows
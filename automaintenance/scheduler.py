@@ -0,0 +1,325 @@
+##
+# Automaintenance.  Django app to track automaintenance records.
+# Copyright (C) 2012 Robert Robinson
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+##
+from django.conf import settings
+
+from automaintenance.models import GasolinePurchase, OilChange, Maintenance
+from automaintenance.models import ServiceDue, OIL_CHANGE_SERVICE
+from automaintenance.models import RecordArchive
+from automaintenance.archive import archived_records, archive_type, unpack
+
+from collections import defaultdict
+from datetime import timedelta
+
+
+# Intervals of the services that should not be inferred from the history of
+# the car.  Services that are not listed here are scheduled using the median
+# gap between the previous records of that service.
+DEFAULT_SERVICE_INTERVALS = {
+    OIL_CHANGE_SERVICE: {'mileage': 5000, 'days': 182},
+}
+
+SERVICE_INTERVALS = getattr(settings, 'AUTOMAINTENANCE_SERVICE_INTERVALS',
+                            DEFAULT_SERVICE_INTERVALS)
+
+# Number of days of odometer readings used to project the mileage of a car.
+MILEAGE_TREND_DAYS = getattr(settings, 'AUTOMAINTENANCE_MILEAGE_TREND_DAYS',
+                             90)
+
+# Number of the latest records of a service that its interval is inferred
+# from.  Saving a record only reads that many records of its service.
+SERVICE_HISTORY_RECORDS = getattr(settings,
+                                  'AUTOMAINTENANCE_SERVICE_HISTORY_RECORDS',
+                                  10)
+
+# Records that hold odometer readings.
+READING_MODELS = (GasolinePurchase, OilChange, Maintenance)
+
+
+def median(values):
+    """
+        Returns the median of the values provided.
+    """
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) // 2
+
+
+def mileage_rate(readings):
+    """
+        Returns the distance driven per day based on the recent odometer
+        readings, or None if there isn't a trend to project from.  The
+        readings are (date, mileage) tuples sorted by date.
+    """
+    readings = [reading for reading in readings if reading[1] > 0]
+    if len(readings) < 2:
+        return None
+
+    cutoff = readings[-1][0] - timedelta(days=MILEAGE_TREND_DAYS)
+    recent = [reading for reading in readings if reading[0] >= cutoff]
+    if len(recent) < 2:
+        recent = readings[-2:]
+
+    first, last = recent[0], recent[-1]
+    days = (last[0] - first[0]).total_seconds() / 86400.0
+    if days <= 0 or last[1] <= first[1]:
+        return None
+
+    return (last[1] - first[1]) / days
+
+
+def service_interval(service, history):
+    """
+        Returns the mileage and day intervals of the service.  Intervals that
+        are not configured are inferred from the latest records of the
+        history of the service.
+    """
+    history = history[-SERVICE_HISTORY_RECORDS:]
+    configured = SERVICE_INTERVALS.get(service, {})
+    interval_mileage = configured.get('mileage')
+    interval_days = configured.get('days')
+
+    pairs = list(zip(history, history[1:]))
+
+    if interval_days is None:
+        gaps = [(second[0] - first[0]).days for first, second in pairs]
+        gaps = [gap for gap in gaps if gap > 0]
+        if gaps:
+            interval_days = median(gaps)
+
+    if interval_mileage is None:
+        gaps = [second[1] - first[1] for first, second in pairs
+                if first[1] > 0]
+        gaps = [gap for gap in gaps if gap > 0]
+        if gaps:
+            interval_mileage = median(gaps)
+
+    return interval_mileage, interval_days
+
+
+def schedule_service(car_id, service, history, readings, intervals=None):
+    """
+        Build the service due row for the service, or None if the service
+        isn't recurring.  History holds the (date, mileage) of the previous
+        services and readings the odometer readings of the car.  The
+        (mileage, days) intervals are inferred from the history unless they
+        are provided.
+    """
+    if intervals is None:
+        intervals = service_interval(service, history)
+    interval_mileage, interval_days = intervals
+    last_date, last_mileage = history[-1]
+
+    service_due = ServiceDue(car_id=car_id, service=service,
+                             last_date=last_date, last_mileage=last_mileage,
+                             interval_mileage=interval_mileage,
+                             interval_days=interval_days)
+    candidates = []
+
+    if interval_days:
+        service_due.due_date = last_date + timedelta(days=interval_days)
+        candidates.append(service_due.due_date)
+
+    if interval_mileage and last_mileage:
+        service_due.due_mileage = last_mileage + interval_mileage
+
+        rate = mileage_rate(readings)
+        if rate:
+            reading_date, reading_mileage = max(
+                reading for reading in readings if reading[1] > 0)
+            remaining = max(service_due.due_mileage - reading_mileage, 0)
+            service_due.projected_mileage_date = reading_date + \
+                timedelta(days=remaining / rate)
+            candidates.append(service_due.projected_mileage_date)
+
+    if not candidates:
+        return None
+
+    service_due.next_due = min(candidates)
+    return service_due
+
+
+def refresh_service_due(car_ids=None):
+    """
+        Recompute the service due rows of the cars provided, or of every car
+        if no cars are provided, in one pass over the records and the
+        archived records.
+    """
+    if car_ids is not None:
+        car_ids = list(car_ids)
+
+    archived = archived_records(car_ids)
+
+    def records(model, *fields):
+        fields = ('car', 'date', 'mileage') + fields
+        query = model.objects.all()
+        if car_ids is not None:
+            query = query.filter(car__in=car_ids)
+        rows = list(query.order_by().values_list(*fields))
+        rows.extend(tuple(record[name] for name in fields)
+                    for record in archived[model])
+        rows.sort(key=lambda row: (row[0], row[1]))
+        return rows
+
+    readings = defaultdict(list)
+    histories = defaultdict(list)
+
+    for car_id, record_date, mileage in records(GasolinePurchase):
+        readings[car_id].append((record_date, mileage))
+
+    for car_id, record_date, mileage in records(OilChange):
+        readings[car_id].append((record_date, mileage))
+        histories[(car_id, OIL_CHANGE_SERVICE)].append((record_date, mileage))
+
+    for car_id, record_date, mileage, service in records(Maintenance, 'type'):
+        readings[car_id].append((record_date, mileage))
+        histories[(car_id, service)].append((record_date, mileage))
+
+    for car_readings in readings.values():
+        car_readings.sort()
+
+    service_due_list = []
+    for (car_id, service), history in histories.items():
+        service_due = schedule_service(car_id, service, history,
+                                       readings[car_id])
+        if service_due is not None:
+            service_due_list.append(service_due)
+
+    query = ServiceDue.objects.all()
+    if car_ids is not None:
+        query = query.filter(car__in=car_ids)
+    query.delete()
+
+    ServiceDue.objects.bulk_create(service_due_list)
+
+    return service_due_list
+
+
+def record_services(record):
+    """
+        Returns the services whose schedule depends on the record, or None if
+        the record doesn't change the schedule of the car.  Every record
+        with a mileage is a reading that the other services are projected
+        from.  A maintenance record that was moved to another type changes
+        the schedule of both.
+    """
+    if isinstance(record, OilChange):
+        return set([OIL_CHANGE_SERVICE])
+    if isinstance(record, Maintenance):
+        services = set([record.type])
+        previous = getattr(record, '_previous', None)
+        if previous is not None:
+            services.add(previous['type'])
+        return services
+    if isinstance(record, GasolinePurchase):
+        return set()
+    return None
+
+
+def service_history(car_id, service):
+    """
+        Returns the (date, mileage) of the latest records of the service for
+        the car, oldest first.  The latest archive of the car is only read
+        when the records left in the tables don't cover the history.
+    """
+    if service == OIL_CHANGE_SERVICE:
+        model = OilChange
+        query = OilChange.objects.filter(car=car_id)
+    else:
+        model = Maintenance
+        query = Maintenance.objects.filter(car=car_id, type=service)
+
+    history = list(query.order_by('-date', '-sequence').values_list(
+        'date', 'mileage')[:SERVICE_HISTORY_RECORDS])
+
+    if len(history) < SERVICE_HISTORY_RECORDS:
+        archives = RecordArchive.objects.filter(car=car_id).order_by('-year')
+        for data in archives.values_list('data', flat=True)[:1]:
+            history.extend((record['date'], record['mileage'])
+                           for record in unpack(data)[archive_type(model)]
+                           if model is OilChange or
+                           record['type'] == service)
+
+    history.sort()
+    return history[-SERVICE_HISTORY_RECORDS:]
+
+
+def recent_readings(car_id):
+    """
+        Returns the odometer readings of the car that its mileage rate is
+        projected from, the readings of the trend days before the latest
+        one and at least the last two, sorted by date.
+    """
+    queries = [model.objects.filter(car=car_id, mileage__gt=0).order_by()
+               for model in READING_MODELS]
+
+    latest = [reading_date for query in queries for reading_date in
+              query.order_by('-date').values_list('date', flat=True)[:1]]
+    if not latest:
+        return []
+
+    cutoff = max(latest) - timedelta(days=MILEAGE_TREND_DAYS)
+    readings = []
+    for query in queries:
+        readings.extend(query.filter(date__gte=cutoff).values_list(
+            'date', 'mileage'))
+    if len(readings) < 2:
+        for query in queries:
+            readings.extend(query.filter(date__lt=cutoff).order_by(
+                '-date').values_list('date', 'mileage')[:2])
+
+    readings.sort()
+    return readings
+
+
+def refresh_car_services(car_id, services):
+    """
+        Update the service due rows of the car after its records of the
+        services provided changed.  Those services are scheduled again from
+        their latest records, the other services of the car keep their
+        intervals and only have their projection updated from the recent
+        readings.  The refresh_service_due command rebuilds the rows from the
+        whole history.
+    """
+    readings = recent_readings(car_id)
+    existing = dict((service_due.service, service_due) for service_due in
+                    ServiceDue.objects.filter(car=car_id))
+
+    service_due_list = []
+    for service in set(services) | set(existing):
+        if service in services:
+            history = service_history(car_id, service)
+            if not history:
+                continue
+            service_due = schedule_service(car_id, service, history,
+                                           readings)
+        else:
+            previous = existing[service]
+            service_due = schedule_service(
+                car_id, service,
+                [(previous.last_date, previous.last_mileage)], readings,
+                (previous.interval_mileage, previous.interval_days))
+        if service_due is not None:
+            service_due_list.append(service_due)
+
+    ServiceDue.objects.filter(car=car_id).delete()
+    ServiceDue.objects.bulk_create(service_due_list)
+
+    return service_due_list
+
@@ -0,0 +1,349 @@
+##
+# Automaintenance.  Django app to track automaintenance records.
+# Copyright (C) 2012 Robert Robinson
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+##
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db import connections, router
+
+from automaintenance.models import Car, Trip, GasolinePurchase, OilChange
+from automaintenance.models import Maintenance, Payment
+
+import re
+
+
+# Text search configuration used by the PostgreSQL backend.
+SEARCH_CONFIG = getattr(settings, 'AUTOMAINTENANCE_SEARCH_CONFIG', 'english')
+
+# Largest number of results returned by one search.
+SEARCH_RESULTS = getattr(settings, 'AUTOMAINTENANCE_SEARCH_RESULTS', 50)
+
+# Name of the SQLite full text table.
+SEARCH_TABLE = 'automaintenance_search'
+
+# Number of type codes that fit in the row ids of the SQLite index, rows are
+# numbered pk * SEARCH_CODES + code so they can be found by record.
+SEARCH_CODES = 8
+
+
+class SearchSource(object):
+    """
+        A table that is searched, the columns holding its text and its date
+        and the code that tells its rows apart in the index.
+    """
+
+    def __init__(self, code, name, model, date_field, text_fields):
+        self.code = code
+        self.name = name
+        self.model = model
+        self.date_field = date_field
+        self.text_fields = text_fields
+
+    @property
+    def table(self):
+        return self.model._meta.db_table
+
+    def column(self, name):
+        return self.model._meta.get_field(name).column
+
+
+SEARCH_SOURCES = (
+    SearchSource(1, 'gasolinepurchase', GasolinePurchase, 'date',
+                 ('location', 'description')),
+    SearchSource(2, 'oilchange', OilChange, 'date',
+                 ('location', 'description')),
+    SearchSource(3, 'maintenance', Maintenance, 'date',
+                 ('location', 'description')),
+    SearchSource(4, 'payment', Payment, 'date', ('location', 'description')),
+    SearchSource(5, 'trip', Trip, 'start', ('name', 'description')),
+)
+
+# Search sources keyed by their name.
+SEARCH_TYPES = dict((source.name, source) for source in SEARCH_SOURCES)
+
+
+def search_terms(query):
+    """
+        Split the query into the words that are searched for.
+    """
+    return re.findall(r'\w+', query, re.UNICODE)
+
+
+class SQLiteSearch(object):
+    """
+        Search backed by one FTS5 table for every source.  Triggers on the
+        source tables keep the index up to date with every write, including
+        bulk inserts, updates and deletes that don't send model signals.
+    """
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.qn = connection.ops.quote_name
+
+    def text(self, source, row):
+        """
+            Returns the SQL expression of the text of a row of the source.
+        """
+        return " || ' ' || ".join("coalesce(%s.%s, '')" % (
+            row, self.qn(source.column(name))) for name in source.text_fields)
+
+    def values(self, source, row):
+        """
+            Returns the SQL expressions of the index columns of a row.
+        """
+        return '%s.%s * %d + %d, %s, %s.%s, %s.%s' % (
+            row, self.qn('id'), SEARCH_CODES, source.code,
+            self.text(source, row), row, self.qn(source.column('car')), row,
+            self.qn(source.column(source.date_field)))
+
+    def install_statements(self):
+        """
+            Returns the statements that create the index and its triggers.
+        """
+        qn = self.qn
+        table = qn(SEARCH_TABLE)
+        columns = 'rowid, body, car_id, date'
+
+        statements = [
+            'CREATE VIRTUAL TABLE IF NOT EXISTS %s USING fts5('
+            'body, car_id UNINDEXED, date UNINDEXED)' % table,
+        ]
+
+        for source in SEARCH_SOURCES:
+            watched = ', '.join(qn(source.column(name)) for name in
+                                source.text_fields +
+                                ('car', source.date_field))
+            delete = 'DELETE FROM %s WHERE rowid = old.%s * %d + %d;' % (
+                table, qn('id'), SEARCH_CODES, source.code)
+            insert = 'INSERT INTO %s (%s) VALUES (%s);' % (
+                table, columns, self.values(source, 'new'))
+            trigger = qn('%s_%s' % (SEARCH_TABLE, source.name) + '_%s')
+
+            statements.extend([
+                'CREATE TRIGGER IF NOT EXISTS %s AFTER INSERT ON %s '
+                'BEGIN %s END' % (trigger % 'insert', qn(source.table),
+                                  insert),
+                'CREATE TRIGGER IF NOT EXISTS %s AFTER UPDATE OF %s ON %s '
+                'BEGIN %s %s END' % (trigger % 'update', watched,
+                                     qn(source.table), delete, insert),
+                'CREATE TRIGGER IF NOT EXISTS %s AFTER DELETE ON %s '
+                'BEGIN %s END' % (trigger % 'delete', qn(source.table),
+                                  delete),
+            ])
+
+        return statements
+
+    def rebuild_statements(self):
+        """
+            Returns the statements that fill the index from the sources.
+        """
+        statements = ['DELETE FROM %s' % self.qn(SEARCH_TABLE)]
+        for source in SEARCH_SOURCES:
+            statements.append(
+                'INSERT INTO %s (rowid, body, car_id, date) SELECT %s FROM %s '
+                'AS source' % (self.qn(SEARCH_TABLE),
+                               self.values(source, 'source'),
+                               self.qn(source.table)))
+        return statements
+
+    def search(self, terms, car_ids, sources, start_date, end_date, limit):
+        """
+            Returns the (code, pk, rank) of the best matches, best first.
+        """
+        ops = self.connection.ops
+        match = ' '.join('"%s"' % term for term in terms)
+
+        sql = ['SELECT rowid, bm25(%s) AS rank FROM %s WHERE %s MATCH %%s' % (
+            self.qn(SEARCH_TABLE), self.qn(SEARCH_TABLE),
+            self.qn(SEARCH_TABLE))]
+        params = [match]
+
+        sql.append('AND car_id IN (%s)' % ', '.join(['%s'] * len(car_ids)))
+        params.extend(car_ids)
+
+        if len(sources) < len(SEARCH_SOURCES):
+            sql.append('AND rowid %%%% %d IN (%s)' % (
+                SEARCH_CODES, ', '.join(str(source.code)
+                                        for source in sources)))
+        if start_date is not None:
+            sql.append('AND date >= %s')
+            params.append(ops.value_to_db_datetime(start_date))
+        if end_date is not None:
+            sql.append('AND date <= %s')
+            params.append(ops.value_to_db_datetime(end_date))
+
+        sql.append('ORDER BY rank LIMIT %d' % limit)
+
+        cursor = self.connection.cursor()
+        cursor.execute(' '.join(sql), params)
+        return [(rowid % SEARCH_CODES, rowid // SEARCH_CODES, -rank)
+                for rowid, rank in cursor.fetchall()]
+
+
+class PostgreSQLSearch(object):
+    """
+        Search backed by a GIN index over the tsvector of every source table,
+        which PostgreSQL keeps up to date with every write.
+    """
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.qn = connection.ops.quote_name
+
+    def vector(self, source):
+        """
+            Returns the tsvector expression of the source, the searches have
+            to use the same expression as the index.
+        """
+        text = " || ' ' || ".join("coalesce(%s, '')" % self.qn(
+            source.column(name)) for name in source.text_fields)
+        return "to_tsvector('%s'::regconfig, %s)" % (SEARCH_CONFIG, text)
+
+    def install_statements(self):
+        """
+            Returns the statements that create the indexes.
+        """
+        return ['CREATE INDEX IF NOT EXISTS %s ON %s USING gin (%s)' % (
+            self.qn('%s_search' % source.table), self.qn(source.table),
+            self.vector(source)) for source in SEARCH_SOURCES]
+
+    def rebuild_statements(self):
+        """
+            Returns the statements that rebuild the indexes.
+        """
+        return ['REINDEX INDEX %s' % self.qn('%s_search' % source.table)
+                for source in SEARCH_SOURCES]
+
+    def search(self, terms, car_ids, sources, start_date, end_date, limit):
+        """
+            Returns the (code, pk, rank) of the best matches, best first.
+        """
+        selects = []
+        params = []
+
+        for source in sources:
+            date_column = self.qn(source.column(source.date_field))
+            sql = ["SELECT %d AS code, %s AS pk, ts_rank(%s, query) AS rank "
+                   "FROM %s, plainto_tsquery('%s'::regconfig, %%s) query "
+                   "WHERE %s @@ query" % (
+                       source.code, self.qn('id'), self.vector(source),
+                       self.qn(source.table), SEARCH_CONFIG,
+                       self.vector(source))]
+            params.append(' '.join(terms))
+
+            sql.append('AND %s IN (%s)' % (self.qn(source.column('car')),
+                                           ', '.join(['%s'] * len(car_ids))))
+            params.extend(car_ids)
+
+            if start_date is not None:
+                sql.append('AND %s >= %%s' % date_column)
+                params.append(start_date)
+            if end_date is not None:
+                sql.append('AND %s <= %%s' % date_column)
+                params.append(end_date)
+
+            selects.append(' '.join(sql))
+
+        cursor = self.connection.cursor()
+        cursor.execute('%s ORDER BY rank DESC LIMIT %d' % (
+            ' UNION ALL '.join(selects), limit), params)
+        return cursor.fetchall()
+
+
+SEARCH_BACKENDS = {
+    'sqlite': SQLiteSearch,
+    'postgresql': PostgreSQLSearch,
+}
+
+
+def search_backend(connection):
+    """
+        Returns the search backend of the database connection.
+    """
+    backend = SEARCH_BACKENDS.get(connection.vendor)
+    if backend is None:
+        raise ImproperlyConfigured('Record search is not available on %s '
+                                   'databases.' % connection.vendor)
+    return backend(connection)
+
+
+def install_search_index(using, rebuild=False):
+    """
+        Create the search index of the database if it doesn't exist yet, and
+        fill it from the records when rebuild is set.
+    """
+    connection = connections[using]
+    if connection.vendor not in SEARCH_BACKENDS:
+        return
+
+    backend = search_backend(connection)
+    statements = backend.install_statements()
+    if rebuild:
+        statements += backend.rebuild_statements()
+
+    cursor = connection.cursor()
+    for statement in statements:
+        cursor.execute(statement)
+
+
+def search(owner, query, car=None, types=None, start_date=None, end_date=None,
+           limit=SEARCH_RESULTS):
+    """
+        Search the records and trips of the car, or of every car of the
+        owner, for the words of the query.  Returns the matching records and
+        trips best match first, each with a search_rank attribute.
+    """
+    terms = search_terms(query)
+    if not terms:
+        return []
+
+    if car is not None:
+        car_ids = [car.pk]
+    else:
+        car_ids = list(Car.objects.filter(owner=owner).values_list('pk',
+                                                                   flat=True))
+    if not car_ids:
+        return []
+
+    sources = [source for source in SEARCH_SOURCES
+               if not types or source.name in types]
+    if not sources:
+        return []
+
+    connection = connections[router.db_for_read(Trip)]
+    matches = search_backend(connection).search(terms, car_ids, sources,
+                                                start_date, end_date, limit)
+
+    codes = dict((source.code, source) for source in SEARCH_SOURCES)
+    pks = {}
+    for code, pk, rank in matches:
+        pks.setdefault(code, []).append(pk)
+
+    objects = {}
+    for code, code_pks in pks.items():
+        model = codes[code].model
+        for pk, instance in model.objects.select_related('car').in_bulk(
+                code_pks).items():
+            objects[(code, pk)] = instance
+
+    results = []
+    for code, pk, rank in matches:
+        instance = objects.get((code, pk))
+        if instance is not None:
+            instance.search_rank = rank
+            instance.search_type = codes[code].name
+            results.append(instance)
+    return results
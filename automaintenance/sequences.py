@@ -0,0 +1,115 @@
+##
+# Automaintenance.  Django app to track automaintenance records.
+# Copyright (C) 2012 Robert Robinson
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+##
+from collections import defaultdict
+
+
+# Number of values looked up per query, which keeps the queries under the
+# parameter limits of the databases.
+LOOKUP_CHUNK_SIZE = 500
+
+
+def chunks(values):
+    """
+        Split the values into lists small enough to be used in one query.
+    """
+    values = list(values)
+    for start in range(0, len(values), LOOKUP_CHUNK_SIZE):
+        yield values[start:start + LOOKUP_CHUNK_SIZE]
+
+
+def matching_rows(model, pairs, *fields):
+    """
+        Returns the car, date and the fields provided of the records of the
+        model that match the (car_id, date) pairs.  The records are looked up
+        one car at a time so the lookups use the car and date index.
+    """
+    dates = defaultdict(set)
+    for car_id, record_date in pairs:
+        dates[car_id].add(record_date)
+
+    for car_id, car_dates in dates.items():
+        for chunk in chunks(car_dates):
+            query = model._default_manager.filter(car=car_id, date__in=chunk)
+            for row in query.values_list('car', 'date', *fields):
+                yield row
+
+
+def taken_sequences(model, pairs, exclude=()):
+    """
+        Returns the sequence numbers used by the records of the model for
+        every (car_id, date) pair provided.
+    """
+    exclude = set(exclude)
+    taken = defaultdict(set)
+    for car_id, record_date, sequence, pk in matching_rows(model, pairs,
+                                                           'sequence', 'pk'):
+        if pk not in exclude:
+            taken[(car_id, record_date)].add(sequence)
+    return taken
+
+
+def next_sequences(taken, entries):
+    """
+        Entries are ((car_id, date), sequence) pairs in the order they are
+        written and taken holds the sequences already used for every pair.
+        Returns the new sequence of the entries that collide by index.  The
+        entries that come first keep their sequence, the ones that collide
+        are numbered after the highest sequence of their date.
+    """
+    conflicting = []
+    for index, (key, sequence) in enumerate(entries):
+        if sequence in taken[key]:
+            conflicting.append(index)
+        else:
+            taken[key].add(sequence)
+
+    renumbered = {}
+    for index in conflicting:
+        key = entries[index][0]
+        renumbered[index] = max(taken[key]) + 1
+        taken[key].add(renumbered[index])
+
+    return renumbered
+
+
+def assign_sequence(record):
+    """
+        Give the record the next sequence number of its car and date if
+        another record of the same type already uses its sequence.
+    """
+    exclude = [record.pk] if record.pk is not None else []
+    key = (record.car_id, record.date)
+    taken = taken_sequences(record.__class__, [key], exclude)
+
+    renumbered = next_sequences(taken, [(key, record.sequence)])
+    if renumbered:
+        record.sequence = renumbered[0]
+
+
+def assign_sequences(model, records):
+    """
+        Number the unsaved records of the model so that they don't collide
+        with each other or with the records that are already stored.
+    """
+    keys = [(record.car_id, record.date) for record in records]
+    taken = taken_sequences(model, keys)
+
+    renumbered = next_sequences(taken, [(key, record.sequence) for key, record
+                                        in zip(keys, records)])
+    for index, sequence in renumbered.items():
+        records[index].sequence = sequence
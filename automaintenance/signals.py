@@ -0,0 +1,224 @@
+##
+# Automaintenance.  Django app to track automaintenance records.
+# Copyright (C) 2012 Robert Robinson
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+##
+from django.core.signals import request_finished
+from django.db.models.signals import pre_save, post_save, pre_delete
+from django.db.models.signals import post_delete
+from django.db.models.signals import post_syncdb
+from django.dispatch import Signal, receiver
+
+from automaintenance.models import Car, Trip, ServiceDue
+from automaintenance.models import RECORD_MODELS
+from automaintenance.models import CHANGE_CREATE, CHANGE_UPDATE, CHANGE_DELETE
+from automaintenance.caching import bump_record_versions
+from automaintenance.sequences import assign_sequence
+from automaintenance.changes import log_changes
+
+
+# Sent once for every change to the maintenance history of one or more cars.
+# Anything that keeps derived data about the records of a car should listen
+# to this signal instead of the per row model signals, bulk operations only
+# send this signal once per batch.  Changes of a single record also provide
+# the record and whether it was deleted, so that the listeners can apply the
+# change of that record instead of recounting the records of the car.  Its
+# values before an update are in its _previous attribute.
+car_records_changed = Signal(providing_args=['car_ids', 'record', 'deleted'])
+
+
+def notify_records_changed(car_ids, record=None, deleted=False):
+    """
+        Let the listeners know that the records of the cars provided have
+        changed.
+    """
+    car_ids = set(car_ids)
+    if car_ids:
+        car_records_changed.send(sender=None, car_ids=car_ids, record=record,
+                                 deleted=deleted)
+
+
+def record_changed(sender, instance, **kwargs):
+    """
+        Translate the model signals of the records into the car records
+        changed signal.
+    """
+    if not kwargs.get('raw', False):
+        bump_record_versions(sender, [instance.pk])
+        notify_records_changed([instance.car_id], instance,
+                               deleted='created' not in kwargs)
+
+def record_saving(sender, instance, **kwargs):
+    """
+        Records of a car at the same date are told apart by their sequence
+        number, pick one that isn't used yet.  The stored values of a record
+        that is updated are kept for the listeners of the change.
+    """
+    if not kwargs.get('raw', False):
+        assign_sequence(instance)
+        instance._previous = None
+        if instance.pk is not None:
+            for values in sender._default_manager.filter(
+                    pk=instance.pk).values():
+                instance._previous = values
+
+def record_created(sender, instance, created, **kwargs):
+    """
+        New records are appended to the range index of their car, this runs
+        after the version of the car was bumped for the record.
+    """
+    if created and not kwargs.get('raw', False):
+        from automaintenance.ranges import append_record
+        append_record(instance)
+
+for record_model in RECORD_MODELS:
+    pre_save.connect(record_saving, sender=record_model)
+    post_save.connect(record_changed, sender=record_model)
+    post_save.connect(record_created, sender=record_model)
+    post_delete.connect(record_changed, sender=record_model)
+
+
+@receiver(car_records_changed)
+def update_service_due(sender, car_ids, record=None, **kwargs):
+    """
+        Keep the service due table up to date with the records of the cars.
+        A single record only schedules its services again, the cars of bulk
+        changes are rebuilt.
+    """
+    from automaintenance.scheduler import refresh_service_due
+    from automaintenance.scheduler import refresh_car_services
+    from automaintenance.scheduler import record_services
+    if record is None:
+        refresh_service_due(car_ids)
+    else:
+        services = record_services(record)
+        if services is not None:
+            refresh_car_services(record.car_id, services)
+
+
+@receiver([pre_delete, post_delete], sender=Car)
+def car_deleted(sender, instance, **kwargs):
+    """
+        Removing the records of a car refreshes its service due rows and its
+        version, so clean them up again once the car itself is gone.  The
+        last version is kept before the version rows go, and the location
+        counts of the car are dropped before its records go.
+    """
+    from automaintenance.versions import retire_car_versions
+    from automaintenance.locations import forget_locations
+    retire_car_versions([instance.pk])
+    if kwargs['signal'] is pre_delete:
+        forget_locations([instance.pk])
+    else:
+        ServiceDue.objects.filter(car=instance.pk).delete()
+
+
+@receiver(car_records_changed)
+def update_report_jobs(sender, car_ids, **kwargs):
+    """
+        Finished report jobs are out of date once the records change.
+    """
+    from automaintenance.jobs import expire_report_jobs
+    expire_report_jobs(car_ids)
+
+
+@receiver(request_finished)
+def queue_report_jobs(sender, **kwargs):
+    """
+        The report jobs created in the transaction of the request can run
+        now that it is committed.
+    """
+    from automaintenance.jobs import queue_deferred_jobs
+    queue_deferred_jobs()
+
+
+@receiver(car_records_changed)
+def update_car_versions(sender, car_ids, **kwargs):
+    """
+        The data shown for the cars changed.
+    """
+    from automaintenance.versions import bump_car_versions
+    bump_car_versions(car_ids)
+
+
+@receiver(car_records_changed)
+def update_locations(sender, car_ids, record=None, deleted=False, **kwargs):
+    """
+        Keep the location dictionaries up to date with the records.  A single
+        record only changes the counts of its locations, the cars of bulk
+        changes are recounted.
+    """
+    from automaintenance.locations import refresh_locations, count_location
+    if record is None:
+        refresh_locations(car_ids)
+    else:
+        count_location(record, deleted)
+
+
+@receiver(post_save, sender=Car)
+def car_saved(sender, instance, **kwargs):
+    """
+        Changing the car changes the data shown for it.
+    """
+    if not kwargs.get('raw', False):
+        from automaintenance.versions import bump_car_versions
+        bump_car_versions([instance.pk])
+
+
+@receiver([post_save, post_delete], sender=Trip)
+def trip_changed(sender, instance, **kwargs):
+    """
+        Trips are shown on the car page, and removing a trip changes the
+        records that were part of it.
+    """
+    if not kwargs.get('raw', False):
+        from automaintenance.versions import bump_car_versions
+        bump_car_versions([instance.car_id])
+
+
+def change_logged(sender, instance, **kwargs):
+    """
+        Append the change of the car, trip or record to the change feed.
+        Bulk operations log their changes themselves.
+    """
+    if kwargs.get('raw', False):
+        return
+
+    if 'created' not in kwargs:
+        action = CHANGE_DELETE
+    elif kwargs['created']:
+        action = CHANGE_CREATE
+    else:
+        action = CHANGE_UPDATE
+
+    if sender is Car:
+        log_changes(sender, action, [(instance.pk, instance.pk)],
+                    owners={instance.pk: instance.owner_id})
+    else:
+        log_changes(sender, action, [(instance.pk, instance.car_id)])
+
+for change_model in (Car, Trip) + RECORD_MODELS:
+    post_save.connect(change_logged, sender=change_model)
+    post_delete.connect(change_logged, sender=change_model)
+
+
+@receiver(post_syncdb)
+def install_search(sender, **kwargs):
+    """
+        Create the search index along with the tables of the records.
+    """
+    if sender.__name__ == Car.__module__:
+        from automaintenance.search import install_search_index
+        install_search_index(kwargs.get('db', 'default'))
@@ -0,0 +1,289 @@
+##
+# Automaintenance.  Django app to track automaintenance records.
+# Copyright (C) 2012 Robert Robinson
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+##
+from django.conf import settings
+from django.core.cache import cache
+
+from automaintenance.models import GasolinePurchase, OilChange, Maintenance
+from automaintenance.models import Payment, PAYMENT_TYPES
+from automaintenance.versions import car_data_version
+from automaintenance.archive import archived_records
+from automaintenance.metrics import cache_lookups
+
+from array import array
+from bisect import bisect_left, bisect_right
+from calendar import timegm
+from decimal import Decimal
+
+
+# Number of seconds that the snapshots of the cars are cached.  Snapshots are
+# cached by the version of the car, so they never need to be invalidated.
+SNAPSHOT_TIMEOUT = getattr(settings, 'AUTOMAINTENANCE_SNAPSHOT_TIMEOUT',
+                           60 * 60 * 24)
+
+# Type codes of the records in the snapshots.
+TYPE_GASOLINE = 0
+TYPE_OIL_CHANGE = 1
+TYPE_MAINTENANCE = 2
+TYPE_PAYMENT = 3
+
+# Columns of the snapshots and the typecodes of their arrays.  Dates are
+# seconds since the epoch in UTC, costs are in cents and the fuel amount,
+# tank mileage and price per unit are in thousandths.
+COLUMNS = (
+    ('date', 'd'),
+    ('type', 'b'),
+    ('pk', 'l'),
+    ('trip', 'l'),
+    ('category', 'l'),
+    ('mileage', 'l'),
+    ('cost', 'l'),
+    ('fuel', 'l'),
+    ('distance', 'l'),
+    ('price', 'l'),
+)
+
+# Divisors that turn the integer columns back into their decimal values.
+SCALES = {
+    'cost': 100,
+    'fuel': 1000,
+    'distance': 1000,
+    'price': 1000,
+}
+
+PAYMENT_TYPE_NAMES = dict(PAYMENT_TYPES)
+
+
+def timestamp(value):
+    """
+        Returns the seconds since the epoch of the aware datetime.
+    """
+    return timegm(value.utctimetuple()) + value.microsecond / 1000000.0
+
+
+def scaled(value, scale):
+    """
+        Returns the decimal value as an integer number of 1/scale units.
+    """
+    return int((Decimal(value) * scale).to_integral_value())
+
+
+class CarSnapshot(object):
+    """
+        Columns of the maintenance history of a car stored in arrays and
+        sorted by date.  The methods work on whole columns, so reports don't
+        create an object per record.  Version is the data version of the car
+        that the whole history was read at, None when it isn't known.
+    """
+    version = None
+
+    def __init__(self, categories=(), version=None, **columns):
+        self.categories = list(categories)
+        self.version = version
+        for name, typecode in COLUMNS:
+            setattr(self, name, columns.get(name, array(typecode)))
+
+    def __len__(self):
+        return len(self.date)
+
+    def take(self, indexes):
+        """
+            Returns a snapshot of the rows at the indexes.
+        """
+        columns = {}
+        for name, typecode in COLUMNS:
+            column = getattr(self, name)
+            columns[name] = array(typecode, [column[index]
+                                             for index in indexes])
+        return CarSnapshot(self.categories, **columns)
+
+    def between(self, start_date=None, end_date=None):
+        """
+            Returns the rows between the dates, found by bisecting the dates.
+        """
+        low = 0
+        high = len(self)
+        if start_date is not None:
+            low = bisect_left(self.date, timestamp(start_date))
+        if end_date is not None:
+            high = bisect_right(self.date, timestamp(end_date))
+
+        columns = dict((name, getattr(self, name)[low:high])
+                       for name, typecode in COLUMNS)
+        return CarSnapshot(self.categories, **columns)
+
+    def select(self, types=None, trip=None):
+        """
+            Returns the rows of the record types and trip provided.
+        """
+        indexes = range(len(self))
+        if types is not None:
+            record_types = self.type
+            indexes = [index for index in indexes
+                       if record_types[index] in types]
+        if trip is not None:
+            trips = self.trip
+            indexes = [index for index in indexes if trips[index] == trip]
+        return self.take(indexes)
+
+    def total(self, column):
+        """
+            Returns the sum of the column as a decimal.
+        """
+        return self.decimal(column, sum(getattr(self, column)))
+
+    def decimal(self, column, value):
+        """
+            Turn a value of the integer column back into a decimal.
+        """
+        if column in SCALES:
+            return Decimal(value) / SCALES[column]
+        return Decimal(value)
+
+    def group_by(self, key, column):
+        """
+            Returns the sums of the column grouped by the values of the key
+            column.  Categories are returned by name.
+        """
+        groups = {}
+        for group, value in zip(getattr(self, key), getattr(self, column)):
+            groups[group] = groups.get(group, 0) + value
+
+        if key == 'category':
+            groups = dict((self.categories[group], value)
+                          for group, value in groups.items())
+        return dict((group, self.decimal(column, value))
+                    for group, value in groups.items())
+
+    def values(self, name):
+        """
+            Returns the values of the field of the gasoline records with the
+            same name, efficency is the tank mileage over the fuel amount.
+        """
+        if name == 'efficency':
+            return [float(distance) / fuel if fuel else 0.0
+                    for distance, fuel in zip(self.distance, self.fuel)]
+
+        column, scale = {'price_per_unit': ('price', 1000.0),
+                         'tank_mileage': ('distance', 1000.0),
+                         'fuel_amount': ('fuel', 1000.0),
+                         'total_cost': ('cost', 100.0),
+                         'mileage': ('mileage', 1.0)}[name]
+        return [value / scale for value in getattr(self, column)]
+
+    def series(self, name):
+        """
+            Returns the values of the field as [milliseconds, value] points.
+        """
+        return [[int(record_date) * 1000, value] for record_date, value in
+                zip(self.date, self.values(name))]
+
+
+def build_snapshot(car_id):
+    """
+        Build the snapshot of the car with one values query per record type,
+        along with the archived records of the car.
+    """
+    archived = archived_records([car_id])
+
+    def records(model, *fields):
+        fields = ('date', 'sequence', 'pk', 'trip', 'total_cost') + fields
+        rows = list(model.objects.filter(car=car_id).order_by().values_list(
+            *fields))
+        rows.extend(tuple(record[name] for name in fields)
+                    for record in archived[model])
+        return rows
+
+    rows = []
+    for record_date, sequence, pk, trip, cost, mileage, fuel, distance, \
+            price in records(GasolinePurchase, 'mileage', 'fuel_amount',
+                             'tank_mileage', 'price_per_unit'):
+        rows.append((record_date, sequence, TYPE_GASOLINE, pk, trip,
+                     'Gasoline', mileage, cost, fuel, distance, price))
+
+    for record_date, sequence, pk, trip, cost, mileage in records(
+            OilChange, 'mileage'):
+        rows.append((record_date, sequence, TYPE_OIL_CHANGE, pk, trip,
+                     'Oil Change', mileage, cost, 0, 0, 0))
+
+    for record_date, sequence, pk, trip, cost, mileage, category in records(
+            Maintenance, 'mileage', 'type'):
+        rows.append((record_date, sequence, TYPE_MAINTENANCE, pk, trip,
+                     category, mileage, cost, 0, 0, 0))
+
+    for record_date, sequence, pk, trip, cost, category in records(
+            Payment, 'type'):
+        rows.append((record_date, sequence, TYPE_PAYMENT, pk, trip,
+                     PAYMENT_TYPE_NAMES.get(category, category), 0, cost, 0,
+                     0, 0))
+
+    rows.sort(key=lambda row: (row[0], row[1], row[2]))
+
+    categories = {}
+    columns = dict((name, array(typecode)) for name, typecode in COLUMNS)
+    for record_date, sequence, record_type, pk, trip, category, mileage, \
+            cost, fuel, distance, price in rows:
+        columns['date'].append(timestamp(record_date))
+        columns['type'].append(record_type)
+        columns['pk'].append(pk)
+        columns['trip'].append(trip or 0)
+        columns['category'].append(categories.setdefault(category,
+                                                         len(categories)))
+        columns['mileage'].append(mileage)
+        columns['cost'].append(scaled(cost, 100))
+        columns['fuel'].append(scaled(fuel, 1000))
+        columns['distance'].append(scaled(distance, 1000))
+        columns['price'].append(scaled(price, 1000))
+
+    names = sorted(categories, key=categories.get)
+    return CarSnapshot(names, **columns)
+
+
+def snapshot_key(car_id, version):
+    """
+        Returns the cache key of the snapshot of a version of the car.
+    """
+    return 'automaintenance:snapshot:%s:%s' % (car_id, version)
+
+
+def car_snapshot(car):
+    """
+        Returns the snapshot of the current version of the car, built once
+        per version and then read from the cache, or from the fleet snapshot
+        file of the owner when a directory is set for those.  The cache is
+        used while another process rebuilds the file of the owner.
+    """
+    from automaintenance.fleet import FLEET_SNAPSHOT_DIR, fleet_snapshot
+    if FLEET_SNAPSHOT_DIR:
+        fleet = fleet_snapshot(car.owner_id)
+        if fleet is not None:
+            return fleet.car(car.pk)
+
+    version = car_data_version(car.pk)
+    key = snapshot_key(car.pk, version)
+    snapshot = cache.get(key)
+    if snapshot is None:
+        cache_lookups('snapshots', misses=1)
+        snapshot = build_snapshot(car.pk)
+        # A change that commits while the snapshot is built can be part of
+        # it without being part of the version, such a snapshot isn't kept.
+        if car_data_version(car.pk) == version:
+            snapshot.version = version
+            cache.set(key, snapshot, SNAPSHOT_TIMEOUT)
+    else:
+        cache_lookups('snapshots', hits=1)
+    return snapshot
@@ -0,0 +1,68 @@
+##
+# Automaintenance.  Django app to track automaintenance records.
+# Copyright (C) 2012 Robert Robinson
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+##
+from django import template
+from django.core.cache import cache
+from django.template.loader import render_to_string
+from django.utils.safestring import mark_safe
+from django.utils.timezone import get_current_timezone_name
+from django.utils.translation import get_language
+
+from automaintenance.caching import record_type, record_versions
+from automaintenance.caching import ROW_CACHE_TIMEOUT
+from automaintenance.metrics import cache_lookups
+
+register = template.Library()
+
+
+def row_cache_key(record, version, car, hide_edit):
+    """
+        Returns the cache key of the rendered row of a record.  The row also
+        depends on the car slug of its urls, the currency of the car and how
+        dates are displayed.
+    """
+    return 'automaintenance:row:%s:%s:%s:%s:%s:%s:%s:%s' % (
+        record_type(record), record.pk, version, car.slug, car.currency,
+        bool(hide_edit), get_current_timezone_name(), get_language())
+
+
+@register.simple_tag(takes_context=True)
+def maintenance_rows(context, maintenance_list, car, hide_edit=False):
+    """
+        Renders the table rows of the records, only rendering the rows that
+        changed since they were cached.
+    """
+    records = list(maintenance_list)
+    versions = record_versions(records)
+
+    keys = [row_cache_key(record, versions[(record_type(record), record.pk)],
+                          car, hide_edit) for record in records]
+    rows = cache.get_many(keys)
+
+    rendered = {}
+    for key, record in zip(keys, records):
+        if key not in rows:
+            rendered[key] = render_to_string(
+                'automaintenance/maintenance_row.html',
+                {'record': record, 'car': car, 'hide_edit': hide_edit})
+    if rendered:
+        cache.set_many(rendered, ROW_CACHE_TIMEOUT)
+        rows.update(rendered)
+    cache_lookups('rows', hits=len(keys) - len(rendered),
+                  misses=len(rendered))
+
+    return mark_safe(''.join(rows[key] for key in keys))
@@ -16,18 +16,1365 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 ##
 """
-This file demonstrates writing tests using the unittest module. These will pass
-when you run "manage.py test".
-
-Replace this with more appropriate tests for your application.
+Tests of the automaintenance app, run with "manage.py test automaintenance".
 """
 
 from django.test import TestCase
+from django.test.client import RequestFactory
+from django.conf import settings
+from django.contrib import admin
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.urlresolvers import reverse, resolve
+from django.http import HttpResponse
+from django.utils.timezone import now
+from django.views.generic import View
+
+from automaintenance.models import Car, OilChange, Maintenance, ServiceDue
+from automaintenance.models import Trip
+from automaintenance.models import GasolinePurchase, Payment
+from automaintenance.models import OIL_CHANGE_SERVICE, RecordArchive
+from automaintenance.models import ReportJob, IngestionKey, Location
+from automaintenance.models import Change
+from automaintenance.rows import record_rows
+from automaintenance.admin import RecordAdmin, EstimatedCountChangeList
+from automaintenance.admin import CarAdmin, TripAdmin
+from automaintenance.admin import EstimatedCountPaginator
+from automaintenance.routers import ReplicaRouter, LAST_WRITE_SESSION_KEY
+from automaintenance.routers import clear_writes, has_written
+from automaintenance.views.mixins import ReplicaReadMixin
+from automaintenance.caching import record_type, record_versions
+from automaintenance.templatetags.maintenance_rows import maintenance_rows
+from automaintenance.templatetags.maintenance_rows import row_cache_key
+from automaintenance.changes import compact_changes
+from automaintenance.locations import normalize_location, refresh_locations
+from automaintenance.locations import complete_location
+from automaintenance.archive import archive_records
+from automaintenance.snapshots import build_snapshot, car_snapshot
+from automaintenance.snapshots import TYPE_GASOLINE, TYPE_OIL_CHANGE
+from automaintenance.snapshots import TYPE_MAINTENANCE
+from automaintenance import changes, fanout, fleet, jobs, ingestion
+from automaintenance import profiling
+from automaintenance.sequences import assign_sequences, matching_rows
+from automaintenance.views import api
+from automaintenance.ranges import range_index, range_index_key
+from automaintenance.ranges import RangeIndex
+from automaintenance.ranges import cost_per_distance
+from automaintenance.versions import car_data_version, car_data_versions
+from automaintenance.prices import price_statistics, car_price_statistics
+from automaintenance.prices import fleet_price_statistics
+from automaintenance.deletion import delete_car, delete_trip, hide_car
+from automaintenance.deletion import hide_trip, purge_deleted
+from automaintenance.loadtest import summarize, ROUTES
+from automaintenance.scheduler import refresh_service_due
+from automaintenance import metrics
+
+from datetime import timedelta
+from decimal import Decimal
+import base64
+import json
+import os
+import random
+import shutil
+import subprocess
+import tempfile
+import time
+
+
+class CarTestCase(TestCase):
+    """
+        Base of the tests that need an owner with a car.  The cache is cleared
+        so that nothing cached by an earlier test is read.
+    """
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user('owner', 'owner@example.com',
+                                             'password')
+        self.car = Car.objects.create(slug='car', name='Car', owner=self.user)
+
+
+class ServiceDueTest(CarTestCase):
+    def test_oil_change_scheduled_on_save(self):
+        """
+        Saving an oil change schedules the next one from the configured
+        interval.
+        """
+        last_date = now() - timedelta(days=10)
+        OilChange.objects.create(car=self.car, date=last_date, mileage=1000)
 
+        service_due = ServiceDue.objects.get(car=self.car,
+                                             service=OIL_CHANGE_SERVICE)
+        self.assertEqual(service_due.due_mileage, 6000)
+        self.assertEqual(service_due.next_due, last_date + timedelta(days=182))
 
-class SimpleTest(TestCase):
-    def test_basic_addition(self):
+    def test_recurring_maintenance_interval_inferred(self):
         """
-        Tests that 1 + 1 always equals 2.
+        Maintenance types only become recurring once there is more than one
+        record to infer the interval from.
+        """
+        start = now() - timedelta(days=400)
+        Maintenance.objects.create(car=self.car, date=start, mileage=1000,
+                                   type='Tires')
+        self.assertFalse(ServiceDue.objects.filter(service='Tires').exists())
+
+        Maintenance.objects.create(car=self.car,
+                                   date=start + timedelta(days=300),
+                                   mileage=11000, type='Tires')
+        service_due = ServiceDue.objects.get(service='Tires')
+        self.assertEqual(service_due.interval_days, 300)
+        self.assertEqual(service_due.due_mileage, 21000)
+
+    def test_saves_match_rebuild(self):
+        """
+        The rows updated on every save are the rows that the full rebuild
+        computes, moving a record to another service schedules both.
+        """
+        start = now() - timedelta(days=400)
+        for days in range(0, 400, 50):
+            GasolinePurchase.objects.create(car=self.car,
+                date=start + timedelta(days=days), mileage=1000 + days * 30)
+        OilChange.objects.create(car=self.car, date=start, mileage=1000)
+        for days in (0, 150, 300):
+            Maintenance.objects.create(car=self.car,
+                date=start + timedelta(days=days, hours=1),
+                mileage=1000 + days * 30, type='Tires')
+        record = Maintenance.objects.get(type='Tires', mileage=1000)
+        record.type = 'Brakes'
+        record.save()
+
+        def rows():
+            return sorted(ServiceDue.objects.filter(car=self.car).values_list(
+                'service', 'due_mileage', 'interval_days', 'next_due'))
+
+        saved = rows()
+        refresh_service_due([self.car.pk])
+        self.assertEqual(saved, rows())
+        self.assertEqual([row[0] for row in saved],
+                         [OIL_CHANGE_SERVICE, 'Tires'])
+        self.assertEqual(saved[1][2], 150)
+
+
+class QueuedPool(object):
+    """
+        Pool that keeps the jobs until the test runs them.
+    """
+
+    def __init__(self):
+        self.queued = []
+
+    def apply_async(self, func, args):
+        self.queued.append((func, args))
+
+    def run(self):
+        while self.queued:
+            func, args = self.queued.pop(0)
+            func(*args)
+
+
+class InlineResult(object):
+    """
+        Result of a task that ran when it was submitted.
+    """
+
+    def __init__(self, func, args):
+        self.error = None
+        try:
+            self.value = func(*args)
+        except Exception as error:
+            self.error = error
+
+    def get(self):
+        if self.error is not None:
+            raise self.error
+        return self.value
+
+
+class InlinePool(object):
+    """
+        Pool that runs the tasks on the current thread, whose connection
+        sees the test database.
+    """
+
+    def apply_async(self, func, args):
+        return InlineResult(func, args)
+
+
+class ReportJobTest(CarTestCase):
+    def setUp(self):
+        super(ReportJobTest, self).setUp()
+        self.client.login(username='owner', password='password')
+        self.previous = jobs._pool
+        jobs._pool = self.pool = QueuedPool()
+
+    def tearDown(self):
+        jobs._pool = self.previous
+
+    def test_job_runs_once(self):
+        """
+        Identical requests share a pending job, which holds the report once
+        it ran and is expired when the records change.
+        """
+        GasolinePurchase.objects.create(car=self.car, date=now(),
+            mileage=1000, tank_mileage='300.000', fuel_amount='10.000',
+            price_per_unit='3.000', total_cost='30.00')
+        url = reverse('auto_maintenance_submit_report_job',
+                      kwargs={'car_slug': 'car', 'report': 'mpg'})
+
+        first = json.loads(self.client.get(url).content)
+        second = json.loads(self.client.get(url).content)
+        self.assertEqual((first['status'], second['id']),
+                         ('pending', first['id']))
+        self.assertEqual(len(self.pool.queued), 1)
+
+        self.pool.run()
+        done = json.loads(self.client.get(first['url']).content)
+        self.assertEqual(done['status'], 'done')
+        self.assertTrue('result' in done)
+
+        OilChange.objects.create(car=self.car, date=now())
+        self.assertFalse(ReportJob.objects.exists())
+
+    def test_changed_while_running(self):
+        """
+        A record saved while a job runs gets its own job, and a job lost
+        with its worker is queued again once it timed out.
+        """
+        start_date = now() - timedelta(days=30)
+        end_date = now()
+        job = jobs.submit_report_job('mpg', self.car, start_date, end_date)
+        ReportJob.objects.filter(pk=job.pk).update(status='running')
+        self.assertEqual(len(self.pool.queued), 0)
+        jobs.queue_deferred_jobs()
+        self.assertEqual(len(self.pool.queued), 1)
+
+        OilChange.objects.create(car=self.car, date=now())
+        changed = jobs.submit_report_job('mpg', self.car, start_date,
+                                         end_date)
+        self.assertNotEqual(changed.key, job.key)
+
+        ReportJob.objects.filter(pk=changed.pk).update(
+            status='running', created=now() - timedelta(
+                seconds=jobs.REPORT_JOB_TIMEOUT + 1))
+        lost = jobs.submit_report_job('mpg', self.car, start_date, end_date)
+        self.assertEqual((lost.pk, lost.status), (changed.pk, 'pending'))
+        jobs.queue_deferred_jobs()
+        self.assertEqual(len(self.pool.queued), 3)
+
+        self.pool.run()
+        self.assertEqual(ReportJob.objects.get(pk=changed.pk).status, 'done')
+
+
+class ReplicaRouterTest(TestCase):
+    def read_database(self, method='get', session=None):
+        """
+        Returns the database that the router picks for the reads of a view
+        using the replica mixin.
+        """
+        databases = []
+
+        class ReadView(ReplicaReadMixin, View):
+            def get(self, request):
+                databases.append(ReplicaRouter().db_for_read(Car))
+                return HttpResponse()
+            post = get
+
+        request = getattr(RequestFactory(), method)('/')
+        request.session = session or {}
+        ReadView.as_view()(request)
+        return databases[0]
+
+    def test_reads_routed_inside_mixin(self):
+        """
+        Only the safe requests of the views using the mixin read from the
+        replica, and not right after the session wrote.
+        """
+        replica = {'ENGINE': 'django.db.backends.sqlite3',
+                   'NAME': ':memory:'}
+        databases = dict(settings.DATABASES, replica=replica)
+        with self.settings(DATABASES=databases):
+            self.assertEqual(ReplicaRouter().db_for_read(Car), None)
+            self.assertEqual(self.read_database(), 'replica')
+            self.assertEqual(self.read_database('post'), None)
+            self.assertEqual(self.read_database(session={
+                LAST_WRITE_SESSION_KEY: time.time()}), None)
+            self.assertEqual(ReplicaRouter().db_for_read(Car), None)
+
+        self.assertEqual(self.read_database(), None)
+
+        clear_writes()
+        ReplicaRouter().db_for_write(Car)
+        self.assertTrue(has_written())
+
+
+class ConditionalGetTest(CarTestCase):
+    def test_not_modified_until_edit(self):
+        """
+        The car page answers 304 to the ETag it sent until a record of the
+        car is edited.
+        """
+        self.client.login(username='owner', password='password')
+        record = OilChange.objects.create(car=self.car, date=now())
+        url = reverse('auto_maintenance_car_detail', kwargs={'slug': 'car'})
+
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        etag = response['ETag']
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+                         .status_code, 304)
+
+        record.mileage = 1200
+        record.save()
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+
+class RowCacheTest(CarTestCase):
+    def test_rows_rendered_again_after_save(self):
+        """
+        Rendered rows are read from the cache until their record is saved.
+        """
+        record = OilChange.objects.create(car=self.car, date=now(),
+                                          mileage=1200)
+        rows = maintenance_rows({}, [record], self.car)
+        self.assertTrue('<td>1200</td>' in rows)
+
+        key = row_cache_key(record, record_versions([record])[
+            (record_type(record), record.pk)], self.car, False)
+        cache.set(key, 'cached row')
+        self.assertEqual(maintenance_rows({}, [record], self.car),
+                         'cached row')
+
+        record.mileage = 1500
+        record.save()
+        rows = maintenance_rows({}, [record], self.car)
+        self.assertTrue('<td>1500</td>' in rows)
+
+
+class BulkRecordTest(CarTestCase):
+    def setUp(self):
+        super(BulkRecordTest, self).setUp()
+        self.client.login(username='owner', password='password')
+        self.url = reverse('auto_maintenance_bulk_records',
+                           kwargs={'car_slug': 'car'})
+        self.date = now()
+        self.records = [OilChange.objects.create(car=self.car, date=self.date)
+                        for index in range(3)]
+
+    def test_move_to_car(self):
+        """
+        Records move to another car of the owner, taking the next sequences
+        of their date, but not to the car of someone else.
+        """
+        other = Car.objects.create(slug='other', name='Other',
+                                   owner=self.user)
+        OilChange.objects.create(car=other, date=self.date)
+        stranger = User.objects.create_user('stranger', 'stranger@example.com',
+                                            'password')
+        foreign = Car.objects.create(slug='foreign', name='Foreign',
+                                     owner=stranger)
+        selected = ['oilchange:%s' % record.pk for record in self.records[:2]]
+
+        response = self.client.post(self.url, {
+            'action': 'move_to_car', 'records': selected, 'car': foreign.pk})
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(OilChange.objects.filter(car=foreign).exists())
+
+        response = self.client.post(self.url, {
+            'action': 'move_to_car', 'records': selected, 'car': other.pk})
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(sorted(OilChange.objects.filter(car=other)
+                                .values_list('sequence', flat=True)),
+                         [0, 1, 2])
+        self.assertEqual(OilChange.objects.filter(car=self.car).count(), 1)
+
+    def test_delete_selected(self):
+        """
+        Only the selected records are deleted, and a request without a
+        selection or a filter is refused.
+        """
+        response = self.client.post(self.url, {'action': 'delete'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(OilChange.objects.count(), 3)
+
+        self.client.post(self.url, {
+            'action': 'delete',
+            'records': ['oilchange:%s' % self.records[0].pk]})
+        self.assertEqual(sorted(OilChange.objects.values_list('pk',
+                                                              flat=True)),
+                         [record.pk for record in self.records[1:]])
+
+
+class RecordSequenceTest(CarTestCase):
+    def test_dates_unique_per_car(self):
+        """
+        Records at the same date only need a new sequence number when they
+        belong to the same car.
+        """
+        record_date = now()
+        other_car = Car.objects.create(slug='other', name='Other',
+                                       owner=self.user)
+
+        first = OilChange.objects.create(car=self.car, date=record_date)
+        second = OilChange.objects.create(car=self.car, date=record_date)
+        other = OilChange.objects.create(car=other_car, date=record_date)
+
+        self.assertEqual((first.sequence, second.sequence, other.sequence),
+                         (0, 1, 0))
+        self.assertEqual(self.car.get_maintenance_list(), [second, first])
+
+    def test_rows_follow_records(self):
+        """
+        The listing rows come in the same order as the records and link to
+        the same pages.
+        """
+        record_date = now()
+        OilChange.objects.create(car=self.car, date=record_date)
+        Maintenance.objects.create(car=self.car, date=record_date,
+                                   type='Tires', total_cost='80.00')
+
+        rows = record_rows(self.car)
+        records = self.car.get_maintenance_list()
+
+        self.assertEqual([(row.pk, row.human_readable_type(),
+                           row.get_edit_url()) for row in rows],
+                         [(record.pk, record.human_readable_type(),
+                           record.get_edit_url()) for record in records])
+
+
+class BatchIngestionTest(CarTestCase):
+    def setUp(self):
+        super(BatchIngestionTest, self).setUp()
+        self.url = reverse('auto_maintenance_batch_ingestion')
+        self.auth = 'Basic ' + base64.b64encode('owner:password')
+
+    def record(self, key, **fields):
+        record = {'key': key, 'record_type': 'oilchange', 'car': 'car',
+                  'date': '2013-05-01T08:30:00', 'mileage': 1000,
+                  'total_cost': '30.00'}
+        record.update(fields)
+        return record
+
+    def post(self, records, **extra):
+        extra.setdefault('HTTP_AUTHORIZATION', self.auth)
+        return self.client.post(self.url, json.dumps({'records': records}),
+                                content_type='application/json', **extra)
+
+    def results(self, records):
+        response = self.post(records)
+        self.assertEqual(response.status_code, 200)
+        return json.loads(response.content)['results']
+
+    def test_keys_make_batches_idempotent(self):
+        """
+        Sending a batch again reports the records it created, keys used twice
+        in a batch and invalid records are reported per record.
+        """
+        first = self.results([self.record('a'), self.record('b'),
+                              self.record('a'),
+                              self.record('c', mileage='many'),
+                              self.record('d', car='unknown')])
+        self.assertEqual([result['status'] for result in first],
+                         ['created', 'created', 'error', 'error', 'error'])
+        self.assertTrue('mileage' in first[3]['errors'])
+        self.assertTrue('car' in first[4]['errors'])
+        self.assertEqual(sorted(OilChange.objects.values_list('sequence',
+                                                              flat=True)),
+                         [0, 1])
+
+        again = self.results([self.record('a'), self.record('b')])
+        self.assertEqual([(result['status'], result['id']) for result in again],
+                         [('duplicate', first[0]['id']),
+                          ('duplicate', first[1]['id'])])
+        self.assertEqual(OilChange.objects.count(), 2)
+
+    def test_refused_requests(self):
+        """
+        Requests without credentials, json or a reasonable size are refused,
+        and batches that collide with another writer ask for a retry.
+        """
+        self.assertEqual(self.post([], HTTP_AUTHORIZATION='').status_code, 401)
+        self.assertEqual(self.client.post(self.url, {'records': ''},
+            HTTP_AUTHORIZATION=self.auth).status_code, 415)
+
+        previous = api.MAX_BATCH_SIZE
+        api.MAX_BATCH_SIZE = 1
+        try:
+            self.assertEqual(self.post([self.record('a'), self.record('b')])
+                             .status_code, 413)
+        finally:
+            api.MAX_BATCH_SIZE = previous
+
+        def concurrent_sequences(model, records):
+            IngestionKey.objects.create(owner=self.user, key='a',
+                                        record_type='oilchange', record_id=1)
+            assign_sequences(model, records)
+
+        ingestion.assign_sequences = concurrent_sequences
+        try:
+            self.assertEqual(self.post([self.record('a')]).status_code, 409)
+        finally:
+            ingestion.assign_sequences = assign_sequences
+
+        ingestion.matching_rows = lambda *args: iter(())
+        try:
+            self.assertEqual(self.post([self.record('b')]).status_code, 409)
+        finally:
+            ingestion.matching_rows = matching_rows
+        self.assertFalse(IngestionKey.objects.filter(key='b').exists())
+
+
+class TripChoiceTest(CarTestCase):
+    def test_trips_around_record_date(self):
+        """
+        The record forms offer the trips of the car around the date of the
+        record and the selected trip, and refuse the trips of other cars.
+        """
+        current = Trip.objects.create(car=self.car, slug='current',
+                                      name='Current', start=now() -
+                                      timedelta(days=3))
+        old = Trip.objects.create(car=self.car, slug='old', name='Old',
+                                  start=now() - timedelta(days=700),
+                                  end=now() - timedelta(days=690))
+        other_car = Car.objects.create(slug='other', name='Other',
+                                       owner=self.user)
+        other = Trip.objects.create(car=other_car, slug='other', name='Other',
+                                    start=now() - timedelta(days=3))
+        record = OilChange.objects.create(car=self.car, trip=old,
+                                          date=now(), mileage=1000)
+        self.client.login(username='owner', password='password')
+
+        def choices(name, *args):
+            response = self.client.get(reverse(name, args=args))
+            field = response.context['form'].fields['trip']
+            return [value for value, label in field.widget.choices if value]
+
+        self.assertEqual(choices('auto_maintenance_create_oil_change',
+                                 self.car.slug), [current.pk])
+        self.assertEqual(choices('auto_maintenance_edit_oil_change',
+                                 self.car.slug, record.pk),
+                         [current.pk, old.pk])
+
+        response = self.client.post(reverse(
+            'auto_maintenance_edit_oil_change',
+            args=[self.car.slug, record.pk]), {
+            'date_0': now().strftime('%Y-%m-%d'),
+            'date_1': now().strftime('%H:%M:%S'),
+            'mileage': '1000', 'total_cost': '30.00', 'trip': other.pk})
+        self.assertTrue('trip' in response.context['form'].errors)
+
+
+class FanOutTest(CarTestCase):
+    def setUp(self):
+        super(FanOutTest, self).setUp()
+        self.previous = fanout._pool, fanout.fanout_enabled
+        fanout._pool = InlinePool()
+        fanout.fanout_enabled = lambda: True
+
+    def tearDown(self):
+        fanout._pool, fanout.fanout_enabled = self.previous
+
+    def test_same_as_serial(self):
+        """
+        The record listings read on the pool match the ones read one query
+        after the other, archived records included.
+        """
+        trip = Trip.objects.create(car=self.car, slug='trip', name='Trip',
+                                   start=now() - timedelta(days=10))
+        GasolinePurchase.objects.create(car=self.car, trip=trip, date=now(),
+            fuel_amount='10.000', price_per_unit='3.000', total_cost='30.00')
+        OilChange.objects.create(car=self.car, date=now() -
+                                 timedelta(days=800), total_cost='40.00')
+        archive_records(after_days=365)
+        Maintenance.objects.create(car=self.car, trip=trip, date=now(),
+                                   type='Tires', total_cost='80.00')
+        Payment.objects.create(car=self.car, date=now(), type='parking',
+                               total_cost='5.00')
+
+        def listings():
+            return ([(type(row), row.pk, row.archived)
+                     for row in record_rows(self.car)],
+                    [(type(row), row.pk)
+                     for row in record_rows(self.car, trip=trip)],
+                    [(type(record), record.pk)
+                     for record in self.car.get_maintenance_list()])
+
+        fanned = listings()
+        fanout.fanout_enabled = lambda: False
+        self.assertEqual(fanned, listings())
+        self.assertEqual(len(fanned[0]), 4)
+
+    def test_failed_task_run_again(self):
+        """
+        A task that fails on the pool is run again on the current thread.
+        """
+        attempts = []
+
+        def flaky(value):
+            attempts.append(value)
+            if len(attempts) == 1:
+                raise ValueError('Connection lost')
+            return value
+
+        self.assertEqual(fanout.fan_out([(flaky, (1,)), (abs, (-2,))]),
+                         [1, 2])
+        self.assertEqual(attempts, [1, 1])
+
+
+class SearchTest(CarTestCase):
+    def test_index_follows_writes(self):
+        """
+        The search index is updated when records are saved, updated in bulk
+        and deleted.
+        """
+        from automaintenance.search import search
+
+        record = Maintenance.objects.create(car=self.car, date=now(),
+                                            type='Tires',
+                                            location='Corner Garage')
+        self.assertEqual(search(self.user, 'garage'), [record])
+
+        Maintenance.objects.filter(pk=record.pk).update(location='Dealer')
+        self.assertEqual(search(self.user, 'garage'), [])
+        self.assertEqual(search(self.user, 'dealer', types=['trip']), [])
+
+        record.delete()
+        self.assertEqual(search(self.user, 'dealer'), [])
+
+
+class LocationTest(CarTestCase):
+    def locations(self):
+        return sorted(Location.objects.filter(owner=self.user).values_list(
+            'normalized', 'name', 'uses'))
+
+    def test_counts_follow_saves(self):
+        """
+        Saves apply their change to the counts, which match a recount of the
+        records, and the spellings of a location share one entry.
+        """
+        self.assertEqual(normalize_location(u' Shell\t Station '),
+                         u'shell station')
+        OilChange.objects.create(car=self.car, date=now(), location='Shell')
+        moved = OilChange.objects.create(car=self.car, date=now(),
+                                         location=' shell ')
+        removed = Maintenance.objects.create(car=self.car, date=now(),
+                                             type='Tires', location='Costco')
+        moved.location = 'Costco'
+        moved.save()
+        removed.delete()
+
+        counted = self.locations()
+        self.assertEqual(counted, [(u'costco', u'Costco', 1),
+                                   (u'shell', u'Shell', 1)])
+        refresh_locations([self.car.pk])
+        self.assertEqual(self.locations(), counted)
+
+        moved.delete()
+        self.assertEqual([row[0] for row in self.locations()], [u'shell'])
+
+    def test_entry_added_at_the_same_time(self):
+        """
+        A location added by another save at the same time is used instead of
+        failing the save.
+        """
+        bulk_create = Location.objects.bulk_create
+
+        def racing_bulk_create(locations):
+            Location.objects.bulk_create = bulk_create
+            Location.objects.create(owner=self.user, name='Shell',
+                                    normalized='shell')
+            return bulk_create(locations)
+
+        Location.objects.bulk_create = racing_bulk_create
+        try:
+            OilChange.objects.create(car=self.car, date=now(),
+                                     location='Shell')
+        finally:
+            Location.objects.bulk_create = bulk_create
+        self.assertEqual(self.locations(), [(u'shell', u'Shell', 1)])
+
+    def test_autocomplete(self):
         """
-        self.assertEqual(1 + 1, 2)
+        The most used locations of the owner that start with the prefix are
+        offered first.
+        """
+        for location in ('Shell', 'Shell', 'Shellbrook Garage', 'Costco'):
+            OilChange.objects.create(car=self.car, date=now(),
+                                     location=location)
+        stranger = User.objects.create_user('stranger', 'stranger@example.com',
+                                            'password')
+        other = Car.objects.create(slug='other', name='Other', owner=stranger)
+        OilChange.objects.create(car=other, date=now(), location='Shellfish')
+
+        self.assertEqual([location.name for location in
+                          complete_location(self.user, ' SHELL')],
+                         ['Shell', 'Shellbrook Garage'])
+
+        self.client.login(username='owner', password='password')
+        response = self.client.get(reverse(
+            'auto_maintenance_location_autocomplete'), {'q': 'sh', 'limit': 1})
+        self.assertEqual(json.loads(response.content)['locations'],
+                         [{'name': 'Shell', 'uses': 2}])
+
+
+class ChangeFeedTest(CarTestCase):
+    def setUp(self):
+        super(ChangeFeedTest, self).setUp()
+        self.client.login(username='owner', password='password')
+        self.previous = changes.CHANGE_VISIBILITY_SECONDS
+        changes.CHANGE_VISIBILITY_SECONDS = 0
+
+    def tearDown(self):
+        changes.CHANGE_VISIBILITY_SECONDS = self.previous
+
+    def feed(self, cursor):
+        response = self.client.get(reverse('auto_maintenance_change_feed'),
+                                   {'cursor': cursor})
+        return response.status_code, json.loads(response.content)
+
+    def test_changes_since_cursor(self):
+        """
+        Clients only get the changes after their cursor, and compaction keeps
+        the last change of every object.
+        """
+        record = OilChange.objects.create(car=self.car, date=now())
+        status, first = self.feed(0)
+        self.assertEqual([(change['type'], change['action'])
+                          for change in first['changes']],
+                         [('car', 'create'), ('oilchange', 'create')])
+
+        record.mileage = 1200
+        record.save()
+        record.delete()
+        status, second = self.feed(first['cursor'])
+        self.assertEqual([change['action'] for change in second['changes']],
+                         ['update', 'delete'])
+
+        compact_changes()
+        status, compacted = self.feed(0)
+        self.assertEqual([(change['type'], change['action'])
+                          for change in compacted['changes']],
+                         [('car', 'create'), ('oilchange', 'delete')])
+
+        compact_changes(retention_days=-1)
+        status, expired = self.feed(0)
+        self.assertEqual(status, 410)
+        self.assertEqual(self.feed(expired['cursor'])[0], 200)
+
+    def test_late_commit_not_skipped(self):
+        """
+        A change logged by a transaction that commits after a later one is
+        still served, the feed holds back the changes younger than the
+        visibility seconds.
+        """
+        changes.CHANGE_VISIBILITY_SECONDS = 60
+        OilChange.objects.create(car=self.car, date=now())
+        Change.objects.update(date=now() - timedelta(minutes=2))
+        status, first = self.feed(0)
+        self.assertEqual(len(first['changes']), 2)
+
+        # The first transaction logs its change but doesn't commit yet, the
+        # second one commits its change with a later sequence.
+        slow = OilChange.objects.create(car=self.car, date=now())
+        fast = OilChange.objects.create(car=self.car, date=now())
+        pending = Change.objects.get(object_type='oilchange',
+                                     object_id=slow.pk)
+        sequence = pending.pk
+        pending.delete()
+        status, second = self.feed(first['cursor'])
+        self.assertEqual(second['changes'], [])
+        self.assertEqual(second['cursor'], first['cursor'])
+
+        pending.pk = sequence
+        pending.save()
+        Change.objects.update(date=now() - timedelta(minutes=2))
+        status, third = self.feed(second['cursor'])
+        self.assertEqual([change['id'] for change in third['changes']],
+                         [slow.pk, fast.pk])
+
+
+class SnapshotTest(CarTestCase):
+    def test_columns_match_records(self):
+        """
+        The columns hold the records sorted by date, and the totals, date
+        ranges and selections match the records they were built from.
+        """
+        trip = Trip.objects.create(car=self.car, slug='trip', name='Trip',
+                                   start=now() - timedelta(days=10))
+        GasolinePurchase.objects.create(car=self.car, trip=trip,
+            date=now() - timedelta(days=1), mileage=1300,
+            fuel_amount='10.500', tank_mileage='300.000',
+            price_per_unit='3.250', total_cost='34.13')
+        OilChange.objects.create(car=self.car, date=now() - timedelta(days=5),
+                                 mileage=1000, total_cost='40.00')
+        Maintenance.objects.create(car=self.car, date=now() -
+                                   timedelta(days=20), type='Tires',
+                                   total_cost='80.00')
+
+        snapshot = build_snapshot(self.car.pk)
+        self.assertEqual(len(snapshot), 3)
+        self.assertEqual(list(snapshot.type), [TYPE_MAINTENANCE,
+                                               TYPE_OIL_CHANGE,
+                                               TYPE_GASOLINE])
+        self.assertEqual(snapshot.total('cost'), Decimal('154.13'))
+        self.assertEqual(snapshot.group_by('category', 'cost'), {
+            'Tires': Decimal('80.00'), 'Oil Change': Decimal('40.00'),
+            'Gasoline': Decimal('34.13')})
+        self.assertEqual(len(snapshot.between(start_date=now() -
+                                              timedelta(days=7))), 2)
+        gasoline = snapshot.select(types=[TYPE_GASOLINE], trip=trip.pk)
+        self.assertEqual(gasoline.values('price_per_unit'), [3.25])
+        self.assertAlmostEqual(gasoline.values('efficency')[0], 300 / 10.5)
+
+    def test_cached_by_version(self):
+        """
+        The snapshot of a car is built once per data version.
+        """
+        OilChange.objects.create(car=self.car, date=now(), total_cost='40.00')
+        first = car_snapshot(self.car)
+        self.assertNumQueries(1, car_snapshot, self.car)
+
+        OilChange.objects.create(car=self.car, date=now(), total_cost='20.00')
+        self.assertEqual(car_snapshot(self.car).total('cost'), 60)
+        self.assertEqual(first.total('cost'), 40)
+
+
+class ArchiveTest(CarTestCase):
+    def test_archived_records_still_read(self):
+        """
+        Archived records leave the record tables but are still listed and
+        totalled, archiving the same year again adds to its archive.
+        """
+        old_date = now() - timedelta(days=800)
+        OilChange.objects.create(car=self.car, date=old_date,
+                                 total_cost='40.00')
+        Maintenance.objects.create(car=self.car, date=now(), type='Tires',
+                                   total_cost='80.00')
+
+        self.assertEqual(archive_records(after_days=365), 1)
+        self.assertFalse(OilChange.objects.exists())
+        self.assertEqual(build_snapshot(self.car.pk).total('cost'), 120)
+        self.assertEqual([row.archived for row in record_rows(self.car)],
+                         [False, True])
+        self.assertEqual(record_rows(self.car, start_date=now() -
+                                     timedelta(days=1))[0].archived, False)
+
+        OilChange.objects.create(car=self.car, date=old_date,
+                                 total_cost='20.00')
+        archive_records(after_days=365)
+        self.assertEqual(RecordArchive.objects.get(car=self.car).records, 2)
+
+
+class FleetSnapshotTest(CarTestCase):
+    def setUp(self):
+        super(FleetSnapshotTest, self).setUp()
+        self.directory = tempfile.mkdtemp()
+        self.previous = fleet.FLEET_SNAPSHOT_DIR
+        fleet.FLEET_SNAPSHOT_DIR = self.directory
+
+    def tearDown(self):
+        fleet.FLEET_SNAPSHOT_DIR = self.previous
+        fleet._mapped.clear()
+        shutil.rmtree(self.directory)
+
+    def test_rebuilt_when_version_changes(self):
+        """
+        The mapped file matches the snapshot of the car and is replaced when
+        the records change.
+        """
+        Maintenance.objects.create(car=self.car, date=now(), type='Tires',
+                                   total_cost='80.00')
+        first = fleet.fleet_snapshot(self.user.pk)
+        self.assertEqual(first.car(self.car.pk).group_by('category', 'cost'),
+                         build_snapshot(self.car.pk).group_by('category',
+                                                              'cost'))
+        self.assertTrue(fleet.fleet_snapshot(self.user.pk) is first)
+
+        OilChange.objects.create(car=self.car, date=now(), total_cost='20.00')
+        second = fleet.fleet_snapshot(self.user.pk)
+        self.assertEqual(second.car(self.car.pk).total('cost'), 100)
+        self.assertEqual(sorted(os.listdir(self.directory)),
+                         ['fleet-%s.lock' % self.user.pk,
+                          'fleet-%s.snapshot' % self.user.pk])
+
+    def test_cache_read_during_rebuild(self):
+        """
+        While another process holds the rebuild lock the snapshots of the
+        current version are read from the cache instead of an out of date
+        file, which is rebuilt once the lock is released.
+        """
+        OilChange.objects.create(car=self.car, date=now(), total_cost='20.00')
+        fleet.fleet_snapshot(self.user.pk)
+
+        OilChange.objects.create(car=self.car, date=now(), total_cost='30.00')
+        lock_file = fleet.lock_fleet(self.user.pk)
+        try:
+            self.assertEqual(fleet.fleet_snapshot(self.user.pk), None)
+            self.assertEqual(car_snapshot(self.car).total('cost'), 50)
+            self.assertEqual(range_index(self.car).totals()['cost'], 50)
+        finally:
+            lock_file.close()
+
+        second = fleet.fleet_snapshot(self.user.pk)
+        self.assertEqual(second.car(self.car.pk).total('cost'), 50)
+
+
+class RangeIndexTest(CarTestCase):
+    def test_range_totals(self):
+        """
+        New records are appended to the index, back dated records make it
+        rebuild, and the totals cover the records between the dates.
+        """
+        start = now() - timedelta(days=10)
+        OilChange.objects.create(car=self.car, date=start, total_cost='40.00')
+        range_index(self.car)
+
+        OilChange.objects.create(car=self.car, date=now(), total_cost='10.50')
+        appended = cache.get(range_index_key(self.car.pk))
+        self.assertEqual(len(appended.dates), 2)
+        self.assertEqual(appended.version, car_data_version(self.car.pk))
+
+        OilChange.objects.create(car=self.car, date=start - timedelta(days=1),
+                                 total_cost='5.00')
+        totals = range_index(self.car).totals(start_date=start)
+        self.assertEqual((totals['count'], totals['cost']),
+                         (2, Decimal('50.50')))
+        self.assertEqual(range_index(self.car).totals()['count'], 3)
+
+    def test_unversioned_snapshot_not_appended(self):
+        """
+        An index built from a snapshot that doesn't know its version, such
+        as a snapshot read while a change committed, is rebuilt instead of
+        appended to.
+        """
+        OilChange.objects.create(car=self.car, date=now() - timedelta(days=1),
+                                 total_cost='40.00')
+        snapshot = build_snapshot(self.car.pk)
+        OilChange.objects.create(car=self.car, date=now() - timedelta(
+            hours=1), total_cost='20.00')
+        key = range_index_key(self.car.pk)
+        cache.set(key, RangeIndex.from_snapshot(
+            car_data_version(self.car.pk), snapshot))
+
+        OilChange.objects.create(car=self.car, date=now(), total_cost='10.00')
+        self.assertEqual(len(cache.get(key).dates), 1)
+        self.assertEqual(range_index(self.car).totals()['cost'], 70)
+
+    def test_cost_per_distance_includes_payments(self):
+        """
+        Payments are spread over the distance driven in the windows that
+        include them.
+        """
+        end = now()
+        GasolinePurchase.objects.create(car=self.car, date=end - timedelta(
+            days=20), tank_mileage='300.000', fuel_amount='10.000',
+            total_cost='30.00')
+        Payment.objects.create(car=self.car, date=end - timedelta(days=60),
+                               type='insurance', total_cost='600.00')
+
+        windows = dict(cost_per_distance(range_index(self.car),
+                                         end - timedelta(days=10), end,
+                                         windows=(30, 90)))
+        self.assertAlmostEqual(windows[30][-1][1], 0.1)
+        self.assertAlmostEqual(windows[90][-1][1], 2.1)
+
+
+class PriceStatisticsTest(CarTestCase):
+    def test_price_statistics(self):
+        """
+        Percentiles interpolate between the fills and the mean is weighted by
+        the fuel bought.
+        """
+        statistics = price_statistics([3000, 1000, 2000, 4000],
+                                      [1000, 1000, 1000, 5000])
+        self.assertEqual(statistics['fills'], 4)
+        self.assertEqual(statistics['median'], Decimal('2.500'))
+        self.assertEqual(statistics['p90'], Decimal('3.700'))
+        self.assertEqual(statistics['weighted_mean'], Decimal('3.250'))
+        self.assertEqual(price_statistics([], []), None)
+
+    def test_car_price_statistics(self):
+        """
+        The statistics of a car are computed per month of its fills.
+        """
+        date = now()
+        for price in ('3.000', '4.000'):
+            GasolinePurchase.objects.create(car=self.car, date=date,
+                fuel_amount='10.000', price_per_unit=price,
+                total_cost='35.00')
+
+        statistics = car_price_statistics(self.car, date - timedelta(days=1),
+                                          date + timedelta(days=1))
+        fills = sum(period[2]['fills'] for period in statistics
+                    if period[2])
+        self.assertEqual(fills, 2)
+
+    def test_fleet_price_statistics(self):
+        """
+        The fleet statistics cover the fills of every comparable car and are
+        computed again when one of the cars changes.
+        """
+        date = now()
+        other = Car.objects.create(slug='other', name='Other',
+                                   owner=self.user)
+        for car in (self.car, other):
+            GasolinePurchase.objects.create(car=car, date=date,
+                fuel_amount='10.000', price_per_unit='3.000',
+                total_cost='30.00')
+
+        def fills():
+            return sum(period[2]['fills'] for period in
+                       fleet_price_statistics(self.car,
+                                              date - timedelta(days=1),
+                                              date + timedelta(days=1))
+                       if period[2])
+
+        self.assertEqual(fills(), 2)
+        GasolinePurchase.objects.create(car=other, date=date,
+            fuel_amount='10.000', price_per_unit='4.000', total_cost='40.00')
+        self.assertEqual(fills(), 3)
+        self.assertEqual(car_data_versions([self.car.pk, other.pk, 0])[0], 0)
+
+
+class DeletionTest(CarTestCase):
+    def setUp(self):
+        super(DeletionTest, self).setUp()
+        self.trip = Trip.objects.create(slug='trip', name='Trip',
+                                        car=self.car, start=now())
+        for days in range(5):
+            OilChange.objects.create(car=self.car, trip=self.trip,
+                                     date=now() - timedelta(days=days * 100),
+                                     mileage=days * 5000, location='Garage')
+
+    def test_delete(self):
+        """
+        Deleting a trip keeps its records, deleting a car removes them
+        along with the rows that refer to the car.
+        """
+        delete_trip(self.trip)
+        self.assertFalse(Trip.all_objects.filter(pk=self.trip.pk).exists())
+        self.assertEqual(OilChange.objects.filter(trip__isnull=True).count(),
+                         5)
+
+        self.assertTrue(ServiceDue.objects.filter(car=self.car).exists())
+        delete_car(self.car)
+        self.assertFalse(Car.all_objects.filter(pk=self.car.pk).exists())
+        self.assertFalse(OilChange.objects.exists())
+        self.assertFalse(ServiceDue.objects.exists())
+
+    def test_soft_delete(self):
+        """
+        Hidden cars are left out right away and purged in batches.
+        """
+        hide_car(self.car)
+        self.assertFalse(Car.objects.filter(owner=self.user).exists())
+        self.assertEqual(OilChange.objects.count(), 5)
+
+        self.assertEqual(purge_deleted(batch_size=2), 1)
+        self.assertFalse(Car.all_objects.exists())
+        self.assertFalse(Trip.all_objects.exists())
+        self.assertFalse(OilChange.objects.exists())
+
+    def test_model_delete(self):
+        """
+        Deleting a car through the model drops its location counts from the
+        dictionary before its records go.
+        """
+        other = Car.objects.create(slug='other', name='Other',
+                                   owner=self.user)
+        OilChange.objects.create(car=other, date=now(), location='Garage')
+        self.assertEqual(Location.objects.get(owner=self.user).uses, 6)
+
+        car_id = self.car.pk
+        self.car.delete()
+        self.assertFalse(OilChange.objects.filter(car=car_id).exists())
+        self.assertEqual(Location.objects.get(owner=self.user).uses, 1)
+
+    def test_hidden_trip(self):
+        """
+        The records of a hidden trip are taken out of it right away, the
+        record forms don't accept the hidden trip.
+        """
+        hide_trip(self.trip)
+        self.assertFalse(Trip.objects.exists())
+        self.assertFalse(OilChange.objects.filter(trip__isnull=False).exists())
+
+        self.assertEqual(purge_deleted(), 1)
+        self.assertFalse(Trip.all_objects.exists())
+        self.assertEqual(OilChange.objects.count(), 5)
+
+    def test_reused_primary_key(self):
+        """
+        A car that gets the primary key of a removed car, here of another
+        owner, never reads the data cached for the removed car.
+        """
+        removed = Car.objects.create(slug='removed', name='Removed',
+                                     owner=self.user)
+        Payment.objects.create(car=removed, date=now(), type='parking',
+                               total_cost='999.00')
+        self.assertEqual(car_snapshot(removed).total('cost'), 999)
+        range_index(removed)
+        delete_car(removed)
+
+        other = User.objects.create_user('other', 'other@example.com',
+                                         'password')
+        car = Car.objects.create(pk=removed.pk, slug='car', name='Car',
+                                 owner=other)
+        Payment.objects.create(car=car, date=now(), type='parking',
+                               total_cost='1.00')
+        self.assertEqual(car_snapshot(car).total('cost'), 1)
+        self.assertEqual(range_index(car).totals()['cost'], 1)
+
+
+class AdminTest(CarTestCase):
+    def test_estimated_count_change_list(self):
+        """
+        The record lists use the estimated count paginator and have no
+        filter listing every car, the records are searched by car slug.
+        """
+        other = Car.objects.create(slug='other', name='Other',
+                                   owner=self.user)
+        for car in (self.car, other):
+            OilChange.objects.create(car=car, date=now())
+        self.user.is_staff = self.user.is_superuser = True
+        self.user.save()
+
+        request = RequestFactory().get('/', {'q': 'car'})
+        request.user = self.user
+        response = RecordAdmin(OilChange, admin.site).changelist_view(request)
+        changelist = response.context_data['cl']
+        self.assertTrue(isinstance(changelist, EstimatedCountChangeList))
+        self.assertTrue(isinstance(changelist.paginator,
+                                   EstimatedCountPaginator))
+        self.assertEqual([spec.title for spec in changelist.filter_specs],
+                         ['date'])
+        self.assertEqual((changelist.result_count,
+                          changelist.full_result_count), (1, 2))
+
+        request = RequestFactory().get('/', {'car': str(other.pk)})
+        request.user = self.user
+        response = RecordAdmin(OilChange, admin.site).changelist_view(request)
+        changelist = response.context_data['cl']
+        self.assertEqual(changelist.filter_specs[0].lookup_choices,
+                         [(str(other.pk), 'Other')])
+        self.assertEqual([record.car_id for record in changelist.result_list],
+                         [other.pk])
+
+    def test_deleted_cars_and_trips(self):
+        """
+        The hidden cars and trips are listed and can be filtered on, their
+        deletion is confirmed with the number of records it affects.
+        """
+        trip = Trip.objects.create(car=self.car, name='Trip', slug='trip',
+                                   start=now(), end=now())
+        for trip_id in (trip.pk, None):
+            OilChange.objects.create(car=self.car, date=now(), trip_id=trip_id)
+        Trip.all_objects.filter(pk=trip.pk).update(deleted=now())
+        self.user.is_staff = self.user.is_superuser = True
+        self.user.save()
+
+        trip_admin = TripAdmin(Trip, admin.site)
+        for deleted, trips in (('', [trip.pk]), ('yes', [trip.pk]),
+                               ('no', [])):
+            request = RequestFactory().get('/', {'deleted': deleted})
+            request.user = self.user
+            changelist = trip_admin.changelist_view(request).context_data['cl']
+            self.assertEqual([row.pk for row in changelist.result_list],
+                             trips)
+
+        request = RequestFactory().get('/')
+        request.user = self.user
+        for model_admin, obj, summary in (
+                (trip_admin, trip, ['Trip: %s' % trip, ['1 oil changes']]),
+                (CarAdmin(Car, admin.site), self.car,
+                 ['Car: Car', ['2 oil changes']])):
+            response = model_admin.delete_view(request, str(obj.pk))
+            self.assertEqual(response.context_data['deleted_objects'],
+                             summary)
+
+
+class ProfilerTest(CarTestCase):
+    def setUp(self):
+        super(ProfilerTest, self).setUp()
+        self.directory = tempfile.mkdtemp()
+        self.previous = profiling.PROFILE_DIR, profiling.PROFILE_KEEP
+        profiling.PROFILE_DIR = self.directory
+
+    def tearDown(self):
+        profiling.PROFILE_DIR, profiling.PROFILE_KEEP = self.previous
+        shutil.rmtree(self.directory)
+
+    def test_profiled_request(self):
+        """
+        Staff users that ask get their request profiled along with its
+        queries, and only the latest profiles are kept.
+        """
+        request = RequestFactory().get('/', {'profile': '1'})
+        request.user = self.user
+        self.assertFalse(profiling.profile_requested(request))
+        self.user.is_staff = True
+        self.assertTrue(profiling.profile_requested(request))
+        plain = RequestFactory().get('/')
+        plain.user = self.user
+        self.assertFalse(profiling.profile_requested(plain))
+
+        def view(request):
+            return HttpResponse(str(Car.objects.count()))
+
+        response = profiling.profile_view(request, view, (), {})
+        self.assertEqual(response.content, '1')
+
+        profiles = profiling.list_profiles()
+        self.assertEqual([profile['query_count'] for profile in profiles],
+                         [1])
+        profile = profiling.load_profile(profiles[0]['id'])
+        self.assertEqual(profile['status'], 200)
+        self.assertTrue('automaintenance_car' in profile['queries'][0]['sql'])
+        self.assertTrue(os.path.exists(profiling.profile_path(
+            profiles[0]['id'], 'prof')))
+        self.assertEqual(profiling.load_profile('../' + profiles[0]['id']),
+                         None)
+
+        profiling.PROFILE_KEEP = 1
+        profiling.profile_view(request, view, (), {})
+        self.assertEqual(len(profiling.profile_ids()), 1)
+        self.assertEqual(len(os.listdir(self.directory)), 2)
+
+
+class LoadTestTest(TestCase):
+    def test_summarize(self):
+        """
+        Latency percentiles are nearest rank, failed requests are counted
+        as errors.
+        """
+        results = {'route': [(index / 1000.0, 200) for index in range(1, 101)]}
+        results['route'][-1] = (0.1, 500)
+        rows = summarize(results, 10.0)
+
+        self.assertEqual([row['route'] for row in rows], ['route', 'total'])
+        self.assertEqual(rows[0]['errors'], 1)
+        self.assertAlmostEqual(rows[0]['throughput'], 10.0)
+        self.assertAlmostEqual(rows[0]['p50'], 50.0)
+        self.assertAlmostEqual(rows[0]['p99'], 99.0)
+
+    def test_routes_named_by_url(self):
+        """
+        Every route, each report included, is named by the url name of the
+        requests it sends.
+        """
+        car = {'slug': 'car', 'trips': ['trip'], 'records': [1]}
+        rng = random.Random(0)
+        for route in ROUTES:
+            self.assertEqual(resolve(route.path(car, rng)[1]).url_name,
+                             route.name)
+        self.assertEqual(len(set(route.name for route in ROUTES)),
+                         len(ROUTES))
+
+
+class MetricsTest(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.previous = metrics.METRICS_DIR
+        metrics.METRICS_DIR = self.directory
+
+    def tearDown(self):
+        metrics.METRICS_DIR = self.previous
+        shutil.rmtree(self.directory)
+
+    def test_processes_added_up(self):
+        """
+        The endpoint adds up the files of every process, histogram buckets
+        are cumulative.
+        """
+        registry = metrics.Registry()
+        lookups = metrics.Counter(registry, 'lookups', 'Lookups.',
+                                  ('result',))
+        latency = metrics.Histogram(registry, 'latency', 'Latency.',
+                                    ('view',), buckets=(0.1, 1.0))
+        lookups.inc(2, result='hit')
+        latency.observe(0.05, view='car')
+        latency.observe(0.5, view='car')
+
+        registry.flush(force=True)
+        shutil.copy(registry.path(), os.path.join(
+            self.directory, 'metrics-%d-%d.json' % (registry.pid,
+                                                    registry.started + 1)))
+
+        lines = registry.collect().exposition().splitlines()
+        self.assertTrue('lookups{result="hit"} 4' in lines)
+        self.assertTrue('latency_bucket{view="car",le="0.1"} 2' in lines)
+        self.assertTrue('latency_bucket{view="car",le="1.0"} 4' in lines)
+        self.assertTrue('latency_bucket{view="car",le="+Inf"} 4' in lines)
+        self.assertTrue('latency_count{view="car"} 4' in lines)
+
+    def test_exited_processes_folded(self):
+        """
+        The files of processes that exited, or whose pid was taken by a later
+        process, are added to the totals once and removed.
+        """
+        registry = metrics.Registry()
+        lookups = metrics.Counter(registry, 'lookups', 'Lookups.')
+        lookups.inc(2)
+        registry.flush(force=True)
+
+        child = subprocess.Popen(['true'])
+        child.wait()
+        exited = ['metrics-%d-0.json' % child.pid,
+                  'metrics-%d-0.json' % registry.pid]
+        for name in exited:
+            shutil.copy(registry.path(), os.path.join(self.directory, name))
+
+        for collected in range(2):
+            lines = registry.collect().exposition().splitlines()
+            self.assertTrue('lookups 6' in lines)
+        self.assertEqual(sorted(os.listdir(self.directory)),
+                         sorted([os.path.basename(registry.path()),
+                                 'metrics.lock', 'totals.json']))
+
+    def test_idle_process_flushed(self):
+        """
+        The metrics counted after the last write of a process that serves no
+        more requests are written by its timer, and when it exits.
+        """
+        previous = metrics.METRICS_FLUSH_SECONDS
+        metrics.METRICS_FLUSH_SECONDS = 0.05
+        try:
+            registry = metrics.Registry()
+            lookups = metrics.Counter(registry, 'lookups', 'Lookups.')
+            lookups.inc()
+            registry.flush()
+            lookups.inc()
+            for attempt in range(100):
+                time.sleep(0.05)
+                with open(registry.path()) as metrics_file:
+                    if json.load(metrics_file)['lookups'] == [[[], 2]]:
+                        break
+            else:
+                self.fail('the timer did not write the metrics')
+        finally:
+            metrics.METRICS_FLUSH_SECONDS = previous
+
+        lookups.inc()
+        registry.flush_changed()
+        with open(registry.path()) as metrics_file:
+            self.assertEqual(json.load(metrics_file)['lookups'], [[[], 3]])
+
+    def test_fan_out_db_time(self):
+        """
+        The database time of the tasks run on the pool is added to the one
+        of the thread that fanned them out.
+        """
+        def task(value):
+            metrics.add_db_time(0.25)
+            return value * 2
+
+        previous = fanout.fanout_enabled
+        fanout.fanout_enabled = lambda: True
+        try:
+            metrics.start_db_timing()
+            self.assertEqual(fanout.fan_out([(task, (1,)), (task, (2,))]),
+                             [2, 4])
+            self.assertAlmostEqual(metrics.db_time(), 0.5)
+        finally:
+            fanout.fanout_enabled = previous
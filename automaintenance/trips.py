@@ -0,0 +1,60 @@
+##
+# Automaintenance.  Django app to track automaintenance records.
+# Copyright (C) 2012 Robert Robinson
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+##
+from django.conf import settings
+from django.db.models import Q
+
+from automaintenance.models import Trip
+
+from datetime import timedelta
+
+
+# Number of days before and after the date of a record that a trip has to
+# overlap to be offered in the record forms.
+TRIP_WINDOW_DAYS = getattr(settings, 'AUTOMAINTENANCE_TRIP_WINDOW_DAYS', 7)
+
+# Largest number of trips offered in the record forms.
+TRIP_CHOICES = getattr(settings, 'AUTOMAINTENANCE_TRIP_CHOICES', 20)
+
+# Number of trips returned per page by the trip search.
+TRIP_PAGE_SIZE = getattr(settings, 'AUTOMAINTENANCE_TRIP_PAGE_SIZE', 20)
+
+
+def nearby_trips(car, around, limit=TRIP_CHOICES):
+    """
+        Returns the trips of the car that were going on around the date, the
+        latest first.  Trips without an end are still going on.
+    """
+    window = timedelta(days=TRIP_WINDOW_DAYS)
+    return Trip.objects.filter(car=car, start__lte=around + window).filter(
+        Q(end__gte=around - window) | Q(end__isnull=True)).order_by(
+        '-start')[:limit]
+
+
+def search_trips(car, query='', page=1, page_size=TRIP_PAGE_SIZE):
+    """
+        Returns a page of the trips of the car whose name contains the query,
+        the latest first, and whether there is a next page.  One extra trip
+        is read instead of counting the trips.
+    """
+    trips = Trip.objects.filter(car=car)
+    if query:
+        trips = trips.filter(name__icontains=query)
+
+    start = (page - 1) * page_size
+    trips = list(trips.order_by('-start')[start:start + page_size + 1])
+    return trips[:page_size], len(trips) > page_size
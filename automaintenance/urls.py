@@ -16,6 +16,7 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 ##
 from django.contrib.auth.decorators import login_required
+from django.contrib.admin.views.decorators import staff_member_required
 from django.conf.urls import url, patterns
 
 from automaintenance.views.car import CarListView, CreateCarView, DisplayCar, EditCarView
@@ -26,14 +27,38 @@ from automaintenance.views.maintenance import CreateMaintenanceView, CreateOilCh
 from automaintenance.views.maintenance import EditOilChange, DeleteOilChange
 from automaintenance.views.maintenance import GasolinePurchaseView, OilChangeView
 from automaintenance.views.trip import CreateTripView, DisplayTripView, EditTripView
-from automaintenance.views.trip import DeleteTripView
+from automaintenance.views.trip import DeleteTripView, TripSearchView
 from automaintenance.views.report import DistancePerUnitReport, CostPerDistanceReport
 from automaintenance.views.report import PricePerUnitReport, CategoryReport, DistancePerTime
+from automaintenance.views.report import LocationReport, ReportTotalsView
 from automaintenance.views.payments import PaymentView, CreatePaymentView, DeletePaymentView, EditPaymentView
+from automaintenance.views.service import ServiceDueListView
+from automaintenance.views.jobs import SubmitReportJobView, ReportJobStatusView
+from automaintenance.views.bulk import BulkRecordView
+from automaintenance.views.api import BatchIngestionView, LocationAutocompleteView
+from automaintenance.views.api import ChangeFeedView
+from automaintenance.views.search import SearchView
+from automaintenance.views.profiling import ProfileListView, ProfileDetailView
+from automaintenance.views.profiling import ProfileDownloadView
+from automaintenance.views.metrics import MetricsView
 
 urlpatterns = patterns('',
     url(r'^$', login_required(CarListView.as_view()),
         name='auto_maintenance_car_list'),
+    url(r'^due/$', login_required(ServiceDueListView.as_view()),
+        name='auto_maintenance_service_due'),
+    url(r'^search/$', login_required(SearchView.as_view()),
+        name='auto_maintenance_search'),
+    url(r'^profiles/$', staff_member_required(ProfileListView.as_view()),
+        name='auto_maintenance_profiles'),
+    url(r'^profiles/(?P<profile_id>[^/]+)/$',
+        staff_member_required(ProfileDetailView.as_view()),
+        name='auto_maintenance_profile_detail'),
+    url(r'^profiles/(?P<profile_id>[^/]+)/download/$',
+        staff_member_required(ProfileDownloadView.as_view()),
+        name='auto_maintenance_profile_download'),
+    url(r'^metrics/$', MetricsView.as_view(),
+        name='auto_maintenance_metrics'),
 
     # Car Records
     url(r'^add_car/$',
@@ -102,7 +127,20 @@ urlpatterns = patterns('',
         login_required(PaymentView.as_view()),
         name='auto_oilchange_view_payment'),
 
+    # Search
+    url(r'^car/(?P<car_slug>[^/]+)/search/$',
+        login_required(SearchView.as_view()),
+        name='auto_maintenance_car_search'),
+
+    # Bulk Record Changes
+    url(r'^car/(?P<car_slug>[^/]+)/records/bulk/$',
+        login_required(BulkRecordView.as_view()),
+        name='auto_maintenance_bulk_records'),
+
     # Trip Records
+    url(r'^car/(?P<car_slug>[^/]+)/trips/search/$',
+        login_required(TripSearchView.as_view()),
+        name='auto_maintenance_trip_search'),
     url(r'^car/(?P<car_slug>[^/]+)/trip/add/$',
         login_required(CreateTripView.as_view()),
         name="auto_maintenance_create_trip"),
@@ -132,5 +170,28 @@ urlpatterns = patterns('',
     url(r'^car/(?P<car_slug>[^/]+)/reports/distance_per_time/$',
         login_required(DistancePerTime.as_view()),
         name='auto_maintenance_distance_per_time'),
+    url(r'^car/(?P<car_slug>[^/]+)/reports/location/$',
+        login_required(LocationReport.as_view()),
+        name='auto_maintenance_location_report'),
+    url(r'^car/(?P<car_slug>[^/]+)/reports/totals/$',
+        login_required(ReportTotalsView.as_view()),
+        name='auto_maintenance_report_totals'),
+
+    # Api
+    url(r'^api/records/batch/$', BatchIngestionView.as_view(),
+        name='auto_maintenance_batch_ingestion'),
+    url(r'^api/locations/$',
+        login_required(LocationAutocompleteView.as_view()),
+        name='auto_maintenance_location_autocomplete'),
+    url(r'^api/changes/$', ChangeFeedView.as_view(),
+        name='auto_maintenance_change_feed'),
+
+    # Report Jobs
+    url(r'^car/(?P<car_slug>[^/]+)/reports/(?P<report>[^/]+)/job/$',
+        login_required(SubmitReportJobView.as_view()),
+        name='auto_maintenance_submit_report_job'),
+    url(r'^reports/jobs/(?P<pk>\d+)/$',
+        login_required(ReportJobStatusView.as_view()),
+        name='auto_maintenance_report_job_status'),
                        
 )
@@ -0,0 +1,117 @@
+##
+# Automaintenance.  Django app to track automaintenance records.
+# Copyright (C) 2012 Robert Robinson
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+##
+from django.db import IntegrityError, transaction
+from django.db.models import F
+from django.utils.timezone import now
+
+from automaintenance.models import Car, CarVersion, RemovedCarVersion
+from automaintenance.sequences import chunks
+
+
+def bump_car_versions(car_ids):
+    """
+        Increment the data version of the cars provided.
+    """
+    car_ids = list(car_ids)
+    modified = now()
+
+    CarVersion.objects.filter(car__in=car_ids).update(
+        version=F('version') + 1, modified=modified)
+
+    existing = set(CarVersion.objects.filter(car__in=car_ids).values_list(
+        'car', flat=True))
+    missing = [car_id for car_id in car_ids if car_id not in existing]
+    if not missing:
+        return
+
+    # A car that got the primary key of a removed car continues from the
+    # last version of the removed car.
+    removed = dict(RemovedCarVersion.objects.filter(
+        car_id__in=missing).values_list('car_id', 'version'))
+
+    for car_id in missing:
+        try:
+            CarVersion.objects.create(car_id=car_id,
+                                      version=removed.get(car_id, 0) + 1,
+                                      modified=modified)
+        except IntegrityError:
+            # Another request created the version at the same time, which
+            # bumped it already.
+            transaction.rollback_unless_managed()
+
+
+def retire_car_versions(car_ids):
+    """
+        Keep the last data version of the cars that are removed, so that
+        the versions of a car that gets one of their primary keys never
+        repeat theirs, and remove their version rows.
+    """
+    car_ids = list(car_ids)
+    for car_id, version in CarVersion.objects.filter(
+            car__in=car_ids).values_list('car', 'version'):
+        removed, created = RemovedCarVersion.objects.get_or_create(
+            car_id=car_id, defaults={'version': version})
+        if removed.version < version:
+            removed.version = version
+            removed.save()
+    CarVersion.objects.filter(car__in=car_ids).delete()
+
+
+def car_data_version(car_id):
+    """
+        Returns the data version of the car with the id, 0 if the car has
+        never changed.
+    """
+    for version in CarVersion.objects.filter(car=car_id).values_list(
+            'version', flat=True)[:1]:
+        return version
+    return 0
+
+
+def car_data_versions(car_ids):
+    """
+        Returns the data versions of the cars with the ids keyed by car id,
+        0 for the cars that have never changed.
+    """
+    versions = dict((car_id, 0) for car_id in car_ids)
+    for chunk in chunks(list(versions)):
+        versions.update(CarVersion.objects.filter(car__in=chunk).values_list(
+            'car', 'version'))
+    return versions
+
+
+def car_version(owner, car_slug):
+    """
+        Returns the data version of the car of the owner with the slug, 0 if
+        the car has never changed.
+    """
+    versions = CarVersion.objects.filter(car__owner=owner,
+                                         car__slug=car_slug,
+                                         car__deleted__isnull=True)
+    for version in versions.values_list('version', flat=True)[:1]:
+        return version
+    return 0
+
+
+def fleet_signature(owner):
+    """
+        Returns the cars of the owner as they are shown in the menus of every
+        page.
+    """
+    return list(Car.objects.filter(owner=owner).values_list('pk', 'slug',
+                                                            'name'))
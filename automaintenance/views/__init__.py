@@ -1 +1,15 @@
-MAINTENANCE_CRUD_BACK_KEY = 'maintenance_back_crud'
\ No newline at end of file
+from django.core.serializers.json import DjangoJSONEncoder
+from django.http import HttpResponse
+
+import json
+
+MAINTENANCE_CRUD_BACK_KEY = 'maintenance_back_crud'
+
+
+def json_response(data, status=200):
+    """
+        Returns a response with the data serialized as json.  Dates and
+        decimals are serialized as strings.
+    """
+    return HttpResponse(json.dumps(data, cls=DjangoJSONEncoder),
+                        content_type='application/json', status=status)
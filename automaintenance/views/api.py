@@ -0,0 +1,214 @@
+##
+# Automaintenance.  Django app to track automaintenance records.
+# Copyright (C) 2012 Robert Robinson
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+##
+
+from django.contrib.auth import authenticate
+from django.utils.decorators import method_decorator
+from django.views.decorators.csrf import csrf_exempt
+from django.views.generic import View
+from django.shortcuts import get_object_or_404
+
+from automaintenance.ingestion import ingest_records, IngestionConflict
+from automaintenance.ingestion import MAX_BATCH_SIZE
+from automaintenance.locations import complete_location
+from automaintenance.changes import changes_since, change_horizon
+from automaintenance.changes import latest_change
+from automaintenance.models import Car
+from automaintenance.views.mixins import ReplicaReadMixin
+from automaintenance.views import json_response
+
+import base64
+import binascii
+import json
+
+
+def api_user(request):
+    """
+        Returns the user making the api request, either logged in with a
+        session or with http basic authentication, or None.
+    """
+    if request.user.is_authenticated():
+        return request.user
+
+    authorization = request.META.get('HTTP_AUTHORIZATION', '').split()
+    if len(authorization) == 2 and authorization[0].lower() == 'basic':
+        try:
+            username, password = base64.b64decode(
+                authorization[1]).decode('utf-8').split(':', 1)
+        except (TypeError, ValueError, binascii.Error):
+            return None
+        user = authenticate(username=username, password=password)
+        if user is not None and user.is_active:
+            return user
+
+    return None
+
+
+class BatchIngestionView(View):
+    """
+        Accepts a json document with a list of gasoline purchase, oil change,
+        maintenance and payment records for any of the cars of the user::
+
+            {"records": [{"key": "fuelcard-1234",
+                          "record_type": "gasolinepurchase",
+                          "car": "civic", "date": "2013-05-01T08:30:00",
+                          "mileage": 12000, "fuel_amount": "10.5", ...}]}
+
+        Records are validated with the rules of the record forms and inserted
+        with one bulk insert per type.  Keys make the requests idempotent,
+        sending a key again reports the record it already created.
+    """
+
+    @method_decorator(csrf_exempt)
+    def dispatch(self, request, *args, **kwargs):
+        """
+            Json requests can't be sent by forms of other sites, so the
+            request doesn't need a csrf token.
+        """
+        return super(BatchIngestionView, self).dispatch(request, *args,
+                                                        **kwargs)
+
+    def post(self, request, *args, **kwargs):
+        """
+            Ingest the records and respond with one result per record.
+        """
+        user = api_user(request)
+        if user is None:
+            response = json_response({'error': 'Authentication required'},
+                                     status=401)
+            response['WWW-Authenticate'] = 'Basic realm="automaintenance"'
+            return response
+
+        if not request.META.get('CONTENT_TYPE', '').startswith(
+                'application/json'):
+            return json_response({'error': 'Expected application/json'},
+                                 status=415)
+
+        try:
+            records = json.loads(request.body.decode('utf-8'))['records']
+        except (ValueError, KeyError, TypeError):
+            return json_response({'error': 'Expected a list of records'},
+                                 status=400)
+
+        if not isinstance(records, list):
+            return json_response({'error': 'Expected a list of records'},
+                                 status=400)
+
+        if len(records) > MAX_BATCH_SIZE:
+            return json_response({'error': 'Batches are limited to %d '
+                                           'records' % MAX_BATCH_SIZE},
+                                 status=413)
+
+        try:
+            results = ingest_records(user, records)
+        except IngestionConflict:
+            return json_response({'error': 'The batch conflicts with records '
+                                           'written at the same time, retry '
+                                           'the batch'}, status=409)
+
+        return json_response({'results': results})
+
+
+class LocationAutocompleteView(ReplicaReadMixin, View):
+    """
+        Returns the most used locations of the user that start with the q
+        parameter, used to complete the location of the record forms::
+
+            {"locations": [{"name": "Shell", "uses": 12}, ...]}
+    """
+
+    # Largest number of locations returned.
+    max_limit = 50
+
+    def get(self, request, *args, **kwargs):
+        """
+            Look up the locations that start with the prefix.
+        """
+        try:
+            limit = min(int(request.GET.get('limit', 10)), self.max_limit)
+        except ValueError:
+            limit = 10
+
+        locations = complete_location(request.user, request.GET.get('q', ''),
+                                      limit)
+        return json_response({'locations': [
+            {'name': location.name, 'uses': location.uses}
+            for location in locations]})
+
+
+class ChangeFeedView(View):
+    """
+        Returns the changes to the cars, trips and records of the user after
+        the cursor, so clients only download what changed since they last
+        synced::
+
+            {"changes": [{"sequence": 42, "action": "update",
+                          "type": "gasolinepurchase", "id": 7, "car": 1,
+                          "data": {"id": 7, "car_id": 1, ...}}, ...],
+             "cursor": 42, "more": false}
+
+        The cursor of the response is passed back as the cursor parameter of
+        the next request.  The car parameter limits the changes to the car
+        with the slug.  Cursors older than the compacted part of the feed get
+        a 410 response, the client downloads everything again and continues
+        from the cursor of that response.
+    """
+
+    # Largest number of changes returned.
+    max_limit = 1000
+
+    def get(self, request, *args, **kwargs):
+        """
+            Look up the changes after the cursor.
+        """
+        user = api_user(request)
+        if user is None:
+            response = json_response({'error': 'Authentication required'},
+                                     status=401)
+            response['WWW-Authenticate'] = 'Basic realm="automaintenance"'
+            return response
+
+        try:
+            cursor = max(int(request.GET.get('cursor', 0)), 0)
+            limit = min(max(int(request.GET.get('limit', 100)), 1),
+                        self.max_limit)
+        except ValueError:
+            return json_response({'error': 'Expected a numeric cursor and '
+                                           'limit'}, status=400)
+
+        car_id = None
+        if request.GET.get('car'):
+            car_id = get_object_or_404(Car, slug=request.GET['car'],
+                                       owner=user).pk
+
+        horizon = change_horizon(user)
+        if cursor < horizon:
+            return json_response({
+                'error': 'The cursor is older than the change feed, '
+                         'download the history again',
+                'cursor': max(latest_change(user) or 0, horizon)},
+                status=410)
+
+        changes, more = changes_since(user, cursor, limit, car_id)
+        if changes:
+            cursor = changes[-1][0].pk
+
+        return json_response({'changes': [
+            {'sequence': change.pk, 'action': change.action,
+             'type': change.object_type, 'id': change.object_id,
+             'car': change.car_id, 'data': data}
+            for change, data in changes], 'cursor': cursor, 'more': more})
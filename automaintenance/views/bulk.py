@@ -0,0 +1,90 @@
+##
+# Automaintenance.  Django app to track automaintenance records.
+# Copyright (C) 2012 Robert Robinson
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+##
+
+from django.views.generic import FormView
+
+from django.shortcuts import get_object_or_404
+
+from automaintenance.models import Car
+from automaintenance.bulk import delete_records, move_records_to_trip
+from automaintenance.bulk import move_records_to_car
+from automaintenance.views.forms import BulkRecordForm, BULK_DELETE
+from automaintenance.views.forms import BULK_MOVE_TO_TRIP, BULK_MOVE_TO_CAR
+
+
+class BulkRecordView(FormView):
+    """
+        Delete or move many records of a car in one request.  The records are
+        changed with one statement per record type inside of one transaction.
+    """
+    form_class = BulkRecordForm
+    template_name = 'automaintenance/bulk_form.html'
+
+    def get(self, request, *args, **kwargs):
+        """
+            Override get to add a car field to the class object.
+        """
+        self.car = get_object_or_404(Car,
+                                     slug=self.kwargs.get('car_slug', None),
+                                     owner=request.user)
+        return super(BulkRecordView, self).get(request, *args, **kwargs)
+
+    def post(self, request, *args, **kwargs):
+        """
+            Override the post field to add a car field to the class object.
+        """
+        self.car = get_object_or_404(Car,
+                                     slug=self.kwargs.get('car_slug', None),
+                                     owner=request.user)
+        return super(BulkRecordView, self).post(request, *args, **kwargs)
+
+    def get_form(self, form_class):
+        """
+            The form needs the car to limit the trips and cars.
+        """
+        return form_class(self.car, **self.get_form_kwargs())
+
+    def form_valid(self, form):
+        """
+            Run the action on the selected records.
+        """
+        action = form.cleaned_data['action']
+        querysets = form.get_querysets()
+
+        if action == BULK_DELETE:
+            delete_records(querysets)
+        elif action == BULK_MOVE_TO_TRIP:
+            move_records_to_trip(querysets, form.cleaned_data['trip'])
+        elif action == BULK_MOVE_TO_CAR:
+            move_records_to_car(querysets, form.cleaned_data['car'])
+
+        return super(BulkRecordView, self).form_valid(form)
+
+    def get_context_data(self, **kwargs):
+        """
+            Add the car to the context.
+        """
+        context = super(BulkRecordView, self).get_context_data(**kwargs)
+        context['car'] = self.car
+        return context
+
+    def get_success_url(self):
+        """
+            Go back to the car's detail page.
+        """
+        return self.car.get_absolute_url()
@@ -23,16 +23,21 @@ from django.core.exceptions import ObjectDoesNotExist
 from django.template.defaultfilters import slugify
 
 from automaintenance.models import Car, GasolinePurchase, OilChange
-from automaintenance.models import Trip
+from automaintenance.models import Trip, ServiceDue
 from automaintenance.views.forms import CarForm
 from automaintenance.views import MAINTENANCE_CRUD_BACK_KEY
-from datetime import date
-
-from decimal import Decimal
+from automaintenance.views.mixins import ReplicaReadMixin, ConditionalGetMixin
+from automaintenance.versions import car_version, fleet_signature
+from automaintenance.ranges import range_index
+from automaintenance.rows import record_rows
+from automaintenance.archive import latest_archived
+from datetime import date, datetime
+
+from django.utils.timezone import utc
 from django.core.paginator import Paginator, EmptyPage, PageNotAnInteger
 
 
-class CarListView(ListView):
+class CarListView(ReplicaReadMixin, ListView):
     """
         Return the list of cars that are owned by the user that is posting the
         requests.
@@ -133,7 +138,7 @@ class EditCarView(UpdateView):
         return self.object.get_absolute_url()        
 
 
-class DisplayCar(DetailView):
+class DisplayCar(ReplicaReadMixin, ConditionalGetMixin, DetailView):
     """
         The view that is responsible for showing off all of the details of the
         car, including the records that make up the maintenance values of the
@@ -148,6 +153,24 @@ class DisplayCar(DetailView):
         """
         return Car.objects.filter(owner=self.request.user)
 
+    def get_etag_parts(self):
+        """
+            The car page only changes with the version of the car, the cars in
+            the menu and the year of the year to date totals.
+        """
+        slug = self.kwargs.get('slug')
+        parts = super(DisplayCar, self).get_etag_parts()
+        parts += [slug, car_version(self.request.user, slug),
+                  fleet_signature(self.request.user), date.today().year]
+        return parts
+
+    def not_modified(self):
+        """
+            The record pages still need to come back to this car.
+        """
+        for car in self.get_queryset().filter(slug=self.kwargs.get('slug')):
+            self.request.session[MAINTENANCE_CRUD_BACK_KEY] = car
+
     def get_context_data(self, **kwargs):
         """
             Adding some contextual data to the view including:
@@ -158,38 +181,39 @@ class DisplayCar(DetailView):
         context = super(DetailView, self).get_context_data(**kwargs)
 
         # Populate the maintenance list for this car
-        maintenance_list = self.object.get_maintenance_list()
+        maintenance_list = record_rows(self.object)
 
         # Populate the last oil change for this car
         try:
             context['has_last_oil_change'] = True
             context['last_oil_change'] = OilChange.objects.filter(car=self.object).latest()
         except ObjectDoesNotExist:
-            context['has_last_oil_change'] = False
+            context['last_oil_change'] = latest_archived(self.object, OilChange)
+            context['has_last_oil_change'] = context['last_oil_change'] is not None
 
         # Populate the last fill up for this car
         try:
             context['has_last_gas_purchase'] = True
             context['last_gas_purchase'] = GasolinePurchase.objects.filter(car=self.object).latest()
         except ObjectDoesNotExist:
-            context['has_last_gas_purchase'] = False
+            context['last_gas_purchase'] = latest_archived(self.object, GasolinePurchase)
+            context['has_last_gas_purchase'] = context['last_gas_purchase'] is not None
+
+        # Populate the services that are coming up for this car
+        context['service_due_list'] = ServiceDue.objects.filter(
+            car=self.object)
 
         # Populate the tirp list for this car
         context['trip_list'] = Trip.objects.filter(car=self.object)
         
         # Calculate the total cost of maintaining the car
-        total_cost = Decimal(0.0)
-        ytd_cost = Decimal(0.0)
-        ytd_mileage = Decimal(0.0)
-        current_year = date.today().year
-        
-        for maintenance in maintenance_list:
-            total_cost += maintenance.total_cost
-            if maintenance.date.year == current_year:
-                ytd_cost += maintenance.total_cost
+        index = range_index(self.object)
+        year_start = datetime(date.today().year, 1, 1, tzinfo=utc)
+        this_year = index.totals(start_date=year_start)
 
-                if hasattr(maintenance, 'tank_mileage'):
-                    ytd_mileage += maintenance.tank_mileage
+        total_cost = index.totals()['cost']
+        ytd_cost = this_year['cost']
+        ytd_mileage = this_year['distance']
 
         context['total_cost'] = total_cost
         context['ytd_cost'] = ytd_cost
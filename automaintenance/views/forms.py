@@ -19,9 +19,26 @@ from django.forms import ModelForm
 from django import forms
 from django.core.exceptions import ValidationError
 from django.template.defaultfilters import slugify
+from django.core.urlresolvers import reverse_lazy
 from automaintenance.models import Car, GasolinePurchase, OilChange
-from automaintenance.models import Maintenance, Trip, Payment
+from automaintenance.models import Maintenance, Trip, Payment, RECORD_MODELS
+from automaintenance.search import SEARCH_SOURCES
 from django.forms.util import ErrorList
+from django.utils.timezone import make_aware, get_default_timezone
+
+from datetime import datetime, time
+
+
+def location_widget():
+    """
+        Returns the widget of the location fields, which completes the
+        location from the location dictionary of the user.
+    """
+    return forms.TextInput(attrs={
+        'autocomplete': 'off',
+        'data-location-source': reverse_lazy(
+            'auto_maintenance_location_autocomplete'),
+    })
 
 
 class SpanErrorList(ErrorList):
@@ -108,6 +125,7 @@ class GasolinePurchaseForm(ModelForm):
                   'filled_tank')
         widgets = {
             'date': forms.SplitDateTimeWidget(),
+            'location': location_widget(),
         }
 
 
@@ -133,6 +151,7 @@ class OilChangeForm(ModelForm):
         )
         widgets = {
             'date': forms.SplitDateTimeWidget(),
+            'location': location_widget(),
         }
 
 
@@ -165,6 +184,7 @@ class MaintenanceForm(ModelForm):
         )
         widgets = {
             'date': forms.SplitDateTimeWidget(),
+            'location': location_widget(),
         }
 
 
@@ -231,4 +251,149 @@ class PaymentForm(ModelForm):
                   'trip',)
         widgets = {
             'date': forms.SplitDateTimeWidget(),
+            'location': location_widget(),
             }
+
+
+BULK_DELETE = 'delete'
+BULK_MOVE_TO_TRIP = 'move_to_trip'
+BULK_MOVE_TO_CAR = 'move_to_car'
+
+BULK_ACTIONS = ((BULK_DELETE, 'Delete'),
+                (BULK_MOVE_TO_TRIP, 'Move to Trip'),
+                (BULK_MOVE_TO_CAR, 'Move to Car'),)
+
+# Record models keyed by the name used to select records of that type.
+RECORD_TYPES = dict((model.__name__.lower(), model) for model in RECORD_MODELS)
+
+
+class BulkRecordForm(forms.Form):
+    """
+        Form that selects records of a car, either listed as type:pk values
+        or with a filter, and the bulk action to run on them.
+    """
+    action = forms.ChoiceField(choices=BULK_ACTIONS)
+    records = forms.Field(required=False, widget=forms.MultipleHiddenInput)
+    record_type = forms.ChoiceField(
+        required=False,
+        choices=[('', 'All')] + [(name, model._meta.verbose_name.title())
+                                 for name, model in RECORD_TYPES.items()])
+    start_date = forms.DateField(required=False)
+    end_date = forms.DateField(required=False)
+    from_trip = forms.ModelChoiceField(queryset=Trip.objects.none(),
+                                       required=False)
+    trip = forms.ModelChoiceField(queryset=Trip.objects.none(),
+                                  required=False)
+    car = forms.ModelChoiceField(queryset=Car.objects.none(), required=False)
+
+    def __init__(self, car, *args, **kwargs):
+        """
+            Limit the trips to the ones of the car and the cars to the other
+            cars of the same owner.
+        """
+        super(BulkRecordForm, self).__init__(*args, **kwargs)
+        self.car = car
+        self.fields['from_trip'].queryset = Trip.objects.filter(car=car)
+        self.fields['trip'].queryset = Trip.objects.filter(car=car)
+        self.fields['car'].queryset = Car.objects.filter(
+            owner=car.owner).exclude(pk=car.pk)
+
+    def clean_records(self):
+        """
+            Parse the type:pk values into lists of primary keys keyed by the
+            record type.
+        """
+        records = {}
+        for value in self.cleaned_data['records'] or []:
+            try:
+                type_name, pk = value.split(':')
+                records.setdefault(RECORD_TYPES[type_name], []).append(int(pk))
+            except (ValueError, KeyError):
+                raise ValidationError("Invalid record %s" % value)
+        return records
+
+    def clean(self):
+        """
+            Make sure that the action doesn't run on every record of the car
+            by accident, and that there is a car to move the records to.
+        """
+        cleaned_data = self.cleaned_data
+
+        filters = ('records', 'record_type', 'start_date', 'end_date',
+                   'from_trip')
+        if not any(cleaned_data.get(name) for name in filters):
+            raise ValidationError("Select records or a filter")
+
+        if cleaned_data.get('action') == BULK_MOVE_TO_CAR and \
+                not cleaned_data.get('car'):
+            raise ValidationError("Select the car to move the records to")
+
+        return cleaned_data
+
+    def get_querysets(self):
+        """
+            Returns one queryset per record type selecting the records.
+        """
+        records = self.cleaned_data['records']
+        record_type = self.cleaned_data['record_type']
+        start_date = self.cleaned_data['start_date']
+        end_date = self.cleaned_data['end_date']
+        from_trip = self.cleaned_data['from_trip']
+
+        querysets = []
+        for name, model in RECORD_TYPES.items():
+            if record_type and name != record_type:
+                continue
+            if records and model not in records:
+                continue
+
+            queryset = model.objects.filter(car=self.car)
+            if records:
+                queryset = queryset.filter(pk__in=records[model])
+            if start_date is not None:
+                queryset = queryset.filter(date__gte=make_aware(
+                    datetime.combine(start_date, time(0)),
+                    get_default_timezone()))
+            if end_date is not None:
+                queryset = queryset.filter(date__lte=make_aware(
+                    datetime.combine(end_date, time.max),
+                    get_default_timezone()))
+            if from_trip is not None:
+                queryset = queryset.filter(trip=from_trip)
+
+            querysets.append(queryset)
+
+        return querysets
+
+
+class SearchForm(forms.Form):
+    """
+        Form that searches the records and trips of one or all cars.
+    """
+    q = forms.CharField(max_length=200, label='Search')
+    record_type = forms.ChoiceField(
+        required=False,
+        choices=[('', 'All')] + [(source.name,
+                                  source.model._meta.verbose_name.title())
+                                 for source in SEARCH_SOURCES])
+    start_date = forms.DateField(required=False)
+    end_date = forms.DateField(required=False)
+
+    def get_search_kwargs(self):
+        """
+            Returns the filters of the search.
+        """
+        record_type = self.cleaned_data['record_type']
+        start_date = self.cleaned_data['start_date']
+        end_date = self.cleaned_data['end_date']
+
+        kwargs = {'types': [record_type] if record_type else None}
+        if start_date is not None:
+            kwargs['start_date'] = make_aware(datetime.combine(start_date,
+                                                               time(0)),
+                                              get_default_timezone())
+        if end_date is not None:
+            kwargs['end_date'] = make_aware(datetime.combine(end_date,
+                                                             time.max),
+                                            get_default_timezone())
+        return kwargs
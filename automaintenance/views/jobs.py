@@ -0,0 +1,117 @@
+##
+# Automaintenance.  Django app to track automaintenance records.
+# Copyright (C) 2012 Robert Robinson
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+##
+
+from django.http import Http404
+from django.shortcuts import get_object_or_404
+from django.core.urlresolvers import reverse
+from django.views.generic import View
+from django.utils.timezone import make_aware, get_default_timezone
+
+from automaintenance.models import ReportJob
+from automaintenance.jobs import submit_report_job
+from automaintenance.views.report import ReportView, REPORTS
+from automaintenance.views import json_response
+
+from datetime import date, datetime, time, timedelta
+import json
+
+
+def job_response(job):
+    """
+        Returns the json response describing the report job.
+    """
+    data = {
+        'id': job.pk,
+        'report': job.report,
+        'status': job.status,
+        'url': reverse('auto_maintenance_report_job_status',
+                       kwargs={'pk': job.pk}),
+    }
+
+    if job.result:
+        data['result'] = json.loads(job.result)
+    if job.error:
+        data['error'] = job.error
+
+    return json_response(data)
+
+
+class SubmitReportJobView(ReportView):
+    """
+        Queue the report in the url to be computed in the background, the
+        date range is read the same way as the report pages.  Identical
+        requests that are still running share the same job.
+    """
+
+    def get_etag(self):
+        """
+            Submitting a job always runs the view.
+        """
+        return None
+
+    def convert_dates(self):
+        """
+            Jobs without an end date cover the records up to the end of the
+            day, so that the requests of the day share one job instead of
+            ending at the current time.
+        """
+        super(SubmitReportJobView, self).convert_dates()
+        if 'end_date' not in self.request.GET:
+            self.end_date = make_aware(datetime.combine(
+                date.today() + timedelta(days=1), time(0)),
+                get_default_timezone())
+            if 'start_date' not in self.request.GET:
+                self.start_date = self.end_date - timedelta(weeks=4)
+
+    def get(self, request, *args, **kwargs):
+        """
+            Submit the job and respond with its status.
+        """
+        report = kwargs['report']
+        if report not in REPORTS:
+            raise Http404
+
+        self.get_car(kwargs['car_slug'])
+        self.convert_dates()
+
+        job = submit_report_job(report, self.car, self.start_date,
+                                self.end_date)
+
+        return job_response(job)
+
+    def post(self, request, *args, **kwargs):
+        """
+            Submitting a job can be done with either method.
+        """
+        return self.get(request, *args, **kwargs)
+
+
+class ReportJobStatusView(View):
+    """
+        Poll the status of a report job, the result is included once the job
+        is done.
+    """
+
+    def get(self, request, *args, **kwargs):
+        """
+            Respond with the status of the job if it belongs to the user.
+        """
+        job = get_object_or_404(ReportJob, pk=kwargs['pk'],
+                                car__owner=request.user)
+
+        return job_response(job)
@@ -27,6 +27,7 @@ from automaintenance.models import Maintenance, Trip
 from automaintenance.views.forms import GasolinePurchaseForm, OilChangeForm
 from automaintenance.views.forms import MaintenanceForm, TripForm
 from automaintenance.views import MAINTENANCE_CRUD_BACK_KEY
+from automaintenance.views.mixins import TripChoiceMixin
 
 import datetime
 from django.utils.timezone import utc
@@ -70,7 +71,7 @@ class MaintenanceView(DetailView):
         return self.model.objects.filter(car=self.car)
 
 
-class CreateMaintenanceView(CreateView):
+class CreateMaintenanceView(TripChoiceMixin, CreateView):
     """
         View that will allow for the creation of new maintenance records.  This
         class can be used as a base class for the creation of all maintenance
@@ -129,21 +130,8 @@ class CreateMaintenanceView(CreateView):
 
         return super(CreateView, self).post(request, *args, **kwargs)
 
-    def get_form(self, form_class):
-        """
-            Returns an instance of the form to be used in this view.  Overriden
-            to limit the trips that are going to be used to the ones that
-            are allowed in the currently edited car.
-        """
-        form = super(CreateMaintenanceView, self).get_form(form_class)
-
-        form.fields['trip'].queryset = Trip.objects.filter(
-            car=self.car)
-
-        return form
-
 
-class EditMaintenanceView(UpdateView):
+class EditMaintenanceView(TripChoiceMixin, UpdateView):
     """
         Override the update view to edit maintenance items on a specific car.
     """
@@ -0,0 +1,38 @@
+##
+# Automaintenance.  Django app to track automaintenance records.
+# Copyright (C) 2012 Robert Robinson
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+##
+from django.conf import settings
+from django.views.generic import View
+from django.http import HttpResponse, HttpResponseForbidden
+
+from automaintenance.metrics import registry
+
+
+class MetricsView(View):
+    """
+        Metrics of every worker process in the text exposition format, for
+        staff users and the addresses listed in INTERNAL_IPS.
+    """
+
+    def get(self, request, *args, **kwargs):
+        user = getattr(request, 'user', None)
+        if not (user is not None and user.is_staff) and \
+                request.META.get('REMOTE_ADDR') not in settings.INTERNAL_IPS:
+            return HttpResponseForbidden()
+
+        return HttpResponse(registry.collect().exposition(),
+                            content_type='text/plain; version=0.0.4')
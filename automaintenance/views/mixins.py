@@ -0,0 +1,144 @@
+##
+# Automaintenance.  Django app to track automaintenance records.
+# Copyright (C) 2012 Robert Robinson
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+##
+from django.core.urlresolvers import reverse
+from django.utils.timezone import now
+from django.views.decorators.http import condition
+
+from automaintenance.models import Trip
+from automaintenance.routers import replica_reads, pinned_to_default
+from automaintenance.trips import nearby_trips
+
+import hashlib
+
+
+class ReplicaReadMixin(object):
+    """
+        Mixin for read only views that sends their reads, including the ones
+        made while the template is rendered, to the replica database.  Reads
+        stay on the default database right after the session wrote something.
+    """
+
+    def dispatch(self, request, *args, **kwargs):
+        """
+            Run the view and render the response inside of a replica block.
+        """
+        if request.method not in ('GET', 'HEAD') or \
+                pinned_to_default(request):
+            return super(ReplicaReadMixin, self).dispatch(request, *args,
+                                                          **kwargs)
+
+        with replica_reads():
+            response = super(ReplicaReadMixin, self).dispatch(request, *args,
+                                                              **kwargs)
+            if hasattr(response, 'render') and callable(response.render):
+                response.render()
+
+        return response
+
+
+class ConditionalGetMixin(object):
+    """
+        Mixin for views whose content only depends on versioned data.  The
+        view returns 304 Not Modified without running when the ETag built
+        from get_etag_parts matches the one the client already has.
+    """
+
+    def get_etag_parts(self):
+        """
+            Returns the values that the content of the page depends on.
+        """
+        return [self.request.user.pk, self.request.GET.urlencode()]
+
+    def get_etag(self):
+        """
+            Returns the ETag of the page.
+        """
+        parts = repr(self.get_etag_parts())
+        return hashlib.md5(parts.encode('utf-8')).hexdigest()
+
+    def not_modified(self):
+        """
+            Called when the page was not modified instead of running the view.
+        """
+        pass
+
+    def dispatch(self, request, *args, **kwargs):
+        """
+            Only run the view when the ETag of the client is out of date.
+        """
+        parent = super(ConditionalGetMixin, self).dispatch
+
+        if request.method not in ('GET', 'HEAD'):
+            return parent(request, *args, **kwargs)
+
+        etag = self.get_etag()
+        if etag is None:
+            return parent(request, *args, **kwargs)
+
+        response = condition(etag_func=lambda *args, **kwargs: etag)(parent)(
+            request, *args, **kwargs)
+
+        if response.status_code == 304:
+            self.not_modified()
+
+        return response
+
+
+class TripChoiceMixin(object):
+    """
+        Mixin for the record form views that only offers the trips of the car
+        that were going on around the date of the record, so rendering the
+        form doesn't depend on the number of trips.  Other trips are found
+        with the trip search.
+    """
+
+    def get_record_date(self):
+        """
+            Returns the date that the offered trips are picked around.
+        """
+        if getattr(self, 'object', None) is not None:
+            return self.object.date
+        return now()
+
+    def get_form(self, form_class):
+        """
+            Limit the trips to the ones of the car, and only render the ones
+            around the date of the record along with the selected trip.
+        """
+        form = super(TripChoiceMixin, self).get_form(form_class)
+
+        # Validating the choice looks up the one trip that was picked, so
+        # the field can keep every trip of the car.
+        field = form.fields['trip']
+        field.queryset = Trip.objects.filter(car=self.car)
+
+        trips = list(nearby_trips(self.car, self.get_record_date()))
+
+        try:
+            selected = int(form['trip'].value() or 0)
+        except (TypeError, ValueError):
+            selected = 0
+        if selected and selected not in [trip.pk for trip in trips]:
+            trips.extend(Trip.objects.filter(car=self.car, pk=selected))
+
+        field.widget.choices = [('', field.empty_label)] + [
+            (trip.pk, unicode(trip)) for trip in trips]
+        field.widget.attrs['data-trip-source'] = reverse(
+            'auto_maintenance_trip_search', args=[self.car.slug])
+
+        return form
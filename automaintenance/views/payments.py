@@ -22,9 +22,10 @@ from django.views.generic import DeleteView
 from django.shortcuts import get_object_or_404
 
 from automaintenance.models import Car
-from automaintenance.models import Trip, Payment
+from automaintenance.models import Payment
 from automaintenance.views.forms import PaymentForm
 from automaintenance.views import MAINTENANCE_CRUD_BACK_KEY
+from automaintenance.views.mixins import TripChoiceMixin
 
 
 class PaymentView(DetailView):
@@ -63,7 +64,7 @@ class PaymentView(DetailView):
         return self.model.objects.filter(car=self.car)
 
 
-class CreatePaymentView(CreateView):
+class CreatePaymentView(TripChoiceMixin, CreateView):
     """
         View that will allow for the creation of new maintenance records.  This
         class can be used as a base class for the creation of all maintenance
@@ -121,21 +122,8 @@ class CreatePaymentView(CreateView):
 
         return super(CreatePaymentView, self).post(request, *args, **kwargs)
 
-    def get_form(self, form_class):
-        """
-            Returns an instance of the form to be used in this view.  Overridden
-            to limit the trips that are going to be used to the ones that
-            are allowed in the currently edited car.
-        """
-        form = super(CreatePaymentView, self).get_form(form_class)
-
-        form.fields['trip'].queryset = Trip.objects.filter(
-            car=self.car)
-
-        return form
-
 
-class EditPaymentView(UpdateView):
+class EditPaymentView(TripChoiceMixin, UpdateView):
     """
         Override the update view to edit maintenance items on a specific car.
     """
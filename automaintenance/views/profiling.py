@@ -0,0 +1,70 @@
+##
+# Automaintenance.  Django app to track automaintenance records.
+# Copyright (C) 2012 Robert Robinson
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+##
+from django.views.generic import TemplateView, View
+from django.http import Http404, HttpResponse
+
+from automaintenance.profiling import list_profiles, load_profile
+from automaintenance.profiling import profile_path
+
+
+class ProfileListView(TemplateView):
+    """
+        List the stored request profiles, latest first.
+    """
+    template_name = 'automaintenance/profile_list.html'
+
+    def get_context_data(self, **kwargs):
+        context = super(ProfileListView, self).get_context_data(**kwargs)
+        context['profile_list'] = list_profiles()
+        return context
+
+
+class ProfileDetailView(TemplateView):
+    """
+        Show the queries and the slowest functions of a request profile.
+    """
+    template_name = 'automaintenance/profile_detail.html'
+
+    def get_context_data(self, **kwargs):
+        context = super(ProfileDetailView, self).get_context_data(**kwargs)
+        profile = load_profile(self.kwargs['profile_id'])
+        if profile is None:
+            raise Http404
+        profile['queries'].sort(key=lambda query: query['time'],
+                                reverse=True)
+        context['profile'] = profile
+        return context
+
+
+class ProfileDownloadView(View):
+    """
+        Download the statistics of a request profile, which can be loaded
+        with pstats or any viewer that reads its format.
+    """
+
+    def get(self, request, *args, **kwargs):
+        profile_id = kwargs['profile_id']
+        if load_profile(profile_id) is None:
+            raise Http404
+
+        with open(profile_path(profile_id, 'prof'), 'rb') as stats:
+            response = HttpResponse(stats.read(),
+                                    content_type='application/octet-stream')
+        response['Content-Disposition'] = 'attachment; filename=%s.prof' % \
+            profile_id
+        return response
@@ -19,19 +19,33 @@
 from django.views.generic.base import TemplateView
 
 from automaintenance.models import GasolinePurchase, Car
+from automaintenance.views.mixins import ReplicaReadMixin, ConditionalGetMixin
+from automaintenance.versions import car_version, fleet_signature
+from automaintenance.locations import location_totals
+from automaintenance.snapshots import car_snapshot, TYPE_GASOLINE
+from automaintenance.rows import record_rows
+from automaintenance.ranges import range_index, cost_per_distance
+from automaintenance.prices import car_price_statistics
+from automaintenance.prices import fleet_price_statistics
+from automaintenance.prices import location_price_statistics
+from automaintenance.prices import statistics_data
+from automaintenance.views import json_response
 
 from django.utils.timezone import make_aware, get_default_timezone
 from django.utils.dateparse import parse_date
 
-from datetime import datetime, time, timedelta
+from datetime import date, datetime, time, timedelta
 
 
-class ReportView(TemplateView):
+class ReportView(ReplicaReadMixin, ConditionalGetMixin, TemplateView):
     """
         Default report view.
     """
     
     template_name = "automaintenance/report.html"
+
+    # Record fields that are plotted against time by the report.
+    series = ()
     
     def convert_dates(self):
         """
@@ -50,6 +64,17 @@ class ReportView(TemplateView):
         self.start_date = make_aware(start_date, get_default_timezone())
         self.end_date = make_aware(end_date, get_default_timezone())
         
+    def get_etag_parts(self):
+        """
+            Reports only change with the version of the car, the cars in the
+            menu and the day that the default date range ends on.
+        """
+        car_slug = self.kwargs.get('car_slug')
+        parts = super(ReportView, self).get_etag_parts()
+        parts += [car_slug, car_version(self.request.user, car_slug),
+                  fleet_signature(self.request.user), date.today()]
+        return parts
+        
     def get_car(self, car_slug):
         """
             Get the car value based on the provided slug.
@@ -61,7 +86,9 @@ class ReportView(TemplateView):
         """
             Filter down the records for the car so that they 
         """
-        self.records = self.car.maintenance_query(GasolinePurchase, self.start_date, self.end_date)
+        self.records = record_rows(self.car, self.start_date, self.end_date,
+                                   models=(GasolinePurchase,))
+        self.records.reverse()
         
         return self.records
     
@@ -79,8 +106,28 @@ class ReportView(TemplateView):
         context['start_date'] = self.start_date
         context['end_date'] = self.end_date
         context['car'] = self.car
+        context['range_totals'] = range_index(self.car).totals(
+            self.start_date, self.end_date)
         
         return context
+
+    def get_report_data(self):
+        """
+            Returns the data of the report in a form that can be serialized,
+            used when the report is computed by a report job.  Each series is
+            a list of [milliseconds since epoch, value] points computed from
+            the snapshot of the car.
+        """
+        gasoline = self.get_snapshot().select(types=[TYPE_GASOLINE])
+        return {'series': dict((field, gasoline.series(field))
+                               for field in self.series)}
+
+    def get_snapshot(self):
+        """
+            Returns the snapshot of the records of the car in the date range
+            of the report.
+        """
+        return car_snapshot(self.car).between(self.start_date, self.end_date)
     
 
 class DistancePerUnitReport(ReportView):
@@ -88,20 +135,91 @@ class DistancePerUnitReport(ReportView):
         Distance per unit report.
     """
     template_name = "automaintenance/report/distance_per_unit.html"
+    series = ('efficency',)
     
 
 class CostPerDistanceReport(ReportView):
     """
-        Cost per distance report.
+        Cost per distance report.  Every cost of the car is spread over the
+        distance driven in trailing windows, not only the fuel.
     """
     template_name = "automaintenance/report/cost_per_distance.html"
+
+    def get_context_data(self, **kwargs):
+        """
+            Add the cost per distance of every window to the context.
+        """
+        context = super(CostPerDistanceReport, self).get_context_data(**kwargs)
+
+        context['cost_windows'] = [{'days': days, 'points': points}
+                                   for days, points in self.get_windows()]
+
+        return context
+
+    def get_windows(self):
+        """
+            Returns the cost per distance points of every trailing window.
+        """
+        return cost_per_distance(range_index(self.car), self.start_date,
+                                 self.end_date)
+
+    def get_report_data(self):
+        """
+            Returns the points of every window for a report job.
+        """
+        return {'series': dict(('%s_days' % days, points)
+                               for days, points in self.get_windows())}
     
 
 class PricePerUnitReport(ReportView):
     """
-        Price per unit report.
+        Price per unit report.  Along with the prices of the fills, it shows
+        the monthly price statistics of the car and of the comparable cars
+        of the owner, and the price statistics per location.
     """
     template_name = "automaintenance/report/price_per_unit.html"
+    series = ('price_per_unit',)
+
+    def get_context_data(self, **kwargs):
+        """
+            Add the price statistics to the context.
+        """
+        context = super(PricePerUnitReport, self).get_context_data(**kwargs)
+
+        context['price_periods'] = self.get_periods()
+        context['price_locations'] = location_price_statistics(
+            self.car, self.start_date, self.end_date)
+
+        return context
+
+    def get_periods(self):
+        """
+            Returns the price statistics of the car and the fleet for every
+            month of the report.
+        """
+        fleet = fleet_price_statistics(self.car, self.start_date,
+                                       self.end_date)
+        return [{'period': date(year, month, 1), 'car': statistics,
+                 'fleet': fleet_statistics}
+                for (year, month, statistics), (fleet_year, fleet_month,
+                                                 fleet_statistics)
+                in zip(car_price_statistics(self.car, self.start_date,
+                                            self.end_date), fleet)]
+
+    def get_report_data(self):
+        """
+            Returns the prices and the price statistics for a report job.
+        """
+        data = super(PricePerUnitReport, self).get_report_data()
+        data['periods'] = [{'period': period['period'].isoformat(),
+                            'car': statistics_data(period['car']),
+                            'fleet': statistics_data(period['fleet'])}
+                           for period in self.get_periods()]
+        data['locations'] = [statistics_data(location) for location in
+                             location_price_statistics(self.car,
+                                                       self.start_date,
+                                                       self.end_date)]
+        return data
     
 
 class CategoryReport(ReportView):
@@ -117,7 +235,7 @@ class CategoryReport(ReportView):
         """
             Filter down the records for the car so that they 
         """
-        self.records = self.car.get_maintenance_list(self.start_date, self.end_date)
+        self.records = record_rows(self.car, self.start_date, self.end_date)
         
         return self.records
     
@@ -126,18 +244,24 @@ class CategoryReport(ReportView):
             Override the context data with the values.
         """
         context = super(CategoryReport, self).get_context_data(**kwargs)
-        
-        categories = {}
-        
-        for record in self.records:
-            if record.human_readable_type() not in categories:
-                categories[record.human_readable_type()] = record.total_cost
-            else:
-                categories[record.human_readable_type()] += record.total_cost
                 
-        context['categories'] = categories
+        context['categories'] = self.get_categories()
         
         return context
+
+    def get_categories(self):
+        """
+            Total the cost of the records by the type of the record.
+        """
+        return self.get_snapshot().group_by('category', 'cost')
+
+    def get_report_data(self):
+        """
+            Returns the cost of each category for a report job.
+        """
+        categories = self.get_categories()
+        return {'categories': dict((key, float(value))
+                                   for key, value in categories.items())}
         
 
 class DistancePerTime(ReportView):
@@ -145,4 +269,83 @@ class DistancePerTime(ReportView):
         Report that tracks the total mileage of a car and the miles that are entered per 
         gasoline record.
     """
-    template_name = "automaintenance/report/distance_per_time.html"
\ No newline at end of file
+    template_name = "automaintenance/report/distance_per_time.html"
+    series = ('mileage', 'tank_mileage')
+
+
+
+class LocationReport(ReportView):
+    """
+        Report that shows the money spent and the price paid for fuel at each
+        location.
+    """
+    template_name = "automaintenance/report/location.html"
+
+    def get_records(self):
+        """
+            List every record of the car in the date range of the report.
+        """
+        self.records = record_rows(self.car, self.start_date, self.end_date)
+
+        return self.records
+
+    def get_context_data(self, **kwargs):
+        """
+            Add the location totals to the context.
+        """
+        context = super(LocationReport, self).get_context_data(**kwargs)
+
+        context['locations'] = self.get_locations()
+
+        return context
+
+    def get_locations(self):
+        """
+            Total the records of the car by location.
+        """
+        return location_totals(self.car, self.start_date, self.end_date)
+
+    def get_report_data(self):
+        """
+            Returns the totals of each location for a report job.
+        """
+        locations = []
+        for totals in self.get_locations():
+            totals = dict(totals)
+            for field in ('spend', 'fuel_amount', 'fuel_spend',
+                          'price_per_unit'):
+                if totals[field] is not None:
+                    totals[field] = float(totals[field])
+            locations.append(totals)
+        return {'locations': locations}
+
+
+# Reports that can be computed by report jobs, keyed by the name used in the
+# report job urls.
+REPORTS = {
+    'mpg': DistancePerUnitReport,
+    'cpm': CostPerDistanceReport,
+    'ppg': PricePerUnitReport,
+    'category_expense': CategoryReport,
+    'distance_per_time': DistancePerTime,
+    'location': LocationReport,
+}
+
+class ReportTotalsView(ReportView):
+    """
+        Returns the totals of the records of the car between the dates as
+        json, so the report pages can update them while the dates are picked
+        without rendering the report::
+
+            {"count": 12, "cost": "412.50", "distance": "3120.000",
+             "fuel": "101.250"}
+    """
+
+    def get(self, request, *args, **kwargs):
+        """
+            Total the records between the dates from the range index.
+        """
+        self.get_car(kwargs['car_slug'])
+        self.convert_dates()
+        return json_response(range_index(self.car).totals(self.start_date,
+                                                          self.end_date))
@@ -0,0 +1,61 @@
+##
+# Automaintenance.  Django app to track automaintenance records.
+# Copyright (C) 2012 Robert Robinson
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+##
+
+from django.views.generic import TemplateView
+
+from django.shortcuts import get_object_or_404
+
+from automaintenance.models import Car
+from automaintenance.search import search
+from automaintenance.views.forms import SearchForm
+from automaintenance.views.mixins import ReplicaReadMixin
+
+
+class SearchView(ReplicaReadMixin, TemplateView):
+    """
+        Full text search over the records and trips of a car, or of all of
+        the cars of the user when the url doesn't name a car.
+    """
+    template_name = 'automaintenance/search.html'
+
+    def get(self, request, *args, **kwargs):
+        """
+            Override get to add a car field to the class object.
+        """
+        self.car = None
+        if 'car_slug' in self.kwargs:
+            self.car = get_object_or_404(Car, slug=self.kwargs['car_slug'],
+                                         owner=request.user)
+        return super(SearchView, self).get(request, *args, **kwargs)
+
+    def get_context_data(self, **kwargs):
+        """
+            Add the form and the results of the search to the context.
+        """
+        context = super(SearchView, self).get_context_data(**kwargs)
+
+        form = SearchForm(self.request.GET or None)
+        results = []
+        if form.is_valid():
+            results = search(self.request.user, form.cleaned_data['q'],
+                             car=self.car, **form.get_search_kwargs())
+
+        context['form'] = form
+        context['car'] = self.car
+        context['results'] = results
+        return context
@@ -0,0 +1,63 @@
+##
+# Automaintenance.  Django app to track automaintenance records.
+# Copyright (C) 2012 Robert Robinson
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+##
+
+from django.views.generic import ListView
+from django.utils.timezone import now
+
+from automaintenance.models import ServiceDue
+
+from datetime import timedelta
+
+
+class ServiceDueListView(ListView):
+    """
+        List the services that are due across all of the cars owned by the
+        user within the number of days requested.
+    """
+    context_object_name = 'service_due_list'
+    model = ServiceDue
+
+    # Number of days to look ahead when the request doesn't define it.
+    default_days = 7
+
+    def get_days(self):
+        """
+            Returns the number of days to look ahead for due services.
+        """
+        try:
+            return int(self.request.GET.get('days', self.default_days))
+        except ValueError:
+            return self.default_days
+
+    def get_queryset(self):
+        """
+            Only return the services of the cars owned by the user that are
+            due before the end of the requested window.
+        """
+        due_before = now() + timedelta(days=self.get_days())
+        return ServiceDue.objects.filter(
+            car__owner=self.request.user, car__deleted__isnull=True,
+            next_due__lte=due_before).select_related('car')
+
+    def get_context_data(self, **kwargs):
+        """
+            Add the size of the window to the context.
+        """
+        context = super(ServiceDueListView, self).get_context_data(**kwargs)
+        context['days'] = self.get_days()
+        return context
@@ -17,15 +17,21 @@
 ##
 
 from django.views.generic import CreateView, DetailView, UpdateView, DeleteView
+from django.views.generic import View
 
 from django.template.defaultfilters import slugify
 from django.shortcuts import get_object_or_404
+from django.http import HttpResponseRedirect
 
 from automaintenance.models import Car, Trip
 from automaintenance.views.forms import TripForm
-from automaintenance.views import MAINTENANCE_CRUD_BACK_KEY
-
-from decimal import Decimal
+from automaintenance.views import MAINTENANCE_CRUD_BACK_KEY, json_response
+from automaintenance.views.mixins import ReplicaReadMixin, ConditionalGetMixin
+from automaintenance.versions import car_version, fleet_signature
+from automaintenance.trips import search_trips
+from automaintenance.snapshots import car_snapshot
+from automaintenance.rows import record_rows
+from automaintenance.deletion import delete_trip
 
 
 class CreateTripView(CreateView):
@@ -133,7 +139,7 @@ class EditTripView(UpdateView):
         return super(EditTripView, self).post(request, *args, **kwargs)        
 
 
-class DisplayTripView(DetailView):
+class DisplayTripView(ReplicaReadMixin, ConditionalGetMixin, DetailView):
     """
         Override DetailView to show records associated with a trip object.
     """
@@ -155,6 +161,28 @@ class DisplayTripView(DetailView):
 
         return super(DisplayTripView, self).get(request, *args, **kwargs)
 
+    def get_etag_parts(self):
+        """
+            The trip page only changes with the version of the car and the
+            cars in the menu.
+        """
+        car_slug = self.kwargs.get('car_slug')
+        parts = super(DisplayTripView, self).get_etag_parts()
+        parts += [car_slug, self.kwargs.get('slug'),
+                  car_version(self.request.user, car_slug),
+                  fleet_signature(self.request.user)]
+        return parts
+
+    def not_modified(self):
+        """
+            The record pages still need to come back to this trip.
+        """
+        for trip in Trip.objects.filter(car__slug=self.kwargs.get('car_slug'),
+                                        car__owner=self.request.user,
+                                        car__deleted__isnull=True,
+                                        slug=self.kwargs.get('slug')):
+            self.request.session[MAINTENANCE_CRUD_BACK_KEY] = trip
+
     def get_context_data(self, **kwargs):
         """
             Adding some contextual data to the view including:
@@ -162,22 +190,16 @@ class DisplayTripView(DetailView):
         """
         context = super(DisplayTripView, self).get_context_data(**kwargs)
 
-        maintenance_list = self.object.car.get_maintenance_list(trip=self.object)
+        maintenance_list = record_rows(self.car, trip=self.object)
 
         maintenance_list.sort()
 
         context['maintenance_list'] = maintenance_list
-        
-        total_price = Decimal(0.0)
-        total_mileage = 0
-        
-        for maintenance in maintenance_list:
-            total_price += maintenance.total_cost
-            if hasattr(maintenance, 'tank_mileage'):
-                total_mileage += maintenance.tank_mileage
-                
-        context['total_price'] = total_price
-        context['total_mileage'] = total_mileage
+
+        trip_records = car_snapshot(self.car).select(trip=self.object.pk)
+
+        context['total_price'] = trip_records.total('cost')
+        context['total_mileage'] = trip_records.total('distance')
         context['car'] = self.car
         
         self.request.session[MAINTENANCE_CRUD_BACK_KEY] = self.object
@@ -229,6 +251,14 @@ class DeleteTripView(DeleteView):
         """
         return self.model.objects.filter(car=self.car)
 
+    def delete(self, request, *args, **kwargs):
+        """
+            Take the records out of the trip without loading them.
+        """
+        self.object = self.get_object()
+        delete_trip(self.object)
+        return HttpResponseRedirect(self.get_success_url())
+
     def get_success_url(self):
         """
             Override the success url to go back to the car's detail page.
@@ -236,3 +266,37 @@ class DeleteTripView(DeleteView):
         return_value = self.car.get_absolute_url()
         
         return return_value
+
+
+class TripSearchView(ReplicaReadMixin, View):
+    """
+        Returns a page of the trips of a car whose name contains the q
+        parameter, used by the trip picker of the record forms::
+
+            {"trips": [{"id": 3, "label": "2013-05-01 - Vacation", ...}],
+             "page": 1, "has_next": false}
+    """
+
+    def get(self, request, *args, **kwargs):
+        """
+            Look up the page of trips.
+        """
+        car = get_object_or_404(Car, slug=self.kwargs.get('car_slug', None),
+                                owner=request.user)
+
+        try:
+            page = max(int(request.GET.get('page', 1)), 1)
+        except ValueError:
+            page = 1
+
+        trips, has_next = search_trips(car, request.GET.get('q', ''), page)
+
+        return json_response({
+            'trips': [{'id': trip.pk, 'label': unicode(trip),
+                       'name': trip.name, 'slug': trip.slug,
+                       'start': trip.start.isoformat(),
+                       'end': trip.end.isoformat() if trip.end else None}
+                      for trip in trips],
+            'page': page,
+            'has_next': has_next,
+        })